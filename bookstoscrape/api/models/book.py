@@ -1,12 +1,13 @@
 from __future__ import annotations
 from pydantic import BaseModel
-from typing import Literal
+from typing import Literal, Optional
 
 from ...utils.common import Category, Rating
 
 
 class BooksOverview(BaseModel):
     books: list[BookOverview]
+    next_cursor: Optional[str] = None
 
 class BookOverview(BaseModel):
     bts_id: int
@@ -21,6 +22,7 @@ SortOrder = Literal["asc", "desc"]
 
 class Changelog(BaseModel):
     changes: list[Change]
+    next_cursor: Optional[str] = None
 
 class Change(BaseModel):
     bts_id: int
@@ -1,6 +1,7 @@
 from datetime import datetime, timezone
 from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.security import OAuth2PasswordRequestForm
+from pymongo import ReturnDocument
 from pymongo.asynchronous.database import AsyncDatabase
 
 from ...settings import (
@@ -8,7 +9,7 @@ from ...settings import (
 )
 from ...utils.api import (
     auth_limiter, create_access_token, create_api_key, get_current_user,
-    get_db, logger, pl_ctx
+    get_db, logger, pl_ctx, revoke_api_key
 )
 from ..models.auth import GenerateApiKey, Login, SignUp, UserData
 
@@ -91,7 +92,7 @@ async def generate_api_key(
 
         time_now = datetime.now(timezone.utc)
         key, key_hash = create_api_key()
-        await key_collection.update_one(
+        old_key = await key_collection.find_one_and_update(
             {"user_id": user["_id"]},
             {
                 "$set": {
@@ -103,8 +104,12 @@ async def generate_api_key(
                     "created_at": time_now
                 }
             },
-            upsert=True
+            upsert=True,
+            projection={"key_hash": 1},
+            return_document=ReturnDocument.BEFORE
         )
+        if old_key:
+            await revoke_api_key(db, old_key["key_hash"])
 
         return {"key": key}
     except HTTPException:
@@ -1,13 +1,21 @@
+import json
 from bson import ObjectId
 from datetime import date, datetime, timezone
+from functools import partial
 from fastapi import APIRouter, Depends, HTTPException, Request, Query
+from fastapi.responses import StreamingResponse
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.asynchronous.cursor import AsyncCursor
 from pymongo.asynchronous.database import AsyncDatabase
-from typing import Annotated, Optional
+from typing import Annotated, AsyncIterator, Optional
 
 from ...settings import (
     API_RATE_LIMIT, MONGODB_BOOK_COLLECTION, MONGODB_CHANGELOG_COLLECTION,
 )
-from ...utils.api import api_limiter, get_db, logger, require_api_key
+from ...utils.api import (
+    api_limiter, books_query_cache, build_keyset_filter, encode_cursor,
+    get_db, logger, require_api_key,
+)
 from ...utils.common import Book, Category, Rating
 from ..models.book import (
     BooksOverview, Changelog, ChangelogEvent, SortBy, SortOrder,
@@ -31,6 +39,7 @@ async def get_books(
     sort_order: Annotated[SortOrder, Query()] = "desc",
     limit: Annotated[int, Query(gt=0, le=100)] = 20,
     offset: Annotated[int, Query()] = 0,
+    cursor: Annotated[Optional[str], Query()] = None,
     user_id: ObjectId = Depends(require_api_key),
     db: AsyncDatabase = Depends(get_db)
 ):
@@ -38,39 +47,73 @@ async def get_books(
     Get all books.
         - Filter by: categories, min_price, max_price, and ratings
         - Sort by: rating, price, and review_count
-        - Paginate via limit and offset.
+        - Paginate via limit and cursor, passing the next_cursor of the previous page.
+          offset is still supported, but each page skips every book before it.
     """
-    try:
-        book_collection = db[MONGODB_BOOK_COLLECTION]
-
-        filters = {}
-        if categories:
-            filters["category"] = {"$in": categories}
-        if min_price or max_price:
-            filters["price"] = ({"$gte": min_price} if min_price else {}) | \
-                               ({"$lte": max_price} if max_price else {})
-        if ratings:
-            filters["rating"] = {"$in": ratings}
-
-        books = await book_collection.find(
-            filter=filters,
-            projection={
-                "_id": 0,
-                "bts_id": 1, "name": 1, "category": 1, "price": 1,
-                "rating": 1, "review_count": 1
-            },
-            sort=[
-                (sort_by, -1 if sort_order == "desc" else 1),
-                ("bts_id", 1)
-            ],
-            skip=offset, limit=limit
-        ).to_list()
+    if cursor and offset:
+        raise HTTPException(400, detail="Use either cursor or offset")
 
-        return {"books": books}
+    try:
+        # Served from memory until the crawler or the scheduler write new books
+        query = (
+            tuple(sorted(set(categories))), min_price or None, max_price or None,
+            tuple(sorted(set(ratings))), sort_by, sort_order, limit, offset, cursor
+        )
+        return await books_query_cache.get(
+            query, partial(find_books, db[MONGODB_BOOK_COLLECTION], *query)
+        )
+    except HTTPException:
+        raise
     except Exception as exc:
         logger.error(f"Unexpected error: {repr(exc)}")
         raise HTTPException(500, detail=str(exc))
     
+async def find_books(
+    book_collection: AsyncCollection,
+    categories: tuple[Category, ...],
+    min_price: Optional[float],
+    max_price: Optional[float],
+    ratings: tuple[Rating, ...],
+    sort_by: SortBy,
+    sort_order: SortOrder,
+    limit: int,
+    offset: int,
+    cursor: Optional[str]
+) -> dict:
+    """Query a page of books, with the cursor of the next page if there is one"""
+    filters = {}
+    if categories:
+        filters["category"] = {"$in": list(categories)}
+    if min_price or max_price:
+        filters["price"] = ({"$gte": min_price} if min_price else {}) | \
+                           ({"$lte": max_price} if max_price else {})
+    if ratings:
+        filters["rating"] = {"$in": list(ratings)}
+
+    # Ties are ordered in the sort direction too, so one (sort_by, bts_id) index serves both orders
+    direction = -1 if sort_order == "desc" else 1
+    sort = [(sort_by, direction), ("bts_id", direction)]
+    if cursor:
+        filters |= build_keyset_filter(sort, cursor)
+
+    books = await book_collection.find(
+        filter=filters,
+        projection={
+            "_id": 0,
+            "bts_id": 1, "name": 1, "category": 1, "price": 1,
+            "rating": 1, "review_count": 1
+        },
+        sort=sort,
+        skip=offset, limit=limit + 1  # One more book tells if there is a next page
+    ).to_list()
+
+    next_cursor = None
+    if len(books) > limit:
+        books = books[:limit]
+        next_cursor = encode_cursor(sort, books[-1])
+
+    return {"books": books, "next_cursor": next_cursor}
+
 @router.get(
     "/books/{book_id}",
     tags=["book"], response_model=Book
@@ -112,12 +155,17 @@ async def get_changes(
     events: Annotated[list[ChangelogEvent], Query()] = [],
     start_date: Annotated[Optional[date], Query(example="2025-12-03")] = None,
     end_date: Annotated[Optional[date], Query(example="2025-12-03")] = None,
+    limit: Annotated[int, Query(gt=0, le=1000)] = 100,
+    cursor: Annotated[Optional[str], Query()] = None,
+    stream: Annotated[bool, Query()] = False,
     user_id: ObjectId = Depends(require_api_key),
     db: AsyncDatabase = Depends(get_db)
 ):
     """
-    Get changes from the changelog collection
+    Get changes from the changelog collection, newest first
         - Filter by events, start_date, and end_date
+        - Paginate via limit and cursor, passing the next_cursor of the previous page.
+        - With stream, every change after the cursor is streamed as NDJSON, one change per line.
     """
     try:
         changelog_collection = db[MONGODB_CHANGELOG_COLLECTION]
@@ -136,15 +184,44 @@ async def get_changes(
                 end_datetime = end_datetime.replace(tzinfo=timezone.utc)
                 filters["timestamp"]["$lte"] = end_datetime
 
+        sort = [("timestamp", -1), ("bts_id", 1)]
+        if cursor:
+            filters |= build_keyset_filter(sort, cursor)
+
+        if stream:
+            return StreamingResponse(
+                stream_changes(changelog_collection.find(filter=filters, projection={"_id": 0}, sort=sort)),
+                media_type="application/x-ndjson"
+            )
+
         changelog = await changelog_collection.find(
             filter=filters,
             projection={"_id": 0},
-            sort=[("timestamp", -1), ("bts_id", 1)]
+            sort=sort,
+            limit=limit + 1  # One more change tells if there is a next page
         ).to_list()
+
+        next_cursor = None
+        if len(changelog) > limit:
+            changelog = changelog[:limit]
+            next_cursor = encode_cursor(sort, changelog[-1])
         for log in changelog:
             log["timestamp"] = log["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
 
-        return {"changes": changelog}
+        return {"changes": changelog, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as exc:
         logger.error(f"Unexpected error: {repr(exc)}")
         raise HTTPException(500, detail=str(exc))
+
+async def stream_changes(changelog: AsyncCursor) -> AsyncIterator[str]:
+    """Write changes as NDJSON as they come from the cursor, so only one batch is held at a time"""
+    try:
+        async for log in changelog:
+            log["timestamp"] = log["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
+            yield json.dumps(log, default=str) + "\n"
+    except Exception as exc:  # The response has started, so it can only be cut short
+        logger.error(f"Unexpected error: {repr(exc)}")
+    finally:
+        await changelog.close()
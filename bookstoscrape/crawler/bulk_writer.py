@@ -0,0 +1,148 @@
+import asyncio
+from logging import Logger
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import BulkWriteError, PyMongoError
+from typing import Optional
+
+from ..settings import (
+    BULK_WRITE_BATCH_SIZE, BULK_WRITE_FLUSH_INTERVAL_SECONDS,
+    BULK_WRITE_MAX_RETRIES,
+)
+from ..utils.crawler import compute_retry_delay
+
+
+WriteOperation = InsertOne | ReplaceOne | UpdateOne
+
+DUPLICATE_KEY = 11000
+# Write errors worth retrying, e.g. a write conflict or a primary stepping down
+TRANSIENT_WRITE_ERROR_CODES = {
+    6, 7, 89, 91, 112, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436,
+}
+
+class BulkWriter:
+    """
+    Write-behind buffer for one collection.
+
+    Operations are collected and sent as unordered `bulk_write` batches, when
+    `batch_size` operations are waiting or `flush_interval` seconds after the
+    first one, whichever comes first. `write` returns once its operation is
+    written, with whether it inserted a new document, so callers can still
+    tell adds from updates.
+
+    A batch that fails is retried up to `max_retries` times. Operations that
+    succeeded are not sent again, and the ones that failed with a transient
+    error are retried together. Other write errors, e.g. a duplicate key,
+    fail their operation at once. A batch whose write concern wasn't met is
+    retried whole.
+
+    A batch that fails without a reply may have been applied, and is sent
+    again. Replaces and updates are idempotent. Inserts should carry their
+    own `_id`: one that an earlier attempt applied fails with a duplicate
+    key on the retry, and is counted as written.
+    """
+    def __init__(
+        self,
+        name: str, collection: AsyncCollection, logger: Logger,
+        batch_size: int = BULK_WRITE_BATCH_SIZE,
+        flush_interval: float = BULK_WRITE_FLUSH_INTERVAL_SECONDS,
+        max_retries: int = BULK_WRITE_MAX_RETRIES
+    ):
+        self.name = name
+        self.collection = collection
+        self.logger = logger
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._batch: list[tuple[WriteOperation, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._writes: set[asyncio.Task] = set()  # Batches being written
+        self.stats = {"operations": 0, "batches": 0, "retries": 0}
+
+    async def write(self, operation: WriteOperation) -> bool:
+        """Queue a write operation and return whether it inserted a document once written."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((operation, future))
+        self.stats["operations"] += 1
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_interval, self.flush)
+        return await future
+
+    def flush(self):
+        """Send the pending operations as one batch"""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, batch: list[tuple[WriteOperation, asyncio.Future]]):
+        self.stats["batches"] += 1
+        upserted_before: set[asyncio.Future] = set()  # Applied by an attempt whose write concern wasn't met
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats["retries"] += 1
+                delay = compute_retry_delay(attempt)
+                self.logger.warning(
+                    f"[manager] Retrying {len(batch)} {self.name} writes in {delay:.2f} seconds: {repr(error)}"
+                )
+                await asyncio.sleep(delay)
+
+            try:
+                result = await self.collection.bulk_write(
+                    [operation for operation, _ in batch], ordered=False
+                )
+                self._resolve(batch, set(result.upserted_ids), upserted_before=upserted_before)
+                return
+            except BulkWriteError as exc:
+                error = exc
+                errors = {write_error["index"]: write_error for write_error in exc.details.get("writeErrors", [])}
+                retried = {i for i, write_error in errors.items() if write_error.get("code") in TRANSIENT_WRITE_ERROR_CODES}
+                applied = {
+                    i for i, write_error in errors.items()
+                    if attempt and (write_error.get("code") == DUPLICATE_KEY) and isinstance(batch[i][0], InsertOne)
+                }
+                failed = set(errors) - retried - applied
+                if exc.details.get("writeConcernErrors"):
+                    retried = set(range(len(batch))) - failed - applied
+
+                upserted = {upsert["index"] for upsert in exc.details.get("upserted", [])}
+                upserted_before |= {batch[i][1] for i in upserted & retried}
+                self._resolve(batch, upserted, retried | failed, upserted_before)
+                for i in failed:
+                    if not batch[i][1].done():
+                        batch[i][1].set_exception(exc)
+                batch = [item for i, item in enumerate(batch) if i in retried]
+                if not batch:
+                    return
+            except PyMongoError as exc:
+                error = exc
+            except Exception as exc:  # Not worth retrying, e.g. a document that can't be encoded
+                error = exc
+                break
+
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+    @staticmethod
+    def _resolve(
+        batch: list[tuple[WriteOperation, asyncio.Future]],
+        upserted: set[int], failed: frozenset[int] = frozenset(),
+        upserted_before: frozenset[asyncio.Future] = frozenset()
+    ):
+        """Hand every written operation of a batch whether it inserted a document"""
+        for i, (_, future) in enumerate(batch):
+            if (i not in failed) and (not future.done()):
+                future.set_result((i in upserted) or (future in upserted_before))
+
+    async def close(self):
+        """Write every pending operation"""
+        self.flush()
+        await asyncio.gather(*self._writes, return_exceptions=True)
@@ -0,0 +1,108 @@
+import asyncio
+from dataclasses import asdict
+from logging import Logger
+from pymongo import DeleteOne, ReplaceOne
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import PyMongoError
+from typing import AsyncIterator, Optional
+
+from ..settings import (
+    CHECKPOINT_INTERVAL_SECONDS, CHECKPOINT_LOAD_BATCH_SIZE,
+    CHECKPOINT_MAX_CHANGES,
+)
+from .frontier import Session
+
+
+class Checkpoint:
+    """
+    Crawler state kept in MongoDB while the run goes on, so a run that ends
+    early, even by a crash, can be resumed without a restart.
+
+    Only the changes since the last write are held in memory: sessions that
+    were queued are upserted and sessions that completed are deleted, in one
+    bulk write every `interval` seconds or once `max_changes` are waiting.
+    Failed sessions stay in the checkpoint.
+    """
+    def __init__(
+        self,
+        collection: AsyncCollection, logger: Logger,
+        interval: float = CHECKPOINT_INTERVAL_SECONDS,
+        max_changes: int = CHECKPOINT_MAX_CHANGES
+    ):
+        self.collection = collection
+        self.logger = logger
+        self.interval = interval
+        self.max_changes = max_changes
+        self._changes: dict[str, Optional[dict]] = {}  # sid to session, or None once completed
+        self._lock = asyncio.Lock()  # Writes are sent one at a time, in order
+        self._writes: set[asyncio.Task] = set()
+        self.stats = {"upserted": 0, "deleted": 0, "writes": 0}
+
+    async def setup(self, reset: bool = False):
+        """Create the checkpoint index. If reset, drop the sessions of the previous run first."""
+        if reset:
+            await self.collection.drop()
+        await self.collection.create_index("sid", unique=True)
+
+    def add(self, session: Session):
+        self._record(session.sid, asdict(session))
+
+    def remove(self, sid: str):
+        self._record(sid, None)
+
+    def _record(self, sid: str, doc: Optional[dict]):
+        self._changes[sid] = doc
+        if len(self._changes) >= self.max_changes:
+            task = asyncio.create_task(self.flush())
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def flush(self):
+        """Write the changes since the last write. Changes that fail are kept for the next one."""
+        async with self._lock:
+            changes, self._changes = self._changes, {}
+            if not changes:
+                return
+
+            operations = [
+                ReplaceOne({"sid": sid}, doc, upsert=True) if doc else DeleteOne({"sid": sid})
+                for sid, doc in changes.items()
+            ]
+            try:
+                await self.collection.bulk_write(operations, ordered=False)
+            except PyMongoError as exc:
+                self.logger.warning(f"[manager] Failed to write {len(changes)} checkpoint changes: {repr(exc)}")
+                for sid, doc in changes.items():  # Newer changes of the same session win
+                    self._changes.setdefault(sid, doc)
+                return
+
+            deleted = sum(doc is None for doc in changes.values())
+            self.stats["writes"] += 1
+            self.stats["deleted"] += deleted
+            self.stats["upserted"] += len(changes) - deleted
+
+    async def run(self):
+        """Write the changes every `interval` seconds for the length of the run"""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def close(self):
+        """Write every pending change"""
+        await asyncio.gather(*self._writes, return_exceptions=True)
+        await self.flush()
+
+    async def load(self, batch_size: int = CHECKPOINT_LOAD_BATCH_SIZE) -> AsyncIterator[Session]:
+        """
+        Read the checkpointed sessions back in batches of `batch_size`, ordered by
+        sid. Each batch is a new query, so no cursor is held open while the caller waits.
+        """
+        last_sid = None
+        while True:
+            query = {"sid": {"$gt": last_sid}} if last_sid else {}
+            batch = await self.collection.find(query, {"_id": 0}).sort("sid", 1).limit(batch_size).to_list()
+            for doc in batch:
+                yield Session(**doc)
+            if len(batch) < batch_size:
+                return
+            last_sid = batch[-1]["sid"]
@@ -3,3 +3,11 @@ from typing import Optional
 
 class ProcessingError(Exception):
     """Custom exception for processing errors"""
+
+    def __init__(self, resource_type: str, field: Optional[str] = None):
+        self.resource_type = resource_type
+        self.field = field  # The field that failed to extract, if known
+        super().__init__(f"{resource_type}: {field}" if field else resource_type)
+
+    def __reduce__(self):  # Keep the arguments when sent back from a parse worker
+        return self.__class__, (self.resource_type, self.field)
@@ -1,51 +1,70 @@
-import asyncio
-from httpx import AsyncClient
-from pathlib import Path
+from httpx import AsyncClient, Response
 from typing import Optional
 
-from ..utils.common import Book
-from .process import process_page, process_book
+from ..utils.common import BookListing
+from .parse_pool import ParsePool
 from ..settings import BROWSER_HEADERS
 
 
-async def fetch_page(client: AsyncClient, page_url: str) -> tuple[int, list[str]]:
+async def fetch_page(
+    client: AsyncClient,
+    page_url: str, cached_page: Optional[dict] = None
+) -> Response:
+    """
+    Fetch a BooksToScrape page.
+
+    The request is conditional on the validators of the cached page, so the
+    response is a 304 if the page hasn't been modified since it was cached.
+    """
+    headers = BROWSER_HEADERS
+    if cached_page:
+        if cached_page.get("etag"):
+            headers = headers | {"if-none-match": cached_page["etag"]}
+        if cached_page.get("last_modified"):
+            headers = headers | {"if-modified-since": cached_page["last_modified"]}
+    page = await client.get(page_url, headers=headers)
+
+    if not (cached_page and (page.status_code == 304)):
+        page.raise_for_status()
+    return page
+
+async def read_page(
+    parse_pool: ParsePool,
+    page_url: str, page: Response, cached_page: Optional[dict] = None
+) -> tuple[int, list[BookListing], Optional[dict]]:
     """
-    Fetch a BooksToScrape page and return the book count
-    and book URLs on the page.
+    Return the book count and book listings on a fetched page, along with
+    the page's new cache entry.
+
+    If the page hasn't been modified, the cached result is returned without
+    parsing and the cache entry is None.
     """
-    page = await client.get(page_url, headers=BROWSER_HEADERS)
-    page.raise_for_status()
-    
-    book_count, urls = await asyncio.to_thread(
-        process_page, page.content, page_url
-    )
-    return book_count, urls
+    if cached_page and (page.status_code == 304):
+        listings = [BookListing(**listing) for listing in cached_page["listings"]]
+        return cached_page["book_count"], listings, None
+
+    book_count, listings = await parse_pool.parse_page(page.content, page_url)
+
+    cache_entry = {
+        "page_url": page_url,
+        "etag": page.headers.get("etag"),
+        "last_modified": page.headers.get("last-modified"),
+        "book_count": book_count,
+        "listings": [listing.model_dump(mode="json") for listing in listings],
+    }
+    return book_count, listings, cache_entry
 
 async def fetch_book(
     client: AsyncClient,
-    book_id: int, book_url: str,
-    last_etag: Optional[str], snapshot_folder: Path
-) -> tuple[str, Optional[Book]]:
+    book_url: str, last_etag: Optional[str]
+) -> Response:
     """
-    Fetch a book page and return the etag and the processed Book model or None
-    if book page hasn't been modified.
-
-    Store the HTML snapshot in the process.
+    Fetch a book page. The response is a 304 if the book page
+    hasn't been modified since `last_etag`.
     """
     headers = BROWSER_HEADERS | {"if-none-match": last_etag or ""}
     book_page = await client.get(book_url, headers=headers)
 
-    etag = book_page.headers["etag"]
-    if book_page.status_code == 304:
-        return etag, None
-    
-    book_page.raise_for_status()
-
-    # Store HTML snapshot
-    with open(snapshot_folder / f"{book_id}.html", "wb") as f:
-        f.write(book_page.content)   
-
-    book = await asyncio.to_thread(
-        process_book, book_page.content, book_id, book_url
-    )
-    return etag, book
+    if book_page.status_code != 304:
+        book_page.raise_for_status()
+    return book_page
@@ -0,0 +1,302 @@
+import asyncio
+import heapq
+import itertools
+import os
+import socket
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from enum import IntEnum
+from pymongo import IndexModel, ReturnDocument
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import DuplicateKeyError
+from typing import Literal, Optional
+
+from ..settings import (
+    FRONTIER_LEASE_SECONDS, FRONTIER_POLL_INTERVAL_SECONDS,
+    FRONTIER_PRIORITY_WEIGHTS,
+)
+
+
+@dataclass
+class Session:
+    sid: str  # session id
+    resource_id: int
+    resource_type: Literal["page", "book"]
+    resource_url: str
+    retry_count: int = 0
+
+class Priority(IntEnum):
+    PAGE = 0  # Listing pages discover the rest of the work
+    NEW_BOOK = 1
+    CHANGED_BOOK = 2
+    UNCHANGED_BOOK = 3
+    RETRY = 4
+
+class Frontier(asyncio.Queue):
+    """
+    Priority queue of crawl sessions.
+
+    Each priority class is a FIFO heap. Classes are served by stride
+    scheduling using FRONTIER_PRIORITY_WEIGHTS, so higher classes get more
+    turns without starving the lower ones. Sessions are deduplicated by sid
+    for the whole run; retries bypass the check since they are re-queued on purpose.
+    Items are put and got as (priority, session) pairs, but new work
+    should go through `push`.
+
+    The async methods (add, claim, complete, retry, join and maintain) are
+    what the manager uses, and are shared with MongoFrontier.
+    """
+    def _init(self, maxsize: int):
+        self.retry_queue = RetryQueue(self)
+        self._heaps: dict[Priority, list[tuple[int, Session]]] = {p: [] for p in Priority}
+        self._strides = {p: 1 / FRONTIER_PRIORITY_WEIGHTS[p.name.lower()] for p in Priority}
+        self._passes = {p: 0.0 for p in Priority}
+        self._virtual_time = 0.0
+        self._counter = itertools.count()
+        self._size = 0
+        self._sids: set[str] = set()  # Every sid accepted during the run
+        self.duplicates = 0
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return self._size == 0
+
+    def _put(self, item: tuple[Priority, Session]):
+        priority, session = item
+        heap = self._heaps[priority]
+        if not heap:
+            # An idle class must not bank turns it did not use
+            self._passes[priority] = max(self._passes[priority], self._virtual_time)
+        heapq.heappush(heap, (next(self._counter), session))
+        self._sids.add(session.sid)
+        self._size += 1
+
+    def _get(self) -> Session:
+        priority = min(
+            (p for p in Priority if self._heaps[p]),
+            key=lambda p: (self._passes[p], p)
+        )
+        self._virtual_time = self._passes[priority]
+        self._passes[priority] += self._strides[priority]
+        self._size -= 1
+        return heapq.heappop(self._heaps[priority])[1]
+
+    def push(self, session: Session, priority: Priority) -> bool:
+        """Queue a session unless its sid was already seen in this run."""
+        if session.sid in self._sids:
+            self.duplicates += 1
+            return False
+        self.put_nowait((priority, session))
+        return True
+
+    async def add(self, session: Session, priority: Priority) -> bool:
+        return self.push(session, priority)
+
+    async def claim(self, timeout: float) -> Optional[Session]:
+        """Wait up to `timeout` seconds for the next session."""
+        try:
+            return await asyncio.wait_for(self.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def complete(self, session: Session):
+        self.task_done()
+
+    async def retry(self, session: Session, delay: float):
+        self.retry_queue.schedule(session, delay)
+
+    async def maintain(self):
+        """Background work for the length of the run: moving due retries back into the queue."""
+        await self.retry_queue.run()
+
+class MongoFrontier:
+    """
+    Crawl frontier stored in MongoDB, shared by crawler or scheduler
+    processes on any number of hosts.
+
+    Each session is a document that a node claims atomically with
+    `find_one_and_update`, which gives it a lease of FRONTIER_LEASE_SECONDS.
+    Leases of in-flight sessions are renewed by `maintain`. The lease of a
+    node that dies expires, and its sessions are claimed again by other nodes.
+    Completed sessions are kept with a "done" status, so sessions are never
+    queued twice and a resumed run does not replay finished work.
+
+    Sessions of different runs are kept apart by `run_id`. Classes are served
+    in strict priority order rather than by weight.
+    """
+    def __init__(self, collection: AsyncCollection, run_id: str):
+        self.collection = collection
+        self.run_id = run_id
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.duplicates = 0
+        self._leased: set[str] = set()  # sids leased by this node
+
+    async def setup(self, reset: bool = False):
+        """Create the frontier indexes. If reset, drop every session of the run first."""
+        if reset:
+            await self.collection.delete_many({"run_id": self.run_id})
+        await self.collection.create_indexes([
+            IndexModel([("run_id", 1), ("sid", 1)], unique=True),
+            IndexModel([("run_id", 1), ("status", 1), ("priority", 1), ("due_at", 1)]),
+        ])
+
+    async def add(self, session: Session, priority: Priority) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            result = await self.collection.update_one(
+                {"run_id": self.run_id, "sid": session.sid},
+                {
+                    "$setOnInsert": asdict(session) | {
+                        "run_id": self.run_id,
+                        "priority": int(priority),
+                        "status": "pending",
+                        "due_at": now,
+                        "lease_owner": None,
+                        "lease_expires_at": None,
+                    }
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:  # Another node inserted it first
+            self.duplicates += 1
+            return False
+
+        if result.upserted_id is None:
+            self.duplicates += 1
+            return False
+        return True
+
+    async def claim(self, timeout: float) -> Optional[Session]:
+        """
+        Lease the most urgent session that is due, or one whose lease has expired.
+        Poll for up to `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            now = datetime.now(timezone.utc)
+            doc = await self.collection.find_one_and_update(
+                {
+                    "run_id": self.run_id,
+                    "$or": [
+                        {"status": "pending", "due_at": {"$lte": now}},
+                        {"status": "leased", "lease_expires_at": {"$lt": now}},
+                    ]
+                },
+                {
+                    "$set": {
+                        "status": "leased",
+                        "lease_owner": self.node_id,
+                        "lease_expires_at": now + timedelta(seconds=FRONTIER_LEASE_SECONDS),
+                    }
+                },
+                projection={
+                    "_id": 0,
+                    "sid": 1, "resource_id": 1, "resource_type": 1,
+                    "resource_url": 1, "retry_count": 1
+                },
+                sort=[("priority", 1), ("due_at", 1)],
+                return_document=ReturnDocument.AFTER
+            )
+            if doc:
+                self._leased.add(doc["sid"])
+                return Session(**doc)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            await asyncio.sleep(min(FRONTIER_POLL_INTERVAL_SECONDS, remaining))
+
+    async def complete(self, session: Session):
+        self._leased.discard(session.sid)
+        await self.collection.update_one(
+            {"run_id": self.run_id, "sid": session.sid, "lease_owner": self.node_id},
+            {
+                "$set": {
+                    "status": "done",
+                    "lease_owner": None,
+                    "lease_expires_at": None,
+                }
+            }
+        )
+
+    async def retry(self, session: Session, delay: float):
+        self._leased.discard(session.sid)
+        await self.collection.update_one(
+            {"run_id": self.run_id, "sid": session.sid, "lease_owner": self.node_id},
+            {
+                "$set": {
+                    "retry_count": session.retry_count,
+                    "priority": int(Priority.RETRY),
+                    "status": "pending",
+                    "due_at": datetime.now(timezone.utc) + timedelta(seconds=delay),
+                    "lease_owner": None,
+                    "lease_expires_at": None,
+                }
+            }
+        )
+
+    async def join(self):
+        """Wait until no session of the run is pending or leased by any node."""
+        while await self.collection.count_documents(
+            {"run_id": self.run_id, "status": {"$ne": "done"}}, limit=1
+        ):
+            await asyncio.sleep(FRONTIER_POLL_INTERVAL_SECONDS)
+
+    async def maintain(self):
+        """Renew the leases held by this node for the length of the run."""
+        while True:
+            await asyncio.sleep(FRONTIER_LEASE_SECONDS / 3)
+            if self._leased:
+                await self.collection.update_many(
+                    {
+                        "run_id": self.run_id,
+                        "sid": {"$in": list(self._leased)},
+                        "lease_owner": self.node_id
+                    },
+                    {
+                        "$set": {
+                            "lease_expires_at": datetime.now(timezone.utc) + timedelta(seconds=FRONTIER_LEASE_SECONDS)
+                        }
+                    }
+                )
+
+class RetryQueue:
+    """
+    Time-ordered queue of sessions waiting for their retry.
+
+    A scheduled session keeps its unfinished task on the frontier, so
+    `frontier.join()` does not return while retries are pending. `run` moves
+    each session back into the frontier's retry class once it is due.
+    """
+    def __init__(self, frontier: Frontier):
+        self.frontier = frontier
+        self._heap: list[tuple[float, int, Session]] = []
+        self._counter = itertools.count()  # Tie-breaker for sessions due at the same time
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, session: Session, delay: float):
+        """Schedule a session taken from the frontier to be retried after `delay` seconds."""
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), session))
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+
+            now = time.monotonic()
+            while self._heap and (self._heap[0][0] <= now):
+                _, _, session = heapq.heappop(self._heap)
+                self.frontier.put_nowait((Priority.RETRY, session))
+                self.frontier.task_done()  # Hand back the task held while waiting
+
+            timeout = (self._heap[0][0] - now) if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
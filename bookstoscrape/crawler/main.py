@@ -1,45 +1,123 @@
 import asyncio
-from dataclasses import asdict
+from pathlib import Path
 from pymongo import IndexModel
+from pymongo.errors import OperationFailure
 from typing import Literal
 
-from ..settings import BASE_URL, WORKER_COUNT
-from ..utils.common import setup_logger, cleanup_logger
+from ..settings import BASE_URL, FRONTIER_BACKEND, MONGODB_BOOK_COLLECTION
+from ..utils.common import setup_logger, cleanup_logger, get_log_file
 from ..utils.crawler import build_cli_parser
 from .manager import Session, Manager
+from .parallel import merge_run_stats, run_shards
 
 
+REBUILD_COLLECTION = f"{MONGODB_BOOK_COLLECTION}_rebuild"
+
+def get_book_indexes() -> list[IndexModel]:
+    """Secondary indexes of the book collection, used by the API's filters and sorts"""
+    return [
+        IndexModel([("category", 1), ("price", 1), ("rating", 1), ("review_count", 1)]),
+        IndexModel([("category", 1), ("rating", 1), ("price", 1), ("review_count", 1)]),
+        IndexModel([("price", 1), ("rating", 1), ("review_count", 1)]),
+        IndexModel([("rating", 1), ("price", 1), ("review_count", 1)]),
+        # Sort and tie-break of the API's keyset pagination
+        IndexModel([("rating", 1), ("bts_id", 1)]),
+        IndexModel([("price", 1), ("bts_id", 1)]),
+        IndexModel([("review_count", 1), ("bts_id", 1)])
+    ]
+
+def get_changelog_indexes() -> list[IndexModel]:
+    """Indexes of the changelog collection, matching the API's event and date filters and its sort"""
+    return [
+        IndexModel([("timestamp", -1), ("bts_id", 1)]),
+        IndexModel([("event", 1), ("timestamp", -1), ("bts_id", 1)])
+    ]
+
+def get_rebuild_snapshot_folder(snapshot_folder: Path) -> Path:
+    """Folder of the snapshots of a rebuild, swapped in with the rebuilt book collection"""
+    return snapshot_folder.with_name(f"{snapshot_folder.name}_rebuild")
+
+async def swap_in_rebuild(manager: Manager, snapshot_folder: Path):
+    """
+    Build the secondary indexes of the rebuilt book collection in one pass,
+    then replace the live book collection with it in a single rename. Once
+    it is swapped in, the snapshots of the rebuild replace the ones in
+    `snapshot_folder`.
+    """
+    if await rename_rebuild(manager):
+        await manager.changelog_collection.drop()
+        await manager.changelog_collection.create_indexes(get_changelog_indexes())
+        manager.logger.info("[manager] Swapped in the rebuilt book collection and dropped the changelog collection")
+    else:
+        manager.logger.info("[manager] Rebuilt book collection already swapped in")
+    # Every crawler process swaps in the snapshots it stored
+    manager.snapshot_store.replace(snapshot_folder)
+    manager.logger.info(f"[manager] Swapped in the snapshots of the rebuild: {snapshot_folder}")
+
+async def rename_rebuild(manager: Manager) -> bool:
+    """Rename the rebuilt book collection to the live one. Return False if it was already renamed."""
+    rebuild_collection = manager.book_collection
+    # Another crawler process sharing the mongo frontier may have swapped it in first.
+    # Building indexes would create the collection again.
+    if rebuild_collection.name not in await rebuild_collection.database.list_collection_names():
+        return False
+
+    indexes = await rebuild_collection.create_indexes(get_book_indexes())
+    manager.logger.info(f"[manager] Indexes created: {indexes}")
+    try:
+        await rebuild_collection.rename(MONGODB_BOOK_COLLECTION, dropTarget=True)
+    except OperationFailure as exc:
+        if exc.code != 26:  # NamespaceNotFound
+            raise
+        return False
+    return True
+
 async def bts_crawler(
     env: Literal["dev", "prod"] ="dev",
-    restart: bool = True
+    restart: bool = True,
+    processes: int = 1,
+    frontier: Literal["memory", "mongo"] = FRONTIER_BACKEND
 ):
-    """BooksToScrape Crawler"""
+    """
+    BooksToScrape Crawler
+
+    With more than one process, this process crawls the listing pages and
+    the book sessions are sharded across worker processes.
+
+    With the mongo frontier, crawler processes on any host can drain the
+    same run. Start one with restart, then the others without it.
+
+    A restart crawl writes to a shadow book collection, while the live one
+    keeps serving the API, and swaps it in once every session is done. A run
+    without restart carries on with the shadow collection if one exists.
+    """
     logger = setup_logger("crawler")
-    manager = Manager(env, logger)
+    manager = Manager(env, logger, listing_only=processes > 1, frontier_backend=frontier)
 
     manager.logger.info("[manager] BEGIN RUN")
-    manager.logger.info(f"[manager] Run parameters: env={env}, restart={restart}")
+    manager.logger.info(f"[manager] Run parameters: env={env}, restart={restart}, processes={processes}, frontier={frontier}")
     
+    rebuilding = restart or (REBUILD_COLLECTION in await manager.book_collection.database.list_collection_names())
+    snapshot_folder = manager.snapshot_folder
+    if rebuilding:
+        # The live books keep their snapshots until the rebuild is swapped in
+        manager.set_book_collection(REBUILD_COLLECTION)
+        manager.set_snapshot_folder(get_rebuild_snapshot_folder(snapshot_folder))
+        manager.logger.info(f"[manager] Writing books to {REBUILD_COLLECTION} and snapshots to {manager.snapshot_folder}")
+
     if restart:
         await manager.book_collection.drop()
-        await manager.changelog_collection.drop()
-        manager.logger.info("[manager] Dropped book and changelog collections")
+        manager.snapshot_store.clear()  # Snapshots of an abandoned rebuild
 
-        # Clean snapshot folder
-        for item in manager.snapshot_folder.iterdir():
-            if item.is_file:
-                item.unlink()
-    
-        indexes = await manager.book_collection.create_indexes(
-            indexes=[
-                IndexModel([("bts_id", 1)], unique=True),
-                IndexModel([("category", 1), ("price", 1), ("rating", 1), ("review_count", 1)]),
-                IndexModel([("category", 1), ("rating", 1), ("price", 1), ("review_count", 1)]),
-                IndexModel([("price", 1), ("rating", 1), ("review_count", 1)]),
-                IndexModel([("rating", 1), ("price", 1), ("review_count", 1)])
-            ]
-        )
-        manager.logger.info(f"[manager] Indexes created: {indexes}")
+        # Only the unique index is kept up to date during the load. The others
+        # are built once the collection is complete.
+        await manager.book_collection.create_index("bts_id", unique=True)
+        await manager.page_cache_collection.create_index("page_url", unique=True)
+
+        if frontier == "mongo":
+            await manager.frontier.setup(reset=True)
+        else:
+            await manager.checkpoint.setup(reset=True)
 
         first_page_session = Session(
             sid="p1",
@@ -47,23 +125,37 @@ async def bts_crawler(
             resource_type="page",
             resource_url=f"{BASE_URL}/page-1.html",
         )
-        await manager.queue.put(first_page_session)
-        manager.crawler_state[first_page_session.sid] = asdict(first_page_session)
-    else:
-        async for doc in manager.crawler_state_collection.find({}, {"_id": 0}):
-            await manager.queue.put(Session(**doc))
-            manager.crawler_state[doc["sid"]] = doc
+        await manager.push_session(first_page_session)
+    elif frontier == "memory":
+        await manager.checkpoint.setup()
 
-    for i in range(WORKER_COUNT):
-        task = asyncio.create_task(manager.worker(f"w{i+1}"))
-        manager.workers.append(task)
+    # Without restart, the memory frontier is filled from the checkpoint as the run goes on
+    await manager.run(resume=(not restart) and (frontier == "memory"))
+
+    completed = manager.completed
+    if processes > 1:
+        manager.logger.info(f"[manager] Sharding {len(manager.discovered_books)} book sessions across {processes} processes")
+        results = await run_shards(
+            "crawler", env, list(manager.discovered_books.values()), processes,
+            log_file=get_log_file(manager.logger),
+            book_collection=manager.book_collection.name,
+            snapshot_folder=manager.snapshot_folder
+        )
+        manager.run_stats = merge_run_stats([manager.run_stats] + [r["run_stats"] for r in results])
+        completed = completed and all(r["completed"] for r in results)
 
-    await asyncio.gather(*manager.workers, return_exceptions=True)
+    manager.logger.info(f"[manager] Run stats: {manager.run_stats}")
 
-    await manager.crawler_state_collection.drop()
-    if manager.crawler_state:
-        await manager.crawler_state_collection.insert_many(manager.crawler_state.values())
+    if rebuilding:
+        if completed:
+            await swap_in_rebuild(manager, snapshot_folder)
+        else:  # The live book collection is kept until a run without restart completes the rebuild
+            manager.logger.warning(f"[manager] Run ended early. Re-run with --no-restart to complete {REBUILD_COLLECTION}")
+    if completed or (not rebuilding):  # The live book collection changed
+        await manager.bump_catalog_version()
     
+    await manager.close_http_client()
+    await manager.close_parse_pool()
     await manager.close_db_client()
     cleanup_logger("crawler")
 
@@ -72,7 +164,14 @@ async def bts_crawler(
 def cli():
     parser = build_cli_parser()
     args = parser.parse_args()
-    asyncio.run(bts_crawler(env=args.env, restart=args.restart))
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    if (args.processes > 1) and (args.frontier == "mongo"):
+        parser.error("--processes cannot be used with the mongo frontier. Start more crawler processes with --no-restart instead")
+    asyncio.run(bts_crawler(
+        env=args.env, restart=args.restart,
+        processes=args.processes, frontier=args.frontier
+    ))
 
 
 if __name__ == "__main__":
@@ -1,178 +1,465 @@
 import asyncio
 import math
-from dataclasses import dataclass, asdict
-from datetime import datetime, timezone
-from httpx import AsyncClient, HTTPError
+import time
+from bson import ObjectId
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timezone
+from httpx import (
+    AsyncClient, HTTPError, HTTPStatusError, Limits, TimeoutException,
+    TransportError,
+)
 from logging import Logger
-from pymongo import AsyncMongoClient
+from pathlib import Path
+from pymongo import AsyncMongoClient, InsertOne, ReplaceOne, UpdateOne
 from typing import Literal, Optional
 
 from .. import settings as ss
-from ..utils.common import Book
-from ..utils.crawler import extract_id_from_book_url, send_error_email
+from ..utils.common import Book, BookListing
+from ..utils.crawler import (
+    compute_retry_delay, extract_id_from_book_url, parse_retry_after,
+    send_error_email,
+)
 from ..utils.scheduler import send_alert_email
+from .bulk_writer import BulkWriter
+from .checkpoint import Checkpoint
 from .exceptions import ProcessingError
-from .fetch import fetch_page, fetch_book
+from .fetch import fetch_book, fetch_page, read_page
+from .frontier import Frontier, MongoFrontier, Priority, Session
+from .parse_pool import ParsePool
+from .pipeline import (
+    AlertEmail, BookWrite, ErrorEmail, EtagRefresh, FetchedResource,
+    PageCacheWrite, Snapshot, Stage, StageStats,
+)
+from .process import compute_product_digest
+from .snapshots import SnapshotStore
+from .stored_books import BOOK_FIELDS, StoredBooks
 
 
-@dataclass
-class Session:
-    sid: str  # session id
-    resource_id: int
-    resource_type: Literal["page", "book"]
-    resource_url: str
-    retry_count: int = 0
+class ConcurrencyController:
+    """
+    AIMD limit on the number of in-flight requests.
+
+    The limit grows by roughly one for every window of fast, successful
+    requests and is cut multiplicatively on 429s, 5xx responses, timeouts,
+    transport errors and responses slower than the target latency.
+    """
+    def __init__(
+        self,
+        logger: Logger,
+        min_limit: int, max_limit: int, initial_limit: int,
+        target_latency: float, decrease_factor: float
+    ):
+        self.logger = logger
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+        self._last_decrease_at = 0.0
+        self.stats = {
+            "current": int(self.limit),
+            "lowest": int(self.limit),
+            "highest": int(self.limit),
+            "increases": 0,
+            "decreases": 0,
+            "requests": 0,
+            "throttled": 0,
+            "server_errors": 0,
+            "timeouts": 0,
+        }
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one request slot and feed its outcome back into the limit."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+        started_at = time.monotonic()
+        signal = "success"
+        try:
+            yield
+        except HTTPStatusError as exc:
+            status_code = exc.response.status_code
+            if status_code == 429:
+                signal = "throttled"
+            elif status_code >= 500:
+                signal = "server_error"
+            else:
+                signal = "neutral"
+            raise
+        except TimeoutException:
+            signal = "timeout"
+            raise
+        except TransportError:
+            signal = "transport_error"
+            raise
+        except BaseException:
+            signal = "neutral"
+            raise
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self._update(signal, started_at, time.monotonic() - started_at)
+                self._condition.notify_all()
+
+    def _update(self, signal: str, started_at: float, latency: float):
+        self.stats["requests"] += 1
+        if signal in ("throttled", "timeout"):
+            self.stats["throttled" if signal == "throttled" else "timeouts"] += 1
+        elif signal == "server_error":
+            self.stats["server_errors"] += 1
+
+        if signal == "neutral":
+            return
+        
+        previous_limit = int(self.limit)
+        if (signal == "success") and (latency <= self.target_latency):
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+        elif started_at >= self._last_decrease_at:
+            # Requests that started before the last decrease saw the old limit,
+            # so they are not allowed to shrink it a second time.
+            self.limit = max(self.limit * self.decrease_factor, self.min_limit)
+            self._last_decrease_at = time.monotonic()
+        
+        current_limit = int(self.limit)
+        if current_limit != previous_limit:
+            direction = "increased" if current_limit > previous_limit else "decreased"
+            self.stats["increases" if current_limit > previous_limit else "decreases"] += 1
+            self.stats["current"] = current_limit
+            self.stats["lowest"] = min(self.stats["lowest"], current_limit)
+            self.stats["highest"] = max(self.stats["highest"], current_limit)
+            self.logger.info(
+                f"[manager] Concurrency {direction} to {current_limit} "
+                f"({signal}, latency={latency:.2f}s)"
+            )
 
 class Manager:
     def __init__(
         self,
         env: Literal["dev", "prod"], logger: Logger,
-        is_scheduler: bool = False
+        is_scheduler: bool = False, listing_only: bool = False,
+        worker_prefix: str = "",
+        frontier_backend: Literal["memory", "mongo"] = ss.FRONTIER_BACKEND
     ):
-        self.queue = asyncio.Queue()
         self.workers: list[asyncio.Task] = []
         self.env = env
         self.logger = logger
         self.is_scheduler = is_scheduler
+        self.listing_only = listing_only  # Collect book sessions instead of crawling them
+        self.worker_prefix = worker_prefix
         self.consecutive_failures = 0
         self.run_status_lock = asyncio.Lock()
         self.shutdown_event = asyncio.Event()
+        self.completed = False  # Whether the last run finished every session rather than stopping early
+        self.concurrency = ConcurrencyController(
+            logger,
+            min_limit=ss.MIN_CONCURRENCY,
+            max_limit=ss.MAX_CONCURRENCY,
+            initial_limit=ss.INITIAL_CONCURRENCY,
+            target_latency=ss.TARGET_LATENCY_SECONDS,
+            decrease_factor=ss.CONCURRENCY_DECREASE_FACTOR,
+        )
+        self.parse_pool = ParsePool()
+        self.run_stats = {
+            "succeeded": 0,
+            "failed": 0,
+            "duplicates_skipped": 0,
+            "cached_pages": 0,  # Listing pages that were not modified since they were cached
+            "unchanged_listings": 0,  # Books not fetched in scheduler runs since their listing hasn't changed
+            "unchanged_content": 0,  # Books whose etag changed but not their product content
+            "concurrency": self.concurrency.stats,
+            "parsing": self.parse_pool.stats,
+        }
 
         self._mongodb_client = AsyncMongoClient(ss.MONGODB_CONNECTION_URI, timeoutMS=5000)
         db = self._mongodb_client[ss.MONGODB_DB]
         self.book_collection = db[ss.MONGODB_BOOK_COLLECTION]
         self.changelog_collection = db[ss.MONGODB_CHANGELOG_COLLECTION]
         self.crawler_state_collection = db[ss.MONGODB_CRAWLER_STATE_COLLECTION]
+        self.frontier_collection = db[ss.MONGODB_FRONTIER_COLLECTION]
+        self.page_cache_collection = db[ss.MONGODB_PAGE_CACHE_COLLECTION]
+        self.meta_collection = db[ss.MONGODB_META_COLLECTION]
+        self.book_writer = BulkWriter("book", self.book_collection, logger)
+        self.changelog_writer = BulkWriter("changelog", self.changelog_collection, logger)
+        self.run_stats["bulk_writes"] = {
+            "books": self.book_writer.stats,
+            "changelog": self.changelog_writer.stats,
+        }
+
+        # One connection pool shared by all workers for the whole run
+        self.http_client = AsyncClient(
+            follow_redirects=True, proxy=ss.PROXY,
+            timeout=ss.REQUEST_TIMEOUT_SECONDS,
+            limits=Limits(
+                max_connections=ss.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=ss.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=ss.HTTP_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            http2=ss.HTTP2_ENABLED,
+        )
 
         self.current_date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-        self.crawler_state = {}  # Save to database if run ends prematurely
-        
-        if self.is_scheduler:
-            self.snapshot_folder = ss.BASE_FOLDER / "snapshots" / "scheduler" / self.current_date.replace("-", "")
+
+        self.frontier_backend = frontier_backend
+        if self.frontier_backend == "mongo":
+            run_id = f"scheduler-{self.current_date}" if self.is_scheduler else "crawler"
+            self.frontier = MongoFrontier(self.frontier_collection, run_id)
         else:
-            self.snapshot_folder = ss.BASE_FOLDER / "snapshots" / "crawler"
-        self.snapshot_folder.mkdir(parents=True, exist_ok=True)
+            self.frontier = Frontier()
+
+        # Unfinished crawler sessions, kept so a run that ends early can be resumed.
+        # The mongo frontier keeps its own sessions.
+        self.checkpoint = Checkpoint(
+            self.crawler_state_collection, logger
+        ) if (not self.is_scheduler) and (self.frontier_backend == "memory") else None
+        if self.checkpoint:
+            self.run_stats["checkpoint"] = self.checkpoint.stats
+        
+        self.set_snapshot_folder(ss.BASE_FOLDER / "snapshots" / ("scheduler" if self.is_scheduler else "crawler"))
         
-        self.stored_books = {}  # Books already in the db from past crawler runs; used in scheduler runs
-        self.daily_change_report = None  # Used in scheduler runs
+        # Books already in the db from past crawler runs; used in scheduler runs
+        self.stored_books = StoredBooks(self.book_collection)
+        if self.is_scheduler:
+            self.run_stats["stored_books"] = self.stored_books.stats
+        self.discovered_books: dict[str, Session] = {}  # Book sessions found in listing_only runs
+        # Stages after the fetchers, in the order they are drained at the end of the run
+        self.fetch_stats = StageStats()
+        self.parse_stage = self._build_stage("parse", self._parse)
+        self.snapshot_stage = self._build_stage("snapshot", self._write_snapshot)
+        self.storage_stage = self._build_stage("storage", self._store)
+        self.notifier_stage = self._build_stage("notifier", self._notify)
+        self.stages = [self.parse_stage, self.snapshot_stage, self.storage_stage, self.notifier_stage]
+
+        self.daily_change_report = {  # Used in scheduler runs
+            "report_date": self.current_date,
+            "summary": {"added": 0, "updated": 0, "total": 0},
+            "changelog": []
+        } if self.is_scheduler else None
 
-    async def worker(self, wid: int):
+    def _build_stage(self, name: str, handler) -> Stage:
+        return Stage(
+            name, self.logger, handler,
+            concurrency=ss.PIPELINE_STAGES[name]["concurrency"],
+            queue_size=ss.PIPELINE_STAGES[name]["queue_size"],
+        )
+
+    async def fetcher(self, wid: str):
+        """
+        Claim sessions from the frontier and fetch them. Responses are handed to
+        the parse stage, which makes fetchers wait when the parsers fall behind.
+        """
         while not self.shutdown_event.is_set():
             session = None
             try:
-                try:
-                    session: Session = await asyncio.wait_for(
-                        self.queue.get(), ss.QUEUE_WAIT_TIMEOUT_SECONDS
-                    )
-                except asyncio.TimeoutError:
-                    if not self.shutdown_event.is_set():
-                        self.logger.info(f"[manager] No new queue entry for {ss.QUEUE_WAIT_TIMEOUT_SECONDS} seconds...")
-                        self.logger.info("[manager] Shutting down workers...")
-                        self.shutdown_event.set()
+                session = await self.frontier.claim(ss.QUEUE_POLL_INTERVAL_SECONDS)
+                if not session:
                     continue
 
                 worker_log_id = f"[{wid}][{session.resource_type}][{session.sid}]"
                 initial_message = self._get_initial_worker_message(session.retry_count)
                 self.logger.info(f"{worker_log_id} {initial_message}")
 
-                async with AsyncClient(
-                    follow_redirects=True, proxy=ss.PROXY,
-                    timeout=ss.REQUEST_TIMEOUT_SECONDS,
-                ) as client:
-                    try:
-                        if session.resource_type == "page":
-                            book_count, book_urls = await fetch_page(client, session.resource_url)
-
-                            if self.env == "prod":  # Scrape only a single page if env is "dev"
-                                if session.resource_id == 1:
-                                    page_count = math.ceil(book_count / len(book_urls))
-                                    for i in range(2, page_count+1):
-                                        page_session = Session(
-                                            sid=f"p{i}",
-                                            resource_id=i,
-                                            resource_type="page",
-                                            resource_url=f"{ss.BASE_URL}/page-{i}.html"
-                                        )
-                                        await self.queue.put(page_session)
-                                        self.crawler_state[page_session.sid] = asdict(page_session)
-
-                            for url in book_urls:
-                                book_id = extract_id_from_book_url(url)
-                                book_session = Session(
-                                    sid=f"b{book_id}",
-                                    resource_id=book_id,
-                                    resource_type="book",
-                                    resource_url=url,
-                                )
-                                await self.queue.put(book_session)
-                                self.crawler_state[book_session.sid] = asdict(book_session)
-                            
-                            self.logger.info(f"{worker_log_id} Processed page successfully")
-                        else:
-                            # Retrieve last etag for the book
-                            if self.is_scheduler:
-                                stored_book = self.stored_books.get(session.resource_id)
-                                if stored_book:
-                                    last_etag = stored_book["crawl_metadata"]["etag"]
-                                else:
-                                    last_etag = None
+                try:
+                    cached_page = None
+                    if session.resource_type == "page":
+                        cached_page = await self.page_cache_collection.find_one(
+                            {"page_url": session.resource_url}, {"_id": 0}
+                        )
+                        async with self.concurrency.slot():
+                            response = await fetch_page(self.http_client, session.resource_url, cached_page)
+                    else:
+                        # Retrieve last etag for the book
+                        if self.is_scheduler:
+                            stored_book = await self.stored_books.lookup(session.resource_id)
+                            if stored_book:
+                                last_etag = stored_book.etag
                             else:
                                 last_etag = None
-
-                            etag, book = await fetch_book(
-                                client,
-                                session.resource_id, session.resource_url,
-                                last_etag, self.snapshot_folder
-                            )
-                            await self._push_to_storage(
-                                session.resource_id, session.resource_url,
-                                etag, book
-                            )
-
-                        self.crawler_state.pop(session.sid)
-                        await self.track_run_status(True)
-
-                    except HTTPError as exc:
-                        self.logger.warning(f"{worker_log_id} Error: {repr(exc)}")
-                        if session.retry_count < ss.MAX_RETRY_COUNT:
-                            session.retry_count += 1
-                            await self.queue.put(session)
-                            self.logger.info(f"{worker_log_id} Queued for retry")
                         else:
-                            self.logger.warning(f"{worker_log_id} Retry limit reached")
-                            if (session.resource_type == "book") and (not self.is_scheduler):
-                                self.logger.info(f"{worker_log_id} Saving with failed status...")
-                                await self._push_to_storage(
-                                    session.resource_id, session.resource_url,
-                                    None, None
-                                )
-                            await asyncio.to_thread(send_error_email, session.sid, "HTTP")
-                            self.logger.info(f"[manager] Error email sent: {session.sid}")
-                        await self.track_run_status(False)
-
-                    except ProcessingError as exc:  # No retry on processing errors
-                        self.logger.exception(f"{worker_log_id} Error: {repr(exc)}")
-                        if (session.resource_type == "book") and (not self.is_scheduler):
-                            self.logger.info(f"{worker_log_id} Saving with failed status...")
-                            await self._push_to_storage(
-                                session.resource_id, session.resource_url,
-                                None, None
-                            )
-                        await asyncio.to_thread(send_error_email, session.sid, "Processing")
-                        self.logger.info(f"[manager] Error email sent: {session.sid}")
-                        await self.track_run_status(False)
+                            last_etag = None
+
+                        async with self.concurrency.slot():
+                            response = await fetch_book(self.http_client, session.resource_url, last_etag)
+                    self.fetch_stats.record(True)
+                    await self.parse_stage.put(FetchedResource(session, response, cached_page))
+
+                except HTTPError as exc:
+                    self.fetch_stats.record(False)
+                    self.logger.warning(f"{worker_log_id} Error: {repr(exc)}")
+                    if session.retry_count < ss.MAX_RETRY_COUNT:
+                        session.retry_count += 1
+                        retry_after = None
+                        if isinstance(exc, HTTPStatusError):
+                            retry_after = parse_retry_after(exc.response.headers.get("retry-after"))
+                        delay = compute_retry_delay(session.retry_count, retry_after)
+                        # The frontier holds the session until the retry is due
+                        await self.frontier.retry(session, delay)
+                        self.logger.info(f"{worker_log_id} Queued for retry in {delay:.2f} seconds")
+                    else:
+                        self.logger.warning(f"{worker_log_id} Retry limit reached")
+                        # Only exhausted retries count towards the consecutive failures
+                        await self._fail_session(session, "HTTP")
 
             except Exception as exc:
                 self.logger.exception(f"[{wid}] Error: {repr(exc)}")
-                await asyncio.to_thread(send_error_email, session.sid, "Unknown")
-                self.logger.info(f"[manager] Error email sent: {session.sid}")
-                await self.track_run_status(False)
-            finally:
                 if session:
-                    self.queue.task_done()
+                    await self._finish_session(session, "Unknown")
         else:
             self.logger.info(f"[manager] Worker {wid} stopped")
 
+    async def _parse(self, item: FetchedResource):
+        """Parse stage: turn a fetched page into new sessions, or a fetched book into a Book"""
+        session = item.session
+        log_id = f"[parse][{session.resource_type}][{session.sid}]"
+        try:
+            if session.resource_type == "page":
+                book_count, book_listings, cache_entry = await read_page(
+                    self.parse_pool, session.resource_url, item.response, item.cached_page
+                )
+                if cache_entry:
+                    await self.storage_stage.put(PageCacheWrite(session.resource_url, cache_entry))
+                elif item.cached_page:
+                    self.run_stats["cached_pages"] += 1
+                await self._push_page_sessions(session, book_count, book_listings)
+                self.logger.info(f"{log_id} Processed page successfully")
+                await self._finish_session(session)
+
+            elif item.response.status_code == 304:
+                self.logger.info(f"[manager] Unchanged: {session.resource_id}")
+                await self._finish_session(session)
+
+            else:
+                etag = item.response.headers.get("etag")
+                digest = compute_product_digest(item.response.content)
+                stored_book = await self.stored_books.lookup(session.resource_id) if self.is_scheduler else None
+                if digest and stored_book and (stored_book.digest == digest):
+                    # Only the etag or irrelevant markup changed
+                    self.logger.info(f"[manager] Unchanged content: {session.resource_id}")
+                    self.run_stats["unchanged_content"] += 1
+                    await self.storage_stage.put(EtagRefresh(session, etag))
+                    return
+
+                await self.snapshot_stage.put(Snapshot(session.resource_id, item.response.content))
+                book = await self.parse_pool.parse_book(
+                    item.response.content, session.resource_id, session.resource_url
+                )
+                await self.storage_stage.put(BookWrite(session, etag, book, digest=digest))
+
+        except ProcessingError as exc:  # No retry on processing errors
+            self.logger.exception(f"{log_id} Error: {repr(exc)}")
+            await self._fail_session(session, "Processing")
+        except Exception as exc:
+            self.logger.exception(f"{log_id} Error: {repr(exc)}")
+            await self._finish_session(session, "Unknown")
+
+    async def _push_page_sessions(self, session: Session, book_count: int, book_listings: list[BookListing]):
+        if self.env == "prod":  # Scrape only a single page if env is "dev"
+            if session.resource_id == 1:
+                page_count = math.ceil(book_count / len(book_listings))
+                for i in range(2, page_count+1):
+                    page_session = Session(
+                        sid=f"p{i}",
+                        resource_id=i,
+                        resource_type="page",
+                        resource_url=f"{ss.BASE_URL}/page-{i}.html"
+                    )
+                    await self.push_session(page_session)
+
+        book_ids = [extract_id_from_book_url(listing.url) for listing in book_listings]
+        # The stored books of the page are looked up at once. Books crawled by
+        # other processes are looked up again by the process that fetches them.
+        keep_stored_books = not (self.listing_only or (self.frontier_backend == "mongo"))
+        if self.is_scheduler and (keep_stored_books or ss.LISTING_CHANGE_DETECTION):
+            await self.stored_books.load(book_ids)
+
+        for book_id, listing in zip(book_ids, book_listings):
+            book_session = Session(
+                sid=f"b{book_id}",
+                resource_id=book_id,
+                resource_type="book",
+                resource_url=listing.url,
+            )
+            if self.is_scheduler and ss.LISTING_CHANGE_DETECTION:
+                priority = self.get_listing_priority(book_id, listing)
+                if priority is None:
+                    self.run_stats["unchanged_listings"] += 1
+                    self.stored_books.discard(book_id)
+                    continue
+                await self.push_session(book_session, priority)
+            else:
+                await self.push_session(book_session)
+            if not keep_stored_books:
+                self.stored_books.discard(book_id)
+
+    async def _write_snapshot(self, item: Snapshot):
+        """Snapshot stage: store the HTML snapshot of a book page"""
+        await self.snapshot_store.write(item.book_id, item.content)
+
+    async def _store(self, item: BookWrite | EtagRefresh | PageCacheWrite):
+        """Storage stage: write books and listing page cache entries to MongoDB"""
+        if isinstance(item, PageCacheWrite):
+            item.cache_entry["updated_at"] = datetime.now(timezone.utc)
+            await self.page_cache_collection.replace_one(
+                {"page_url": item.page_url}, item.cache_entry, upsert=True
+            )
+            return
+
+        session = item.session
+        try:
+            if isinstance(item, EtagRefresh):  # So the next run gets a 304
+                await self.book_writer.write(UpdateOne(
+                    {"bts_id": session.resource_id},
+                    {"$set": {"crawl_metadata.etag": item.etag}}
+                ))
+                error_type = None
+            else:
+                await self._push_to_storage(
+                    session.resource_id, session.resource_url,
+                    item.etag, item.book, item.digest
+                )
+                error_type = item.error
+        except Exception as exc:
+            self.logger.exception(f"[storage][book][{session.sid}] Error: {repr(exc)}")
+            error_type = "Unknown"
+        await self._finish_session(session, error_type)
+
+    async def _notify(self, item: AlertEmail | ErrorEmail):
+        """Notifier stage: send alert and error emails"""
+        if isinstance(item, ErrorEmail):
+            await asyncio.to_thread(send_error_email, item.sid, item.error_type)
+            self.logger.info(f"[manager] Error email sent: {item.sid}")
+            return
+        
+        try:
+            await asyncio.to_thread(send_alert_email, item.event, item.book_id)
+            self.logger.info(f"[manager] Alert email sent for {item.event} event: {item.book_id}")
+        except Exception as exc:
+            self.logger.warning(f"[manager] Failed to send alert email for {item.book_id}: {repr(exc)}")
+
+    async def _fail_session(self, session: Session, error_type: str):
+        """Finish a session that failed. Failed book crawls are stored with a failed status first."""
+        if (session.resource_type == "book") and (not self.is_scheduler):
+            self.logger.info(f"[manager] Saving with failed status: {session.sid}")
+            await self.storage_stage.put(BookWrite(session, None, None, error_type))
+        else:
+            await self._finish_session(session, error_type)
+
+    async def _finish_session(self, session: Session, error_type: Optional[str] = None):
+        """Record the outcome of a session and release it from the frontier"""
+        try:
+            if error_type:
+                await self.notifier_stage.put(ErrorEmail(session.sid, error_type))
+            elif self.checkpoint:
+                self.checkpoint.remove(session.sid)
+            if session.resource_type == "book":
+                self.stored_books.discard(session.resource_id)
+            await self.track_run_status(not error_type)
+        finally:
+            await self.frontier.complete(session)
+
     def _get_initial_worker_message(self, retry_count: int):
         if not retry_count:
             return "Start"
@@ -181,6 +468,7 @@ class Manager:
 
     async def track_run_status(self, success: bool = True):
         async with self.run_status_lock:
+            self.run_stats["succeeded" if success else "failed"] += 1
             if not self.shutdown_event.is_set():
                 if success:
                     self.consecutive_failures = 0
@@ -194,7 +482,8 @@ class Manager:
 
     async def _push_to_storage(
         self,
-        book_id: int, book_url: str, etag: Optional[str], book: Optional[Book]
+        book_id: int, book_url: str, etag: Optional[str], book: Optional[Book],
+        digest: Optional[str] = None
     ):
         if self.is_scheduler and (not book):  # Book hasn't been updated
             self.logger.info(f"[manager] Unchanged: {book_id}")
@@ -206,33 +495,54 @@ class Manager:
             "timestamp": timestamp,
             "status": "success" if book else "failed",
             "source_url": book_url,
-            "etag": etag
+            "etag": etag,
+            "digest": digest,  # Hash of the product content, see compute_product_digest
         }
 
-        # replace_one works for both normal crawler and scheduler runs.
-        # In a normal crawler run, we want to prevent duplicate key error on bts_id
-        # when failed crawls, stored in the book collection, are retried through restart=False.
-        # For scheduler runs, update_one is not ideal since the $set and $setOnInsert fields
-        # are not fixed.
-        result = await self.book_collection.replace_one(
-            filter={"bts_id": document["bts_id"]},
-            replacement=document,
-            upsert=True
-        )
+        stored_book = await self.stored_books.lookup(book_id) if self.is_scheduler else None
+        stored_doc = None
+        if stored_book and (stored_book.status == "success"):
+            # The content digest changed, so any field may have changed
+            stored_doc = await self.book_collection.find_one(
+                {"bts_id": book_id}, {"_id": 0, "crawl_metadata": 0}
+            )
+        if stored_doc:
+            # Only the changed fields are written, so unchanged index keys,
+            # the description and the URLs aren't rewritten or sent to the oplog
+            update = {
+                field: value for field, value in book.model_dump(mode="json").items()
+                if stored_doc.get(field) != value
+            }
+            changes = self._get_update_changes(update, stored_doc)
+            changed = bool(update)
+            update["crawl_metadata"] = document["crawl_metadata"]
+            did_upsert = await self.book_writer.write(
+                UpdateOne({"bts_id": book_id}, {"$set": update})
+            )
+            if not changed:
+                # Only the markup changed, or the book was stored before its digest.
+                # The new digest is kept but no update is reported.
+                self.logger.info(f"[manager] Unchanged: {book_id}")
+                return
+        else:  # New books and books whose last crawl failed are written whole
+            changes = {}
+            # In a normal crawler run, replace_one prevents duplicate key error on bts_id
+            # when failed crawls, stored in the book collection, are retried through restart=False.
+            did_upsert = await self.book_writer.write(
+                ReplaceOne({"bts_id": document["bts_id"]}, document, upsert=True)
+            )
 
         if not self.is_scheduler:
             self.logger.info(f"[manager] Pushed to storage: {book_id}")
         else:
-            if result.did_upsert:
+            if did_upsert:
                 self.logger.info(f"[manager] Book added: {book_id}")
                 event = "add"
                 self.daily_change_report["summary"]["added"] += 1
-                changes = {}
             else:
                 self.logger.info(f"[manager] Book updated: {book_id}")
                 event = "update"
                 self.daily_change_report["summary"]["updated"] += 1
-                changes = self._get_update_changes(book.model_dump(mode="json"))
             self.daily_change_report["summary"]["total"] += 1
 
             changelog_doc = {
@@ -241,28 +551,183 @@ class Manager:
                 "timestamp": timestamp,
                 "changes": changes
             }
-            await self.changelog_collection.insert_one(dict(changelog_doc))
+            # The _id makes the insert idempotent when a batch is retried
+            await self.changelog_writer.write(InsertOne({"_id": ObjectId(), **changelog_doc}))
 
             changelog_doc["timestamp"] = changelog_doc["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
             self.daily_change_report["changelog"].append(changelog_doc)
                 
-            try:
-                await asyncio.to_thread(send_alert_email, event, book_id)
-                self.logger.info(f"[manager] Alert email sent for {event} event: {book_id}")
-            except Exception as exc:
-                self.logger.warning(f"[manager] Failed to send alert email for {book_id}: {repr(exc)}")
+            await self.notifier_stage.put(AlertEmail(event, book_id))
+
+    def _get_update_changes(self, update: dict, stored_doc: dict):
+        """Changes of the fields tracked in the changelog"""
+        return {
+            field: {"old": stored_doc.get(field), "new": update[field]}
+            for field in BOOK_FIELDS if field in update
+        }
+
+    async def run(self, resume: bool = False):
+        """
+        Run the pipeline until every queued session, including pending retries,
+        is done or the run is shut down early. If resume, the sessions of the
+        checkpoint are queued while the run goes on.
 
-    def _get_update_changes(self, book: dict):
-        changes = {}
-        old_version: dict = self.stored_books[book["bts_id"]]
+        Enough fetchers are started to reach the maximum concurrency. The
+        concurrency controller decides how many of them fetch at once. Once the
+        fetchers stop, the other stages are drained in order, so every fetched
+        resource is parsed, stored and notified before the run returns.
+        """
+        for stage in self.stages:
+            stage.start()
+        self.fetch_stats.started_at = time.monotonic()
+        for i in range(ss.MAX_CONCURRENCY):
+            task = asyncio.create_task(self.fetcher(f"{self.worker_prefix}w{i+1}"))
+            self.workers.append(task)
+        maintain_task = asyncio.create_task(self.frontier.maintain())
+        report_task = asyncio.create_task(self.report_stages())
+        checkpoint_task = asyncio.create_task(self.checkpoint.run()) if self.checkpoint else None
 
-        for k in old_version.keys():
-            if k in ("bts_id", "crawl_metadata"):
-                continue
-            if (old:=old_version[k]) != (new:=book[k]):
-                changes[k] = {"old": old, "new": new}
+        queue_done = asyncio.create_task(self._wait_for_sessions(resume))
+        shutdown = asyncio.create_task(self.shutdown_event.wait())
+        await asyncio.wait([queue_done, shutdown], return_when=asyncio.FIRST_COMPLETED)
+        self.completed = queue_done.done()
+        if self.completed:
+            self.logger.info("[manager] All sessions completed")
+            self.logger.info("[manager] Shutting down workers...")
+        self.shutdown_event.set()
         
-        return changes
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        for stage in self.stages:
+            await stage.drain()
+            self.logger.info(f"[manager] {stage.name.capitalize()} stage drained")
+        await self.snapshot_store.close()
+        await self.book_writer.close()
+        await self.changelog_writer.close()
+
+        tasks = [maintain_task, report_task, queue_done, shutdown] + ([checkpoint_task] if checkpoint_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.checkpoint:
+            await self.checkpoint.close()
+        self.run_stats["duplicates_skipped"] = self.frontier.duplicates
+        self.run_stats["stages"] = self.get_stage_stats()
+
+    async def _wait_for_sessions(self, resume: bool):
+        """Wait until every session, including the ones still in the checkpoint if resume, is done"""
+        if resume:
+            await self.resume_from_checkpoint()
+        await self.frontier.join()
+
+    async def resume_from_checkpoint(self):
+        """
+        Queue the checkpointed sessions of an earlier run. They are read in batches
+        whenever the frontier runs low, so a large checkpoint isn't held in memory at once.
+        """
+        count = 0
+        async for session in self.checkpoint.load():
+            while self.frontier.qsize() >= ss.CHECKPOINT_LOAD_QUEUE_SIZE:
+                if self.shutdown_event.is_set():
+                    return
+                await asyncio.sleep(ss.QUEUE_POLL_INTERVAL_SECONDS)
+            await self.push_session(session)
+            count += 1
+        self.logger.info(f"[manager] Resumed {count} sessions from the checkpoint")
+
+    def get_stage_stats(self) -> dict:
+        """Queue depth and throughput of every stage"""
+        if isinstance(self.frontier, Frontier):  # Sessions waiting to be fetched
+            self.fetch_stats.record_queue_depth(self.frontier.qsize())
+        return {"fetch": dict(self.fetch_stats.stats)} | {
+            stage.name: dict(stage.stats) for stage in self.stages
+        }
+
+    async def report_stages(self):
+        """Log the queue depth and throughput of every stage for the length of the run"""
+        while True:
+            await asyncio.sleep(ss.STAGE_REPORT_INTERVAL_SECONDS)
+            report = " | ".join(
+                f"{name}: {stats['queue_depth']} queued, {stats['throughput']}/s"
+                for name, stats in self.get_stage_stats().items()
+            )
+            self.logger.info(f"[manager] Stages: {report}")
+
+    async def push_session(self, session: Session, priority: Optional[Priority] = None):
+        """Queue a new session and track it in the crawler state."""
+        if self.listing_only and (session.resource_type == "book"):
+            if session.sid not in self.discovered_books:
+                self.discovered_books[session.sid] = session
+                if self.checkpoint:  # Completed by the shard that crawls it
+                    self.checkpoint.add(session)
+            return
+        if priority is None:
+            priority = self.get_priority(session)
+        if await self.frontier.add(session, priority) and self.checkpoint:
+            self.checkpoint.add(session)
+
+    def get_priority(self, session: Session) -> Priority:
+        if session.resource_type == "page":
+            return Priority.PAGE
+        if session.retry_count:
+            return Priority.RETRY
+        if not self.is_scheduler:
+            return Priority.NEW_BOOK
+        
+        stored_book = self.stored_books.get(session.resource_id)
+        if not stored_book:
+            return Priority.NEW_BOOK
+        if not stored_book.etag:  # Forced refetch, e.g. after a failed crawl
+            return Priority.CHANGED_BOOK
+        return Priority.UNCHANGED_BOOK
+
+    def get_listing_priority(self, book_id: int, listing: BookListing) -> Optional[Priority]:
+        """
+        Decide from a book's listing whether its page should be fetched in a scheduler run.
+        Return None if the book can be skipped.
+
+        New books, books whose listing differs from the stored book and books
+        due for their periodic full check are fetched. Full checks are spread
+        evenly over FULL_CHECK_INTERVAL_DAYS by bts_id.
+        """
+        stored_book = self.stored_books.get(book_id)
+        if not stored_book:
+            return Priority.NEW_BOOK
+        if not stored_book.etag:
+            return Priority.CHANGED_BOOK
+        for field in ("price", "rating", "in_stock"):
+            if getattr(stored_book, field) != getattr(listing, field):
+                return Priority.CHANGED_BOOK
+        
+        day_number = date.fromisoformat(self.current_date).toordinal()
+        if book_id % ss.FULL_CHECK_INTERVAL_DAYS == day_number % ss.FULL_CHECK_INTERVAL_DAYS:
+            return Priority.UNCHANGED_BOOK
+        return None
+
+    def set_book_collection(self, name: str):
+        """Read and write books in another collection, e.g. the shadow collection of a rebuild"""
+        self.book_collection = self.book_collection.database[name]
+        self.book_writer.collection = self.book_collection
+        self.stored_books.collection = self.book_collection
+
+    def set_snapshot_folder(self, folder: Path):
+        """Store snapshots in another folder, e.g. the one of a rebuild"""
+        self.snapshot_folder = folder
+        self.snapshot_folder.mkdir(parents=True, exist_ok=True)
+        self.snapshot_store = SnapshotStore(self.snapshot_folder, day=self.current_date.replace("-", ""))
+        self.run_stats["snapshots"] = self.snapshot_store.stats
+
+    async def close_http_client(self):
+        await self.http_client.aclose()
+
+    async def close_parse_pool(self):
+        await self.parse_pool.shutdown()
+
+    async def bump_catalog_version(self):
+        """Tell the API that the books changed, so its workers drop their cached /books responses"""
+        await self.meta_collection.update_one(
+            {"_id": "catalog"}, {"$inc": {"version": 1}}, upsert=True
+        )
+        self.logger.info("[manager] Catalog version bumped")
 
     async def close_db_client(self):
         await self._mongodb_client.close()
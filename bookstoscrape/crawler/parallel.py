@@ -0,0 +1,127 @@
+import asyncio
+from dataclasses import asdict
+from pathlib import Path
+from typing import Literal, Optional
+
+from ..utils.common import setup_logger, cleanup_logger
+from ..utils.crawler import create_process_pool
+from .frontier import Session
+from .manager import Manager
+
+
+def shard_sessions(sessions: list[Session], process_count: int) -> list[list[Session]]:
+    """Split book sessions across processes by bts_id."""
+    shards = [[] for _ in range(process_count)]
+    for session in sessions:
+        shards[session.resource_id % process_count].append(session)
+    return shards
+
+async def run_shards(
+    name: Literal["crawler", "scheduler"],
+    env: Literal["dev", "prod"],
+    sessions: list[Session], process_count: int,
+    log_file: Optional[Path] = None,
+    book_collection: Optional[str] = None,
+    snapshot_folder: Optional[Path] = None
+) -> list[dict]:
+    """
+    Crawl book sessions in `process_count` worker processes, each with its own
+    event loop, HTTP pool and MongoDB client. Return the result of every shard.
+    Books are written to `book_collection` and snapshots to `snapshot_folder` if given.
+    """
+    loop = asyncio.get_running_loop()
+    with create_process_pool(process_count) as executor:
+        futures = [
+            loop.run_in_executor(
+                executor, run_shard,
+                name, env, shard_index, process_count,
+                [asdict(session) for session in shard], log_file, book_collection, snapshot_folder
+            )
+            for shard_index, shard in enumerate(shard_sessions(sessions, process_count))
+        ]
+        return await asyncio.gather(*futures)
+
+def run_shard(
+    name: Literal["crawler", "scheduler"],
+    env: Literal["dev", "prod"],
+    shard_index: int, shard_count: int,
+    sessions: list[dict], log_file: Optional[Path],
+    book_collection: Optional[str] = None,
+    snapshot_folder: Optional[Path] = None
+) -> dict:
+    """Worker process entry point"""
+    return asyncio.run(crawl_shard(
+        name, env, shard_index, shard_count, sessions, log_file, book_collection, snapshot_folder
+    ))
+
+async def crawl_shard(
+    name: Literal["crawler", "scheduler"],
+    env: Literal["dev", "prod"],
+    shard_index: int, shard_count: int,
+    sessions: list[dict], log_file: Optional[Path],
+    book_collection: Optional[str] = None,
+    snapshot_folder: Optional[Path] = None
+) -> dict:
+    logger = setup_logger(name, log_file=log_file)
+    manager = Manager(
+        env, logger,
+        is_scheduler=(name == "scheduler"),
+        worker_prefix=f"s{shard_index+1}",
+        frontier_backend="memory"  # Each shard owns its sessions
+    )
+    manager.logger.info(f"[manager] Shard {shard_index+1}/{shard_count}: {len(sessions)} sessions")
+    if book_collection:
+        manager.set_book_collection(book_collection)
+    if snapshot_folder:
+        manager.set_snapshot_folder(snapshot_folder)
+
+    if manager.is_scheduler:
+        await manager.stored_books.load(doc["resource_id"] for doc in sessions)
+
+    for doc in sessions:
+        await manager.push_session(Session(**doc))
+    await manager.run()
+
+    await manager.close_http_client()
+    await manager.close_parse_pool()
+    await manager.close_db_client()
+    cleanup_logger(name)
+
+    return {
+        "completed": manager.completed,
+        "run_stats": manager.run_stats,
+        "daily_change_report": manager.daily_change_report,
+    }
+
+def merge_run_stats(run_stats: list[dict]) -> dict:
+    """
+    Merge the run stats of several managers. Counters are summed,
+    except for the lowest and highest concurrency.
+    """
+    merged = {}
+    for stats in run_stats:
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                merged[key] = merge_run_stats([merged.get(key, {}), value])
+            elif key not in merged:
+                merged[key] = value
+            elif key == "lowest":
+                merged[key] = min(merged[key], value)
+            elif key == "highest":
+                merged[key] = max(merged[key], value)
+            else:
+                merged[key] += value
+    return merged
+
+def merge_daily_change_reports(reports: list[dict]) -> dict:
+    merged = {
+        "report_date": reports[0]["report_date"],
+        "summary": {"added": 0, "updated": 0, "total": 0},
+        "changelog": []
+    }
+    for report in reports:
+        for key, value in report["summary"].items():
+            merged["summary"][key] += value
+        merged["changelog"].extend(report["changelog"])
+    merged["changelog"].sort(key=lambda log: (log["timestamp"], log["bts_id"]))
+    return merged
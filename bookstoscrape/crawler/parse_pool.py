@@ -0,0 +1,135 @@
+import asyncio
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from ..settings import (
+    PARSE_BATCH_DELAY_SECONDS, PARSE_BATCH_SIZE, PARSE_POOL_SIZE,
+)
+from ..utils.common import Book, BookListing
+from ..utils.crawler import create_process_pool
+from .process import process_book, process_page
+
+
+ParseJob = tuple[Callable[..., Any], tuple]
+
+class ParsePool:
+    """
+    Parses pages in a pool of worker processes, away from the event loop
+    and the GIL of the crawler process.
+
+    Jobs are sent to the workers in batches of up to `batch_size` bodies, so
+    the cost of a round trip to a worker is shared by several pages. A batch
+    is sent as soon as it is full, or `batch_delay` seconds after its first job.
+    With a pool size of 0, pages are parsed in a thread of the crawler process.
+    The workers are started on the first job.
+    """
+    def __init__(
+        self,
+        pool_size: int = PARSE_POOL_SIZE,
+        batch_size: int = PARSE_BATCH_SIZE,
+        batch_delay: float = PARSE_BATCH_DELAY_SECONDS
+    ):
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._batch: list[tuple[ParseJob, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.stats = {"jobs": 0, "batches": 0}
+
+    async def parse_page(self, page: bytes, page_url: str) -> tuple[int, list[BookListing]]:
+        return await self._submit((process_page, (page, page_url)))
+
+    async def parse_book(self, content: bytes, book_id: int, book_url: str) -> Book:
+        return await self._submit((process_book, (content, book_id, book_url)))
+
+    async def _submit(self, job: ParseJob) -> Any:
+        self.stats["jobs"] += 1
+        if not self.pool_size:
+            func, args = job
+            return await asyncio.to_thread(func, *args)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((job, future))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        """Send the pending batch to the workers"""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        if self._executor is None:
+            self._executor = create_process_pool(self.pool_size)
+        futures = [future for _, future in batch]
+        try:
+            batch_future = self._executor.submit(parse_batch, [job for job, _ in batch])
+        except BrokenProcessPool as exc:
+            self._executor = None
+            self._resolve_error(futures, exc)
+            return
+        self.stats["batches"] += 1
+
+        loop = asyncio.get_running_loop()
+        batch_future.add_done_callback(
+            lambda done: loop.call_soon_threadsafe(self._resolve, futures, done)
+        )
+
+    def _resolve(self, futures: list[asyncio.Future], batch_future: Future):
+        """Hand the result of every job of a batch to the coroutine waiting for it"""
+        if batch_future.cancelled():  # The pool was shut down
+            for future in futures:
+                future.cancel()
+            return
+
+        exc = batch_future.exception()
+        if exc is not None:
+            if isinstance(exc, BrokenProcessPool):  # Start new workers on the next batch
+                self._executor = None
+            self._resolve_error(futures, exc)
+            return
+
+        for future, (succeeded, result) in zip(futures, batch_future.result()):
+            if future.done():  # The waiting worker was cancelled
+                continue
+            if succeeded:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    @staticmethod
+    def _resolve_error(futures: list[asyncio.Future], exc: BaseException):
+        for future in futures:
+            if not future.done():
+                future.set_exception(exc)
+
+    async def shutdown(self):
+        """Stop the workers, without blocking the event loop while they exit"""
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._executor:
+            executor, self._executor = self._executor, None
+            await asyncio.to_thread(executor.shutdown, cancel_futures=True)
+
+def parse_batch(jobs: list[ParseJob]) -> list[tuple[bool, Any]]:
+    """
+    Worker process entry point. Run every job of a batch and return whether
+    each one succeeded, with its result or its exception.
+    """
+    results = []
+    for func, args in jobs:
+        try:
+            results.append((True, func(*args)))
+        except Exception as exc:
+            results.append((False, exc))
+    return results
@@ -0,0 +1,124 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from httpx import Response
+from logging import Logger
+from typing import Any, Awaitable, Callable, Optional
+
+from ..utils.common import Book
+from .frontier import Session
+
+
+@dataclass
+class FetchedResource:
+    """A response waiting in the parse stage"""
+    session: Session
+    response: Response
+    cached_page: Optional[dict] = None
+
+@dataclass
+class Snapshot:
+    book_id: int
+    content: bytes
+
+@dataclass
+class BookWrite:
+    """A book waiting in the storage stage. Failed crawls have no book and the type of error."""
+    session: Session
+    etag: Optional[str]
+    book: Optional[Book]
+    error: Optional[str] = None
+    digest: Optional[str] = None
+
+@dataclass
+class EtagRefresh:
+    """A book whose etag changed while its product content didn't"""
+    session: Session
+    etag: Optional[str]
+
+@dataclass
+class PageCacheWrite:
+    page_url: str
+    cache_entry: dict
+
+@dataclass
+class AlertEmail:
+    event: str
+    book_id: int
+
+@dataclass
+class ErrorEmail:
+    sid: str
+    error_type: str
+
+class StageStats:
+    """Number of items handled by a stage, its throughput and its queue depth"""
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.stats = {
+            "processed": 0,
+            "failed": 0,
+            "throughput": 0.0,  # Items per second
+            "queue_depth": 0,
+            "highest": 0,  # Highest queue depth
+        }
+
+    def record(self, succeeded: bool):
+        self.stats["processed" if succeeded else "failed"] += 1
+        elapsed = time.monotonic() - self.started_at
+        self.stats["throughput"] = round(self.stats["processed"] / elapsed, 2) if elapsed else 0.0
+
+    def record_queue_depth(self, depth: int):
+        self.stats["queue_depth"] = depth
+        self.stats["highest"] = max(self.stats["highest"], depth)
+
+class Stage(StageStats):
+    """
+    A pipeline stage: `concurrency` tasks that take items from a bounded queue
+    and pass each one to `handler`.
+
+    When the queue is full, `put` waits, so a slow stage holds back the stages
+    that feed it instead of letting work pile up in memory.
+    """
+    def __init__(
+        self,
+        name: str, logger: Logger,
+        handler: Callable[[Any], Awaitable[None]],
+        concurrency: int, queue_size: int
+    ):
+        super().__init__()
+        self.name = name
+        self.logger = logger
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self.started_at = time.monotonic()
+        self.tasks = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+
+    async def put(self, item: Any):
+        await self.queue.put(item)
+        self.record_queue_depth(self.queue.qsize())
+
+    async def _run(self):
+        while True:
+            item = await self.queue.get()
+            self.record_queue_depth(self.queue.qsize())
+            try:
+                await self.handler(item)
+                self.record(True)
+            except Exception as exc:
+                self.logger.exception(f"[manager] {self.name.capitalize()} stage error: {repr(exc)}")
+                self.record(False)
+            finally:
+                self.queue.task_done()
+
+    async def drain(self):
+        """Wait until every queued item is handled, then stop the stage"""
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
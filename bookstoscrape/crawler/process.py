@@ -1,10 +1,15 @@
+import hashlib
+import importlib
 import re
-from bs4 import BeautifulSoup, Tag
-from typing import Literal, Optional
+import sys
+from bs4 import BeautifulSoup, SoupStrainer, Tag
+from types import ModuleType
+from typing import Any, Callable, Literal, Optional
 from urllib.parse import urljoin
 
 from .exceptions import ProcessingError
-from ..utils.common import Book
+from ..settings import PARSER_BACKEND
+from ..utils.common import Book, BookListing
 
 
 BOOK_RATING_MAPPER = {
@@ -14,19 +19,55 @@ BOOK_RATING_MAPPER = {
     "Four": 4,
     "Five": 5
 }
-
-def process_page(page: bytes, page_url: str) -> tuple[int, list[str]]:
+# Only these subtrees are parsed, the rest of the document is skipped
+PAGE_STRAINER = SoupStrainer(["form", "article"], class_=["form-horizontal", "product_pod"])
+BOOK_STRAINER = SoupStrainer(["ul", "article"], class_=["breadcrumb", "product_page"])
+# Sections of a book page that every Book field is extracted from
+BREADCRUMB_PATTERN = re.compile(rb'<ul class="breadcrumb">.*?</ul>', re.DOTALL)
+PRODUCT_ARTICLE_PATTERN = re.compile(rb'<article class="product_page">.*?</article>', re.DOTALL)
+# Markers of the sections the fast parsers build, from the tag holding the first
+# marker to the last end tag: the results form and listings of a page, and the
+# product article of a book page with its nested related products
+PAGE_SECTION = (b'class="form-horizontal"', b"</article>")
+PRODUCT_ARTICLE_SECTION = (b'class="product_page"', b"</article>")
+COMMENT_PATTERN = re.compile(rb"<!--.*?-->", re.DOTALL)
+WHITESPACE_PATTERN = re.compile(rb"\s+")
+ParserBackend = Literal["beautifulsoup", "lxml", "selectolax"]
+PARSER_BACKENDS: tuple[ParserBackend, ...] = ("beautifulsoup", "lxml", "selectolax")
+
+def get_parser(backend: ParserBackend) -> ModuleType:
+    """
+    Return the module that implements `parse_page` and `parse_book` for a parser backend.
+    BeautifulSoup is implemented in this module, the others in process_<backend>.py
     """
-    Extract the total number of books and all the book urls on a given page.
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"Unknown parser backend: {backend}")
+    if backend == "beautifulsoup":
+        return sys.modules[__name__]
+    return importlib.import_module(f".process_{backend}", __package__)
+
+def process_page(
+    page: bytes, page_url: str,
+    backend: ParserBackend = PARSER_BACKEND
+) -> tuple[int, list[BookListing]]:
+    """
+    Extract the total number of books and the listing of every book on a given page.
     """
     try:
-        soup = BeautifulSoup(page, "html.parser")
-        total_book_count = extract_total_book_count(soup)
-        book_urls = extract_book_urls(soup, page_url)
-        return total_book_count, book_urls
+        return get_parser(backend).parse_page(page, page_url)
+    except ProcessingError:
+        raise
     except Exception as exc:
         raise ProcessingError("page") from exc
 
+def parse_page(page: bytes, page_url: str) -> tuple[int, list[BookListing]]:
+    soup = BeautifulSoup(page, "html.parser", parse_only=PAGE_STRAINER)
+    fields = extract_fields("page", {
+        "book_count": lambda: extract_total_book_count(soup),
+        "listings": lambda: extract_book_listings(soup, page_url),
+    })
+    return fields["book_count"], fields["listings"]
+
 def extract_total_book_count(soup: BeautifulSoup) -> int:
     """Extract the total number of books"""
     book_count = soup.find("form", class_="form-horizontal") \
@@ -34,49 +75,125 @@ def extract_total_book_count(soup: BeautifulSoup) -> int:
         .find_previous_sibling().text
     return int(book_count)
 
-def extract_book_urls(soup: BeautifulSoup, page_url: str) -> list[str]:
-    """Extract all the book URLs on a page"""
+def extract_book_listings(soup: BeautifulSoup, page_url: str) -> list[BookListing]:
+    """Extract the URL, price, rating and availability of all the books on a page"""
     article_tags = soup.find_all("article", class_="product_pod")
     return [
-        urljoin(page_url, tag.h3.a.attrs["href"])
+        BookListing(
+            url=urljoin(page_url, tag.h3.a.attrs["href"]),
+            price=float(tag.find("p", class_="price_color").text.replace("£", "")),
+            rating=BOOK_RATING_MAPPER[tag.find("p", class_="star-rating").attrs["class"][-1]],
+            in_stock=tag.find("p", class_="availability").text.strip().startswith("In stock")
+        )
         for tag in article_tags
     ]
 
-def process_book(content: bytes, book_id: int, book_url: str) -> Book:
+def compute_product_digest(content: bytes) -> Optional[str]:
+    """
+    Hash the product sections of a book page, i.e. the breadcrumb and the
+    product article, without comments and with whitespace collapsed.
+    Return None if the page has no product article.
+    """
+    article = PRODUCT_ARTICLE_PATTERN.search(content)
+    if not article:
+        return None
+    breadcrumb = BREADCRUMB_PATTERN.search(content)
+    sections = (breadcrumb.group() if breadcrumb else b"") + article.group()
+    normalized = WHITESPACE_PATTERN.sub(b" ", COMMENT_PATTERN.sub(b"", sections))
+    return hashlib.blake2b(normalized, digest_size=16).hexdigest()
+
+def slice_section(content: bytes, start_marker: bytes, end_tag: bytes) -> Optional[bytes]:
+    """
+    Slice a section out of a page, from the tag holding start_marker to the
+    end of the last end_tag, so only its subtree is parsed.
+    Return None if the page has no such section.
+    """
+    marker = content.find(start_marker)
+    end = content.rfind(end_tag)
+    if (marker < 0) or (end < marker):
+        return None
+    return content[content.rfind(b"<", 0, marker):end + len(end_tag)]
+
+def slice_product_sections(content: bytes) -> bytes:
+    """
+    Slice the breadcrumb and the product article out of a book page, the only
+    sections its fields are extracted from. Missing sections are left out.
+    """
+    breadcrumb = BREADCRUMB_PATTERN.search(content)
+    article = slice_section(content, *PRODUCT_ARTICLE_SECTION)
+    return (breadcrumb.group() if breadcrumb else b"") + (article or b"")
+
+def process_book(
+    content: bytes, book_id: int, book_url: str,
+    backend: ParserBackend = PARSER_BACKEND
+) -> Book:
     """
     Process book page and return a Book pydantic model.
     """
     try:
-        soup = BeautifulSoup(content, "html.parser")
-        article_tag = soup.find(name="article", class_="product_page")
-        info_table = article_tag.table
-
-        availability = extract_availability(info_table)
-        if availability.startswith("In stock"):
-            in_stock = True
-            stock_count = re.search(r"(\d+)", availability).group()
-        else:
-            in_stock = False
-            stock_count = 0
-        
-        return Book(
-            bts_id=book_id,
-            name=extract_book_name(article_tag),
-            description=extract_book_description(article_tag),
-            url=book_url,
-            category=extract_book_category(soup),
-            upc=extract_upc(soup),
-            price=extract_price(info_table),
-            tax=extract_tax(info_table),
-            in_stock=in_stock,
-            stock_count=stock_count,
-            review_count=extract_review_count(info_table),
-            cover_image_url=extract_cover_image(article_tag, book_url),
-            rating=BOOK_RATING_MAPPER[extract_book_rating(article_tag)]
-        )
+        return get_parser(backend).parse_book(content, book_id, book_url)
+    except ProcessingError:
+        raise
     except Exception as exc:
         raise ProcessingError("book") from exc
 
+def parse_book(content: bytes, book_id: int, book_url: str) -> Book:
+    soup = BeautifulSoup(content, "html.parser", parse_only=BOOK_STRAINER)
+    article_tag = extract_fields("book", {
+        "article": lambda: extract_product_article(soup),
+    })["article"]
+    info = extract_fields("book", {
+        "info_table": lambda: extract_info_table(article_tag.table),
+    })["info_table"]
+
+    fields = extract_fields("book", {
+        "name": lambda: extract_book_name(article_tag),
+        "description": lambda: extract_book_description(article_tag),
+        "category": lambda: extract_book_category(soup),
+        "upc": lambda: extract_upc(info),
+        "price": lambda: extract_price(info),
+        "tax": lambda: extract_tax(info),
+        "availability": lambda: parse_availability(extract_availability(info)),
+        "review_count": lambda: extract_review_count(info),
+        "cover_image_url": lambda: extract_cover_image(article_tag, book_url),
+        "rating": lambda: BOOK_RATING_MAPPER[extract_book_rating(article_tag)],
+    })
+    in_stock, stock_count = fields.pop("availability")
+    return Book(bts_id=book_id, url=book_url, in_stock=in_stock, stock_count=stock_count, **fields)
+
+def extract_fields(
+    resource_type: Literal["page", "book"],
+    extractors: dict[str, Callable[[], Any]]
+) -> dict[str, Any]:
+    """
+    Run the extractor of every field and return the extracted values.
+    The first extractor to fail raises a ProcessingError with its field name.
+    """
+    fields = {}
+    for field, extractor in extractors.items():
+        try:
+            fields[field] = extractor()
+        except Exception as exc:
+            raise ProcessingError(resource_type, field) from exc
+    return fields
+
+def extract_info_table(info_table: Tag) -> dict[str, str]:
+    """Map the header text of each row of the product information table to its data text"""
+    return {row.th.text: row.td.text for row in info_table.find_all("tr")}
+
+def parse_availability(availability: str) -> tuple[bool, int]:
+    """Return whether the book is in stock and the stock count, given its availability text"""
+    if availability.startswith("In stock"):
+        return True, int(re.search(r"(\d+)", availability).group())
+    return False, 0
+
+def extract_product_article(soup: BeautifulSoup) -> Tag:
+    """Extract the product article, which holds every field but the category"""
+    article_tag = soup.find(name="article", class_="product_page")
+    if article_tag is None:
+        raise ValueError("Product article not found")
+    return article_tag
+
 def extract_book_name(article_tag: Tag) -> str:
     """Extract book name"""
     name: str = article_tag.h1.text
@@ -95,27 +212,25 @@ def extract_book_category(soup: BeautifulSoup) -> str:
         .find_all("li")[2].text
     return category.strip()
 
-def extract_upc(info_table: Tag) -> str:
+def extract_upc(info: dict[str, str]) -> str:
     """Extract the Universal Product Code of the book"""
-    return extract_td_given_th(info_table, "UPC")
+    return info["UPC"]
 
-def extract_price(info_table: Tag) -> float:
+def extract_price(info: dict[str, str]) -> float:
     """Extract price (excluding tax)"""
-    th_text = extract_td_given_th(info_table, "Price (excl. tax)")
-    return float(th_text.replace("£", ""))
+    return float(info["Price (excl. tax)"].replace("£", ""))
 
-def extract_tax(info_table: Tag) -> str:
+def extract_tax(info: dict[str, str]) -> float:
     """Extract tax on book"""
-    th_text = extract_td_given_th(info_table, "Tax")
-    return float(th_text.replace("£", ""))
+    return float(info["Tax"].replace("£", ""))
 
-def extract_availability(info_table: Tag) -> str:
+def extract_availability(info: dict[str, str]) -> str:
     """Extract stock availability"""
-    return extract_td_given_th(info_table, "Availability")
+    return info["Availability"]
 
-def extract_review_count(info_table: Tag) -> int:
+def extract_review_count(info: dict[str, str]) -> int:
     """Extract review count"""
-    return int(extract_td_given_th(info_table, "Number of reviews"))
+    return int(info["Number of reviews"])
 
 def extract_cover_image(article_tag: Tag, book_url: str) -> str:
     """Extract book cover image"""
@@ -126,6 +241,3 @@ def extract_book_rating(article_tag: Tag) -> Literal["One", "Two", "Three", "Fou
     """Extract book rating"""
     return article_tag.find("p", class_="star-rating").attrs["class"][-1]
 
-def extract_td_given_th(info_table: Tag, th_text: str) -> str:
-    """Extract table data text given the table header text"""
-    return info_table.find("th", string=th_text).parent.td.text
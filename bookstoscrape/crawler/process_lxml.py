@@ -0,0 +1,96 @@
+from lxml import html
+from lxml.html import HtmlElement
+from typing import Optional
+from urllib.parse import urljoin
+
+from .process import (
+    BOOK_RATING_MAPPER, PAGE_SECTION, extract_availability, extract_fields,
+    extract_price, extract_review_count, extract_tax, extract_upc,
+    parse_availability, slice_product_sections, slice_section,
+)
+from ..utils.common import Book, BookListing
+
+
+def has_class(class_name: str) -> str:
+    """XPath predicate matching elements with the given class"""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {class_name} ")'
+
+def parse_section(section: bytes) -> HtmlElement:
+    """
+    Parse sections sliced out of a page under one parent element. They're
+    decoded first, since they lack the charset declared by the page.
+    """
+    return html.fragment_fromstring(section.decode("utf-8", "replace"), create_parent="div")
+
+def parse_page(page: bytes, page_url: str) -> tuple[int, list[BookListing]]:
+    root = parse_section(slice_section(page, *PAGE_SECTION) or page)
+    fields = extract_fields("page", {
+        "book_count": lambda: extract_total_book_count(root),
+        "listings": lambda: extract_book_listings(root, page_url),
+    })
+    return fields["book_count"], fields["listings"]
+
+def extract_total_book_count(root: HtmlElement) -> int:
+    """Extract the total number of books from the tag before the "results" text"""
+    return int(root.xpath(
+        f'//form[{has_class("form-horizontal")}]'
+        '//text()[contains(., "results")]/preceding-sibling::*[1]'
+    )[0].text_content())
+
+def extract_book_listings(root: HtmlElement, page_url: str) -> list[BookListing]:
+    """Extract the URL, price, rating and availability of all the books on a page"""
+    book_listings = []
+    for article in root.xpath(f'//article[{has_class("product_pod")}]'):
+        price = article.xpath(f'.//p[{has_class("price_color")}]')[0].text_content()
+        rating = article.xpath(f'.//p[{has_class("star-rating")}]/@class')[0].split()[-1]
+        availability = article.xpath(f'.//p[{has_class("availability")}]')[0].text_content()
+        book_listings.append(
+            BookListing(
+                url=urljoin(page_url, article.find(".//h3").find(".//a").get("href")),
+                price=float(price.replace("£", "")),
+                rating=BOOK_RATING_MAPPER[rating],
+                in_stock=availability.strip().startswith("In stock")
+            )
+        )
+    return book_listings
+
+def parse_book(content: bytes, book_id: int, book_url: str) -> Book:
+    root = parse_section(slice_product_sections(content))
+    article = extract_fields("book", {
+        "article": lambda: root.xpath(f'//article[{has_class("product_page")}]')[0],
+    })["article"]
+    info = extract_fields("book", {
+        "info_table": lambda: extract_info_table(article.find(".//table")),
+    })["info_table"]
+
+    fields = extract_fields("book", {
+        "name": lambda: article.find(".//h1").text_content().strip(),
+        "description": lambda: extract_book_description(article),
+        "category": lambda: root.xpath(f'//ul[{has_class("breadcrumb")}]//li')[2].text_content().strip(),
+        "upc": lambda: extract_upc(info),
+        "price": lambda: extract_price(info),
+        "tax": lambda: extract_tax(info),
+        "availability": lambda: parse_availability(extract_availability(info)),
+        "review_count": lambda: extract_review_count(info),
+        "cover_image_url": lambda: urljoin(
+            book_url, article.xpath('.//div[@id="product_gallery"]//img/@src')[0]
+        ),
+        "rating": lambda: BOOK_RATING_MAPPER[
+            article.xpath(f'.//p[{has_class("star-rating")}]/@class')[0].split()[-1]
+        ],
+    })
+    in_stock, stock_count = fields.pop("availability")
+    return Book(bts_id=book_id, url=book_url, in_stock=in_stock, stock_count=stock_count, **fields)
+
+def extract_book_description(article: HtmlElement) -> Optional[str]:
+    """Extract book description"""
+    description_tags = article.xpath('.//div[@id="product_description"]/following-sibling::p[1]')
+    if description_tags:
+        return description_tags[0].text_content().strip()
+
+def extract_info_table(info_table: HtmlElement) -> dict[str, str]:
+    """Map the header text of each row of the product information table to its data text"""
+    return {
+        th.text_content(): th.getparent().find(".//td").text_content()
+        for th in info_table.iter("th")
+    }
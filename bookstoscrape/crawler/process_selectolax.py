@@ -0,0 +1,89 @@
+from selectolax.lexbor import LexborHTMLParser, LexborNode
+from typing import Optional
+from urllib.parse import urljoin
+
+from .process import (
+    BOOK_RATING_MAPPER, PAGE_SECTION, extract_availability, extract_fields,
+    extract_price, extract_review_count, extract_tax, extract_upc,
+    parse_availability, slice_product_sections, slice_section,
+)
+from ..utils.common import Book, BookListing
+
+
+def parse_page(page: bytes, page_url: str) -> tuple[int, list[BookListing]]:
+    tree = LexborHTMLParser(slice_section(page, *PAGE_SECTION) or page)
+    fields = extract_fields("page", {
+        "book_count": lambda: extract_total_book_count(tree.css_first("form.form-horizontal")),
+        "listings": lambda: extract_book_listings(tree, page_url),
+    })
+    return fields["book_count"], fields["listings"]
+
+def extract_book_listings(tree: LexborHTMLParser, page_url: str) -> list[BookListing]:
+    """Extract the URL, price, rating and availability of all the books on a page"""
+    return [
+        BookListing(
+            url=urljoin(page_url, article.css_first("h3 a").attributes["href"]),
+            price=float(article.css_first("p.price_color").text().replace("£", "")),
+            rating=BOOK_RATING_MAPPER[article.css_first("p.star-rating").attributes["class"].split()[-1]],
+            in_stock=article.css_first("p.availability").text().strip().startswith("In stock")
+        )
+        for article in tree.css("article.product_pod")
+    ]
+
+def extract_total_book_count(form: LexborNode) -> int:
+    """Extract the total number of books from the tag before the "results" text"""
+    for node in form.traverse(include_text=True):
+        if (node.tag == "-text") and ("results" in node.text()):
+            tag = node.prev
+            while tag.tag == "-text":
+                tag = tag.prev
+            return int(tag.text())
+    raise ValueError("Book count not found")
+
+def parse_book(content: bytes, book_id: int, book_url: str) -> Book:
+    tree = LexborHTMLParser(slice_product_sections(content))
+    article = extract_fields("book", {
+        "article": lambda: extract_product_article(tree),
+    })["article"]
+    info = extract_fields("book", {
+        "info_table": lambda: extract_info_table(article.css_first("table")),
+    })["info_table"]
+
+    fields = extract_fields("book", {
+        "name": lambda: article.css_first("h1").text().strip(),
+        "description": lambda: extract_book_description(article),
+        "category": lambda: tree.css("ul.breadcrumb li")[2].text().strip(),
+        "upc": lambda: extract_upc(info),
+        "price": lambda: extract_price(info),
+        "tax": lambda: extract_tax(info),
+        "availability": lambda: parse_availability(extract_availability(info)),
+        "review_count": lambda: extract_review_count(info),
+        "cover_image_url": lambda: urljoin(
+            book_url, article.css_first("div#product_gallery img").attributes["src"]
+        ),
+        "rating": lambda: BOOK_RATING_MAPPER[
+            article.css_first("p.star-rating").attributes["class"].split()[-1]
+        ],
+    })
+    in_stock, stock_count = fields.pop("availability")
+    return Book(bts_id=book_id, url=book_url, in_stock=in_stock, stock_count=stock_count, **fields)
+
+def extract_product_article(tree: LexborHTMLParser) -> LexborNode:
+    """Extract the product article, which holds every field but the category"""
+    article = tree.css_first("article.product_page")
+    if article is None:
+        raise ValueError("Product article not found")
+    return article
+
+def extract_book_description(article: LexborNode) -> Optional[str]:
+    """Extract book description"""
+    description_tag = article.css_first("div#product_description ~ p")
+    if description_tag:
+        return description_tag.text().strip()
+
+def extract_info_table(info_table: LexborNode) -> dict[str, str]:
+    """Map the header text of each row of the product information table to its data text"""
+    return {
+        th.text(): th.parent.css_first("td").text()
+        for th in info_table.css("th")
+    }
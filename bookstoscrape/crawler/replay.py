@@ -0,0 +1,200 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+from pymongo import AsyncMongoClient, IndexModel, ReplaceOne
+from typing import Literal, Optional
+
+from .. import settings as ss
+from ..utils.common import cleanup_logger, setup_logger
+from ..utils.crawler import build_replay_cli_parser, create_process_pool
+from .exceptions import ProcessingError
+from .main import get_book_indexes
+from .process import compute_product_digest, process_book
+from .snapshots import SnapshotStore
+
+
+STALE_SNAPSHOT = "stale"
+
+def replay_batch(
+    folder: Path, day: Optional[str], jobs: list[tuple[int, str, Optional[str]]], backend: str
+) -> list[tuple[int, bool, dict | str, Optional[str]]]:
+    """
+    Worker process entry point. Parse the snapshot of every book of a batch and
+    return, for each one, whether it succeeded with the parsed book and the
+    digest of its content, or the field that failed.
+    Snapshots whose digest differs from the stored one are older than the
+    stored book, e.g. a crawler snapshot of a book the scheduler updated since.
+    They aren't parsed and fail with STALE_SNAPSHOT.
+    Snapshots are read by the worker, so page bodies aren't sent between processes.
+    """
+    store = SnapshotStore(folder)
+    results = []
+    for book_id, book_url, stored_digest in jobs:
+        content = store.read(book_id, day)
+        digest = compute_product_digest(content)
+        if stored_digest and (digest != stored_digest):
+            results.append((book_id, False, STALE_SNAPSHOT, None))
+            continue
+        try:
+            book = process_book(content, book_id, book_url, backend)
+            results.append((book_id, True, book.model_dump(mode="json"), digest))
+        except ProcessingError as exc:
+            results.append((book_id, False, exc.field or exc.resource_type, None))
+    store.close_readers()
+    return results
+
+def get_update_changes(stored_book: dict, book: dict) -> dict:
+    """Fields of a stored book that differ from its replayed version"""
+    return {
+        field: {"old": stored_book[field], "new": value}
+        for field, value in book.items()
+        if (field in stored_book) and (stored_book[field] != value)
+    }
+
+async def bts_replay(
+    source: Literal["crawler", "scheduler"] = "crawler",
+    day: Optional[str] = None,
+    shadow: bool = False,
+    dry_run: bool = False,
+    processes: int = os.cpu_count() or 1
+):
+    """
+    BooksToScrape Replay
+
+    Rebuild books from stored HTML snapshots instead of the live site, e.g.
+    after a fix to the parsers. Snapshots are parsed in a pool of processes.
+    The books are written to the book collection, or to a shadow copy of it,
+    and a report lists the parse failures and the fields that changed.
+    Books that fail to parse, or whose snapshot is older than the stored
+    book, are left as they are.
+    """
+    logger = setup_logger("replay")
+    logger.info("[replay] BEGIN RUN")
+    logger.info(f"[replay] Run parameters: source={source}, day={day}, shadow={shadow}, dry_run={dry_run}, processes={processes}")
+
+    store = SnapshotStore(ss.BASE_FOLDER / "snapshots" / source)
+    book_ids = store.book_ids(day)
+    store.close_readers()
+    logger.info(f"[replay] {len(book_ids)} snapshots to replay")
+
+    mongodb_client = AsyncMongoClient(ss.MONGODB_CONNECTION_URI, timeoutMS=5000)
+    book_collection = mongodb_client[ss.MONGODB_DB][ss.MONGODB_BOOK_COLLECTION]
+    target_collection = book_collection
+    if shadow:
+        target_collection = mongodb_client[ss.MONGODB_DB][f"{ss.MONGODB_BOOK_COLLECTION}_replay"]
+        if not dry_run:
+            # The shadow starts as a full copy of the live collection, so books
+            # that aren't replayed are kept and the two can be compared or swapped
+            cursor = await book_collection.aggregate([{"$out": target_collection.name}])
+            await cursor.to_list()
+            await target_collection.create_indexes(
+                [IndexModel("bts_id", unique=True)] + get_book_indexes()
+            )
+
+    report = {
+        "summary": {"snapshots": len(book_ids), "replayed": 0, "failed": 0, "stale": 0, "repaired": 0, "changed": 0, "unchanged": 0},
+        "field_changes": {},  # Number of books whose field changed
+        "failures": [],
+        "stale": [],  # Books whose snapshot is older than the stored book
+        "changes": [],
+    }
+    timestamp = datetime.now(timezone.utc)
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Semaphore(processes * 2)  # Batches read from MongoDB or parsed at once
+
+    async def replay(batch: list[int]):
+        async with batches:
+            stored_books = {
+                doc["bts_id"]: doc
+                async for doc in book_collection.find({"bts_id": {"$in": batch}}, {"_id": 0})
+            }
+            jobs = []
+            for book_id in batch:
+                stored_book = stored_books.get(book_id, {})
+                book_url = stored_book.get("url") or stored_book.get("crawl_metadata", {}).get("source_url")
+                if book_url:
+                    jobs.append((book_id, book_url, stored_book.get("crawl_metadata", {}).get("digest")))
+                else:
+                    report["summary"]["failed"] += 1
+                    report["failures"].append({"bts_id": book_id, "field": "url"})
+
+            results = await loop.run_in_executor(
+                executor, replay_batch, store.folder, day, jobs, ss.PARSER_BACKEND
+            )
+
+        operations = []
+        for book_id, succeeded, result, digest in results:
+            if result == STALE_SNAPSHOT:
+                report["summary"]["stale"] += 1
+                report["stale"].append(book_id)
+                continue
+            if not succeeded:
+                report["summary"]["failed"] += 1
+                report["failures"].append({"bts_id": book_id, "field": result})
+                continue
+
+            report["summary"]["replayed"] += 1
+            stored_book = stored_books[book_id]
+            crawl_metadata = stored_book.get("crawl_metadata", {})
+            if crawl_metadata.get("status") != "success":
+                report["summary"]["repaired"] += 1
+            elif changes := get_update_changes(stored_book, result):
+                report["summary"]["changed"] += 1
+                report["changes"].append({"bts_id": book_id, "changes": changes})
+                for field in changes:
+                    report["field_changes"][field] = report["field_changes"].get(field, 0) + 1
+            else:
+                report["summary"]["unchanged"] += 1
+
+            result["crawl_metadata"] = {
+                "timestamp": timestamp,
+                "status": "success",
+                "source_url": result["url"],
+                "etag": crawl_metadata.get("etag"),
+                "digest": digest,
+            }
+            operations.append(ReplaceOne({"bts_id": book_id}, result, upsert=True))
+
+        if operations and (not dry_run):
+            await target_collection.bulk_write(operations, ordered=False)
+
+    with create_process_pool(processes) as executor:
+        await asyncio.gather(*[
+            replay(book_ids[start:start+ss.REPLAY_BATCH_SIZE])
+            for start in range(0, len(book_ids), ss.REPLAY_BATCH_SIZE)
+        ])
+
+    if (target_collection is book_collection) and (not dry_run):
+        # Tell the API that the books changed, so its workers drop their cached /books responses
+        await mongodb_client[ss.MONGODB_DB][ss.MONGODB_META_COLLECTION].update_one(
+            {"_id": "catalog"}, {"$inc": {"version": 1}}, upsert=True
+        )
+
+    logger.info(f"[replay] Summary: {report['summary']}")
+    logger.info(f"[replay] Field changes: {report['field_changes']}")
+    reports_path = ss.BASE_FOLDER / "reports"
+    reports_path.mkdir(exist_ok=True)
+    report_path = reports_path / f"replay_{timestamp.strftime('%Y%m%d%H%M%S')}.json"
+    with open(report_path, "w") as f:
+        json.dump(report, f, default=str)
+    logger.info(f"[replay] Report saved: {report_path}")
+
+    await mongodb_client.close()
+    logger.info("[replay] END RUN")
+    cleanup_logger("replay")
+
+def cli():
+    parser = build_replay_cli_parser()
+    args = parser.parse_args()
+    if args.processes < 1:
+        parser.error("--processes must be at least 1")
+    asyncio.run(bts_replay(
+        source=args.source, day=args.day, shadow=args.shadow,
+        dry_run=args.dry_run, processes=args.processes
+    ))
+
+
+if __name__ == "__main__":
+    cli()
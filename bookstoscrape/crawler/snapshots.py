@@ -0,0 +1,268 @@
+import asyncio
+import gzip
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import threading
+import zstandard
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import BinaryIO, Iterator, Literal, Optional
+
+from ..settings import (
+    PIPELINE_STAGES, SNAPSHOT_COMPRESSION, SNAPSHOT_SEGMENT_MAX_BYTES,
+)
+
+
+Compression = Optional[Literal["zstd", "gzip"]]
+BlobLocation = tuple[int, int, int]  # Segment number, offset and length
+
+COMPRESSION_CODES = {None: 0, "gzip": 1, "zstd": 2}  # First byte of every blob
+BLOB_INDEX_RECORD = struct.Struct("<16sQI")  # Content hash, offset and length of a blob in its segment
+MANIFEST_RECORD = struct.Struct("<IQI")  # Blob location. The record of a book is at bts_id * size.
+
+def compress(content: bytes, compression: Compression) -> bytes:
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compress(content)
+    if compression == "gzip":
+        return gzip.compress(content, compresslevel=6)
+    return content
+
+def decompress(data: bytes, compression: Compression) -> bytes:
+    if compression == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if compression == "gzip":
+        return gzip.decompress(data)
+    return data
+
+def create_exclusive(folder: Path, template: str) -> tuple[int, BinaryIO]:
+    """Create the first file of `template` with a free number. Safe across processes."""
+    number = 1
+    while True:
+        try:
+            return number, open(folder / template.format(number), "xb")
+        except FileExistsError:
+            number += 1
+
+class SnapshotStore:
+    """
+    Content-addressed store of HTML snapshots.
+
+    Each distinct page body is stored once, compressed, as a blob appended to a
+    segment file. Every writer appends to segments of its own, so shard
+    processes can share a store. A blob index next to each segment maps
+    content hashes to blobs and is read back to deduplicate against earlier runs.
+
+    A manifest per run and day maps every book to the blob of its snapshot.
+    It is an array of fixed-size records indexed by bts_id, read through mmap.
+    Records are written in place as snapshots are stored, so a run that is
+    killed keeps the snapshots it stored. The manifests of a day, or of every
+    day, are merged once per store, newest first, so the snapshot of any book
+    is found without a scan.
+    """
+    def __init__(
+        self,
+        folder: Path,
+        day: Optional[str] = None,
+        compression: Compression = SNAPSHOT_COMPRESSION,
+        max_workers: int = PIPELINE_STAGES["snapshot"]["concurrency"],
+        segment_max_bytes: int = SNAPSHOT_SEGMENT_MAX_BYTES
+    ):
+        self.folder = folder
+        self.segment_folder = folder / "segments"
+        self.manifest_folder = folder / "manifests"
+        self.day = day or datetime.now(timezone.utc).strftime("%Y%m%d")
+        self.compression = compression
+        self.max_workers = max_workers
+        self.segment_max_bytes = segment_max_bytes
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._append_lock = threading.Lock()
+        self._blobs: Optional[dict[bytes, BlobLocation]] = None  # Loaded on the first write
+        self._segment: Optional[tuple[int, BinaryIO, BinaryIO]] = None  # Number, segment and blob index files
+        self._manifest: Optional[BinaryIO] = None  # Manifest of this run, created on the first write
+        self._maps: dict[Path, Optional[mmap.mmap]] = {}
+        self._indexes: dict[Optional[str], Optional[mmap.mmap | bytearray]] = {}  # Merged manifests by day
+        self.stats = {"written": 0, "deduplicated": 0, "bytes_in": 0, "bytes_out": 0}
+
+    async def write(self, book_id: int, content: bytes):
+        """Add the snapshot of a book to today's manifest, storing its body unless it is already stored"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="snapshot")
+        loop = asyncio.get_running_loop()
+        size = await loop.run_in_executor(self._executor, self._write_blob, book_id, content)
+        self.stats["written"] += 1
+        self.stats["bytes_in"] += len(content)
+        if size:
+            self.stats["bytes_out"] += size
+        else:
+            self.stats["deduplicated"] += 1
+
+    def _write_blob(self, book_id: int, content: bytes) -> int:
+        """Return the size of the new blob, or 0 if the body was already stored"""
+        key = hashlib.blake2b(content, digest_size=16).digest()
+        with self._append_lock:
+            if self._blobs is None:
+                self._blobs = self._load_blob_index()
+            location = self._blobs.get(key)
+        size = 0
+        if location is None:
+            # Compressed outside the lock, so writers compress in parallel
+            data = bytes([COMPRESSION_CODES[self.compression]]) + compress(content, self.compression)
+            with self._append_lock:
+                location = self._blobs.get(key) or self._append(key, data)
+            size = len(data)
+        self._write_record(book_id, location)
+        return size
+
+    def _write_record(self, book_id: int, location: BlobLocation):
+        """Write the manifest record of a book once its blob is on disk. Records of missing books read as zeros."""
+        with self._append_lock:
+            if self._manifest is None:
+                self.manifest_folder.mkdir(parents=True, exist_ok=True)
+                _, self._manifest = create_exclusive(self.manifest_folder, f"{self.day}-{{:04d}}.idx")
+                self._indexes = {}
+        os.pwrite(self._manifest.fileno(), MANIFEST_RECORD.pack(*location), book_id * MANIFEST_RECORD.size)
+
+    def _append(self, key: bytes, data: bytes) -> BlobLocation:
+        if (self._segment is None) or (self._segment[1].tell() >= self.segment_max_bytes):
+            self._close_segment()
+            self.segment_folder.mkdir(parents=True, exist_ok=True)
+            number, segment_file = create_exclusive(self.segment_folder, "{:08d}.seg")
+            index_file = open(self.segment_folder / f"{number:08d}.idx", "ab")
+            self._segment = (number, segment_file, index_file)
+
+        number, segment_file, index_file = self._segment
+        offset = segment_file.tell()
+        segment_file.write(data)
+        segment_file.flush()  # The blob is on disk before the index points to it
+        index_file.write(BLOB_INDEX_RECORD.pack(key, offset, len(data)))
+        index_file.flush()
+        self._blobs[key] = (number, offset, len(data))
+        return self._blobs[key]
+
+    def _load_blob_index(self) -> dict[bytes, BlobLocation]:
+        blobs = {}
+        for path in sorted(self.segment_folder.glob("*.idx")):
+            number = int(path.stem)
+            data = path.read_bytes()
+            usable = len(data) - len(data) % BLOB_INDEX_RECORD.size  # A crash can leave a partial record
+            for key, offset, length in BLOB_INDEX_RECORD.iter_unpack(data[:usable]):
+                blobs[key] = (number, offset, length)
+        return blobs
+
+    def _close_segment(self):
+        if self._segment:
+            _, segment_file, index_file = self._segment
+            segment_file.close()
+            index_file.close()
+            self._segment = None
+
+    async def close(self):
+        """Wait for the writes in progress, then close the files of the run"""
+        if self._executor:
+            executor, self._executor = self._executor, None
+            await asyncio.to_thread(executor.shutdown)
+        self._close_segment()
+        if self._manifest:
+            self._manifest.close()
+            self._manifest = None
+        self.close_readers()
+
+    def clear(self):
+        """Delete every snapshot of the store"""
+        self.close_readers()
+        if self._manifest:
+            self._manifest.close()
+            self._manifest = None
+        for folder in (self.segment_folder, self.manifest_folder):
+            shutil.rmtree(folder, ignore_errors=True)
+        self._blobs = None
+
+    def replace(self, target: Path):
+        """
+        Move the closed store to `target`, replacing the store there, e.g. to
+        swap in the snapshots of a rebuild. Does nothing if it has no snapshots.
+        """
+        if not self.folder.exists():
+            return
+        self.close_readers()
+        old = target.with_name(f"{target.name}_old")
+        shutil.rmtree(old, ignore_errors=True)
+        if target.exists():
+            target.rename(old)
+        self.folder.rename(target)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def days(self) -> list[str]:
+        """Days with snapshots, oldest first"""
+        return sorted({path.name.split("-")[0] for path in self.manifest_folder.glob("*.idx")})
+
+    def _get_manifests(self, day: Optional[str] = None) -> list[Path]:
+        """Manifests of a day, or of every day, newest first"""
+        return sorted(self.manifest_folder.glob(f"{day or '*'}-*.idx"), reverse=True)
+
+    def _map(self, path: Path) -> Optional[mmap.mmap]:
+        if path not in self._maps:
+            with open(path, "rb") as f:
+                self._maps[path] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else None
+        return self._maps[path]
+
+    def _index(self, day: Optional[str] = None) -> Optional[mmap.mmap | bytearray]:
+        """
+        Manifest records of a day, or of every day, with the latest record of
+        each book. Built once and kept until the readers are closed.
+        """
+        if day not in self._indexes:
+            manifests = [m for m in map(self._map, self._get_manifests(day)) if m is not None]
+            if len(manifests) <= 1:
+                self._indexes[day] = manifests[0] if manifests else None
+            else:
+                index = bytearray(max(map(len, manifests)))
+                for manifest in reversed(manifests):  # Oldest first, so newer records win
+                    for book_id, location in enumerate(MANIFEST_RECORD.iter_unpack(manifest)):
+                        if location[2]:
+                            MANIFEST_RECORD.pack_into(index, book_id * MANIFEST_RECORD.size, *location)
+                self._indexes[day] = index
+        return self._indexes[day]
+
+    def read(self, book_id: int, day: Optional[str] = None) -> Optional[bytes]:
+        """Return the snapshot of a book on a day, or its latest one"""
+        index = self._index(day)
+        start = book_id * MANIFEST_RECORD.size
+        if (index is None) or (start + MANIFEST_RECORD.size > len(index)):
+            return None
+        location = MANIFEST_RECORD.unpack_from(index, start)
+        return self._read_blob(location) if location[2] else None
+
+    def _read_blob(self, location: BlobLocation) -> bytes:
+        number, offset, length = location
+        with open(self.segment_folder / f"{number:08d}.seg", "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        compression = next(c for c, code in COMPRESSION_CODES.items() if code == data[0])
+        return decompress(data[1:], compression)
+
+    def book_ids(self, day: Optional[str] = None) -> list[int]:
+        """Books with a snapshot on a day, or on any day"""
+        index = self._index(day)
+        if index is None:
+            return []
+        return [
+            book_id for book_id, (_, _, length) in enumerate(MANIFEST_RECORD.iter_unpack(index))
+            if length
+        ]
+
+    def iter_snapshots(self, day: Optional[str] = None) -> Iterator[tuple[int, bytes]]:
+        """Yield the id and latest snapshot of every book with a snapshot on a day, or on any day"""
+        for book_id in self.book_ids(day):
+            yield book_id, self.read(book_id, day)
+
+    def close_readers(self):
+        self._indexes = {}
+        for manifest in self._maps.values():
+            if manifest is not None:
+                manifest.close()
+        self._maps = {}
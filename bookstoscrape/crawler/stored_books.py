@@ -0,0 +1,68 @@
+import sys
+from pymongo.asynchronous.collection import AsyncCollection
+from typing import Iterable, Optional
+
+from ..settings import CHANGE_DETECTION_FIELDS, STORED_BOOKS_LOOKUP_BATCH_SIZE
+
+
+# Book fields tracked in the changelog, e.g. price and rating
+BOOK_FIELDS = tuple(
+    field for field in CHANGE_DETECTION_FIELDS
+    if (field not in ("_id", "bts_id")) and (not field.startswith("crawl_metadata."))
+)
+
+class StoredBook:
+    """Change detection fields of a stored book, without the overhead of a dict per book"""
+    __slots__ = ("etag", "digest", "status") + BOOK_FIELDS
+
+    def __init__(self, doc: dict):
+        crawl_metadata = doc.get("crawl_metadata", {})
+        self.etag = crawl_metadata.get("etag")
+        self.digest = crawl_metadata.get("digest")
+        self.status = crawl_metadata.get("status")
+        for field in BOOK_FIELDS:
+            value = doc.get(field)
+            # Categories repeat across books, so each one is kept once
+            setattr(self, field, sys.intern(value) if isinstance(value, str) else value)
+
+class StoredBooks:
+    """
+    The stored books that a scheduler run is working on, keyed by bts_id.
+
+    Books are looked up with `$in` queries of up to `batch_size` ids, usually
+    for all the books of a listing page at once, and discarded once their
+    session is done. Memory depends on the books in flight rather than on the
+    size of the catalog, and fetching starts without a scan of the collection.
+    """
+    def __init__(self, collection: AsyncCollection, batch_size: int = STORED_BOOKS_LOOKUP_BATCH_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+        self._books: dict[int, Optional[StoredBook]] = {}  # None for books that aren't stored
+        self.stats = {"lookups": 0, "loaded": 0, "highest": 0}
+
+    def get(self, book_id: int) -> Optional[StoredBook]:
+        """Return a book that was loaded, or None if it isn't stored"""
+        return self._books.get(book_id)
+
+    async def load(self, book_ids: Iterable[int]):
+        """Look up the books that weren't loaded yet"""
+        missing = [book_id for book_id in dict.fromkeys(book_ids) if book_id not in self._books]
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start+self.batch_size]
+            self.stats["lookups"] += 1
+            async for doc in self.collection.find({"bts_id": {"$in": batch}}, CHANGE_DETECTION_FIELDS):
+                self._books[doc["bts_id"]] = StoredBook(doc)
+                self.stats["loaded"] += 1
+            for book_id in batch:
+                self._books.setdefault(book_id, None)
+        self.stats["highest"] = max(self.stats["highest"], len(self._books))
+
+    async def lookup(self, book_id: int) -> Optional[StoredBook]:
+        await self.load((book_id,))
+        return self.get(book_id)
+
+    def discard(self, book_id: int):
+        self._books.pop(book_id, None)
+
+    def __len__(self) -> int:
+        return len(self._books)
@@ -1,35 +1,47 @@
-import asyncio
 import json
-from dataclasses import asdict
 from typing import Literal
 
 from .. import settings as ss
+from ..crawler.main import get_changelog_indexes
 from ..crawler.manager import Manager, Session
-from ..utils.common import setup_logger, cleanup_logger
+from ..crawler.parallel import (
+    merge_daily_change_reports, merge_run_stats, run_shards,
+)
+from ..utils.common import setup_logger, cleanup_logger, get_log_file
 
 
 async def bts_scheduler(
-    env: Literal["dev", "prod"] = "dev"
+    env: Literal["dev", "prod"] = "dev",
+    processes: int = ss.SCHEDULER_PROCESS_COUNT
 ):
-    """BooksToScrape Scheduler Job"""
+    """
+    BooksToScrape Scheduler Job
+
+    With more than one process, this process crawls the listing pages and
+    the book sessions are sharded across worker processes.
+    """
     logger = setup_logger("scheduler")
-    manager = Manager(env, logger, is_scheduler=True)
+    if (ss.FRONTIER_BACKEND == "mongo") and (processes > 1):
+        logger.warning("[manager] Worker processes are not used with the mongo frontier. Run more scheduler processes instead")
+        processes = 1
+    manager = Manager(env, logger, is_scheduler=True, listing_only=processes > 1)
 
     manager.logger.info(f"[manager] BEGIN RUN")
-    manager.logger.info(f"[manager] Run parameters: env={env}")
+    manager.logger.info(f"[manager] Run parameters: env={env}, processes={processes}, frontier={ss.FRONTIER_BACKEND}")
+
+    if ss.FRONTIER_BACKEND == "mongo":
+        # Other scheduler processes may already be working on today's run.
+        # Only sessions from previous days are removed.
+        await manager.frontier_collection.delete_many(
+            {"run_id": {"$regex": "^scheduler-", "$lt": manager.frontier.run_id}}
+        )
+        await manager.frontier.setup()
     
-    # Retrieve stored books from collection
-    async for book in manager.book_collection.find({}, ss.CHANGE_DETECTION_FIELDS):
-        manager.stored_books[book["bts_id"]] = book
+    await manager.page_cache_collection.create_index("page_url", unique=True)
+    await manager.changelog_collection.create_indexes(get_changelog_indexes())
 
-    # Initialize daily report
     reports_path = ss.BASE_FOLDER / "reports"
     reports_path.mkdir(exist_ok=True)
-    manager.daily_change_report = {
-        "report_date": manager.current_date,
-        "summary": {"added": 0, "updated": 0, "total": 0},
-        "changelog": []
-    }
 
     first_page_session = Session(
         sid="p1",
@@ -37,19 +49,33 @@ async def bts_scheduler(
         resource_type="page",
         resource_url=f"{ss.BASE_URL}/page-1.html"
     )
-    await manager.queue.put(first_page_session)
-    manager.crawler_state[first_page_session.sid] = asdict(first_page_session)
+    await manager.push_session(first_page_session)
+
+    await manager.run()
 
-    for i in range(ss.WORKER_COUNT):
-        task = asyncio.create_task(manager.worker(f"w{i+1}"))
-        manager.workers.append(task)
+    if processes > 1:
+        manager.logger.info(f"[manager] Sharding {len(manager.discovered_books)} book sessions across {processes} processes")
+        results = await run_shards(
+            "scheduler", env, list(manager.discovered_books.values()), processes,
+            log_file=get_log_file(manager.logger)
+        )
+        manager.run_stats = merge_run_stats([manager.run_stats] + [r["run_stats"] for r in results])
+        manager.daily_change_report = merge_daily_change_reports(
+            [manager.daily_change_report] + [r["daily_change_report"] for r in results]
+        )
 
-    await asyncio.gather(*manager.workers, return_exceptions=True)
+    manager.logger.info(f"[manager] Run stats: {manager.run_stats}")
+    await manager.bump_catalog_version()
 
-    # Store daily report
-    with open(reports_path / f"{manager.current_date.replace("-", "")}.json", "w") as f:
+    # Store daily report. With the mongo frontier, each process reports the changes it made.
+    report_name = manager.current_date.replace("-", "")
+    if ss.FRONTIER_BACKEND == "mongo":
+        report_name += f"_{manager.frontier.node_id}"
+    with open(reports_path / f"{report_name}.json", "w") as f:
         json.dump(manager.daily_change_report, f)
 
+    await manager.close_http_client()
+    await manager.close_parse_pool()
     await manager.close_db_client()
     cleanup_logger("scheduler")
 
@@ -13,9 +13,12 @@ MONGODB_DB = os.getenv("MONGODB_DB", "bookstoscrape")
 MONGODB_BOOK_COLLECTION = os.getenv("MONGODB_BOOK_COLLECTION", "books")
 MONGODB_CHANGELOG_COLLECTION = os.getenv("MONGODB_CHANGELOG_COLLECTION", "changelog")
 MONGODB_CRAWLER_STATE_COLLECTION = os.getenv("MONGODB_CRAWLER_STATE_COLLECTION", "crawler_state")
+MONGODB_FRONTIER_COLLECTION = os.getenv("MONGODB_FRONTIER_COLLECTION", "frontier")
+MONGODB_PAGE_CACHE_COLLECTION = os.getenv("MONGODB_PAGE_CACHE_COLLECTION", "page_cache")
 MONGODB_SCHEDULED_JOBS_COLLECTION = os.getenv("MONGODB_SCHEDULED_JOBS_COLLECTION", "scheduled_jobs")
 MONGODB_USERS_COLLECTION = os.getenv("MONGODB_USERS_COLLECTION", "users")
 MONGODB_API_KEYS_COLLECTION = os.getenv("MONGODB_API_KEYS_COLLECTION", "api_keys")
+MONGODB_META_COLLECTION = os.getenv("MONGODB_META_COLLECTION", "meta")
 
 # email
 EMAIL_SENDER = os.getenv("EMAIL_SENDER")
@@ -28,10 +31,52 @@ ADMIN_EMAIL = os.getenv("ADMIN_EMAIL")
 BASE_URL = "https://books.toscrape.com/catalogue"
 PROXY = None
 REQUEST_TIMEOUT_SECONDS = 5
-QUEUE_WAIT_TIMEOUT_SECONDS = 5
-WORKER_COUNT = 5
+HTTP_MAX_CONNECTIONS = 20  # BooksToScrape is a single host, so this is also the per-host limit
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+HTTP_KEEPALIVE_EXPIRY_SECONDS = 30
+HTTP2_ENABLED = False  # Multiplex requests over a single connection if the origin supports it
+PARSER_BACKEND = "lxml"  # "beautifulsoup", "lxml" or "selectolax"
+PARSE_POOL_SIZE = 2  # Worker processes that parse pages. With 0, pages are parsed in a thread of the crawler process
+PARSE_BATCH_SIZE = 4  # Pages sent to a parse worker at once
+PARSE_BATCH_DELAY_SECONDS = 0.005  # How long a batch waits to fill up before it is sent
+PIPELINE_STAGES = {  # Tasks and bounded queue size of each stage after the fetchers
+    "parse": {"concurrency": 8, "queue_size": 40},
+    "snapshot": {"concurrency": 2, "queue_size": 100},
+    "storage": {"concurrency": 100, "queue_size": 100},  # Enough to fill bulk write batches
+    "notifier": {"concurrency": 1, "queue_size": 500},
+}
+SNAPSHOT_COMPRESSION = "zstd"  # "zstd", "gzip" or None to store HTML snapshots uncompressed
+SNAPSHOT_SEGMENT_MAX_BYTES = 64 * 1024 * 1024  # Size after which snapshots are appended to a new segment file
+BULK_WRITE_BATCH_SIZE = 50  # Books and changelog entries sent to MongoDB in one bulk write
+BULK_WRITE_FLUSH_INTERVAL_SECONDS = 0.5  # How long a write waits for its batch to fill up
+BULK_WRITE_MAX_RETRIES = 3
+REPLAY_BATCH_SIZE = 200  # Snapshots parsed by a replay worker at once
+CHECKPOINT_INTERVAL_SECONDS = 10  # How often the crawler state is written during a run
+CHECKPOINT_MAX_CHANGES = 500  # Crawler state changes that are written without waiting for the interval
+CHECKPOINT_LOAD_BATCH_SIZE = 500  # Sessions read back from the crawler state at a time on --no-restart
+CHECKPOINT_LOAD_QUEUE_SIZE = 1000  # Queued sessions above which --no-restart waits before reading more
+STAGE_REPORT_INTERVAL_SECONDS = 30  # How often the queue depth and throughput of every stage is logged
+QUEUE_POLL_INTERVAL_SECONDS = 1  # How often idle workers check whether the run is over
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 20
+INITIAL_CONCURRENCY = 5
+TARGET_LATENCY_SECONDS = 1.0  # Slower responses are treated as a sign of congestion
+CONCURRENCY_DECREASE_FACTOR = 0.5
 MAX_RETRY_COUNT= 3
+RETRY_BASE_DELAY_SECONDS = 1  # Doubled on every retry
+RETRY_MAX_DELAY_SECONDS = 60
+RETRY_AFTER_MAX_SECONDS = 300  # Upper bound on how long a Retry-After header can delay a session
 MAX_CONSECUTIVE_FAILURES = 5
+FRONTIER_PRIORITY_WEIGHTS = {  # Relative share of turns each class gets when several are queued
+    "page": 8,
+    "new_book": 4,
+    "changed_book": 4,
+    "unchanged_book": 2,
+    "retry": 1,
+}
+FRONTIER_BACKEND = "memory"  # "mongo" lets several crawler or scheduler processes share one frontier
+FRONTIER_LEASE_SECONDS = 60  # How long a claimed session is reserved for a node without renewal
+FRONTIER_POLL_INTERVAL_SECONDS = 1
 BROWSER_HEADERS = {
     "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7",
     "accept-encoding": "gzip, deflate, br, zstd",
@@ -60,12 +105,25 @@ CHANGE_DETECTION_FIELDS = {
     "stock_count": 1,
     "review_count": 1,
     "rating": 1,
+    "category": 1,
+    "crawl_metadata.status": 1,
     "crawl_metadata.etag": 1,
+    "crawl_metadata.digest": 1,
 }
+STORED_BOOKS_LOOKUP_BATCH_SIZE = 1000  # Stored books looked up with one $in query
+LISTING_CHANGE_DETECTION = True  # Only fetch book pages that are new or whose listing changed
+FULL_CHECK_INTERVAL_DAYS = 30  # Every book page is still fetched once in this many days
 MISFIRE_GRACE_TIME = 5 * 60 * 60  # 5 hours
+SCHEDULER_PROCESS_COUNT = 1  # Worker processes used by each scheduler run
 
 # api
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 AUTH_RATE_LIMIT = "5/minute"
 API_RATE_LIMIT = "100/minute"
+API_KEY_CACHE_SIZE = 10000  # Verified API keys kept in memory by each API worker
+API_KEY_CACHE_TTL_SECONDS = 5 * 60  # A valid key is looked up again after this long
+API_KEY_CACHE_NEGATIVE_TTL_SECONDS = 30  # An invalid key is looked up again after this long
+BOOKS_QUERY_CACHE_SIZE = 1000  # /books responses kept in memory by each API worker
+API_KEY_REVOCATION_HISTORY = 100  # Replaced key hashes kept in the meta collection. A worker that missed more clears its whole key cache.
+META_VERSION_POLL_INTERVAL_SECONDS = 1  # Without change streams, new crawls are served by every API worker within this long
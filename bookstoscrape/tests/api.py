@@ -0,0 +1,228 @@
+import asyncio
+import base64
+import json
+import time
+import unittest
+from bson import ObjectId
+from datetime import datetime
+from fastapi import HTTPException
+from unittest.mock import patch
+
+from ..api.routers.book import stream_changes
+from ..settings import MONGODB_META_COLLECTION
+from ..utils.api import (
+    ApiKeyCache, QueryCache, build_keyset_filter, encode_cursor,
+    refresh_versions, watch_versions,
+)
+
+
+def build_cursor(position: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+class TestPagination(unittest.TestCase):
+
+    def test__build_keyset_filter_1(self):
+        sort = [("price", -1), ("bts_id", -1)]
+        cursor = encode_cursor(sort, {"bts_id": 7, "price": 12.5, "name": "A Light in the Attic"})
+        self.assertEqual(build_keyset_filter(sort, cursor), {"$or": [
+            {"price": {"$lt": 12.5}},
+            {"price": 12.5, "bts_id": {"$lt": 7}},
+        ]})
+
+    def test__build_keyset_filter_2(self):
+        sort = [("timestamp", 1), ("bts_id", 1)]
+        timestamp = datetime(2025, 12, 3, 10, 30)
+        cursor = encode_cursor(sort, {"bts_id": 7, "timestamp": timestamp})
+        self.assertEqual(build_keyset_filter(sort, cursor), {"$or": [
+            {"timestamp": {"$gt": timestamp}},
+            {"timestamp": timestamp, "bts_id": {"$gt": 7}},
+        ]})
+
+    def test__build_keyset_filter_3(self):
+        cursor = encode_cursor([("rating", 1), ("bts_id", 1)], {"bts_id": 7, "rating": 3})
+        for sort, cursor in [
+            ([("rating", -1), ("bts_id", -1)], cursor),  # Another sort
+            ([("rating", 1), ("bts_id", 1)], "not-a-cursor"),
+            ([("rating", 1), ("bts_id", 1)], build_cursor({"sort": [["rating", 1], ["bts_id", 1]], "after": [3]})),
+            ([("price", 1), ("bts_id", 1)], build_cursor({"sort": [["price", 1], ["bts_id", 1]], "after": [{"$where": "sleep(1000)"}, 7]})),
+        ]:
+            with self.assertRaises(HTTPException) as ctx:
+                build_keyset_filter(sort, cursor)
+            self.assertEqual(ctx.exception.status_code, 400)
+
+class FakeChangelogCursor:
+    """Async cursor over changelog documents"""
+    def __init__(self, docs: list[dict]):
+        self.docs = docs
+        self.closed = False
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+    async def close(self):
+        self.closed = True
+
+class TestStreamChanges(unittest.IsolatedAsyncioTestCase):
+
+    async def test__stream_changes_1(self):
+        changelog = FakeChangelogCursor([
+            {"bts_id": 2, "event": "update", "timestamp": datetime(2025, 12, 3, 10, 30), "changes": {"price": {"old": 10.0, "new": 12.5}}},
+            {"bts_id": 1, "event": "add", "timestamp": datetime(2025, 12, 2, 9, 0), "changes": {}},
+        ])
+        lines = [line async for line in stream_changes(changelog)]
+        self.assertTrue(all(line.endswith("\n") for line in lines))
+        self.assertEqual([json.loads(line) for line in lines], [
+            {"bts_id": 2, "event": "update", "timestamp": "2025-12-03 10:30:00", "changes": {"price": {"old": 10.0, "new": 12.5}}},
+            {"bts_id": 1, "event": "add", "timestamp": "2025-12-02 09:00:00", "changes": {}},
+        ])
+        self.assertTrue(changelog.closed)
+
+class FakeChangeStream:
+    """Change stream that reports the given changes, then closes"""
+    def __init__(self, changes: list[dict]):
+        self.changes = changes
+        self.alive = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.alive = False
+
+    async def try_next(self):
+        await asyncio.sleep(0)
+        if not self.changes:
+            self.alive = False
+            return None
+        return self.changes.pop(0)
+
+class FakeMetaCollection:
+    """Meta collection with settable documents"""
+    def __init__(self, changes: list[dict] = ()):
+        self.docs = {}
+        self.changes = list(changes)
+
+    async def find(self, query: dict):
+        for meta_id in query["_id"]["$in"]:
+            if meta_id in self.docs:
+                yield self.docs[meta_id]
+
+    async def watch(self, pipeline: list, full_document: str):
+        return FakeChangeStream(self.changes)
+
+    def set(self, meta_id: str, version: int, revoked: list[str] = ()):
+        self.docs[meta_id] = {"_id": meta_id, "version": version, "revoked": list(revoked)}
+
+class TestApiKeyCache(unittest.IsolatedAsyncioTestCase):
+
+    def test__get_1(self):
+        cache = ApiKeyCache(max_size=2, ttl=60, negative_ttl=10)
+        user_id = ObjectId()
+        cache.set("a", user_id, cache.generation)
+        cache.set("b", None, cache.generation)  # Invalid key
+        self.assertEqual(cache.get("a"), (True, user_id))
+        cache.set("c", user_id, cache.generation)  # "b" is the least recently used
+        self.assertEqual(cache.get("b"), (False, None))
+        self.assertEqual(cache.get("c"), (True, user_id))
+
+    def test__get_2(self):
+        cache = ApiKeyCache(ttl=60, negative_ttl=10)
+        cache.set("a", ObjectId(), cache.generation)
+        cache.set("b", None, cache.generation)
+        later = time.monotonic() + 30
+        with patch("bookstoscrape.utils.api.time.monotonic", return_value=later):
+            self.assertTrue(cache.get("a")[0])
+            self.assertFalse(cache.get("b")[0])
+
+    async def test__refresh_versions_1(self):
+        cache = ApiKeyCache()
+        meta_collection = FakeMetaCollection()
+        db = {MONGODB_META_COLLECTION: meta_collection}
+        await refresh_versions(db, [cache])
+        generation = cache.generation  # A lookup starts
+        cache.set("a", ObjectId(), cache.generation)
+
+        meta_collection.set("api_keys", 1)  # Keys are replaced by another worker, none recorded
+        await refresh_versions(db, [cache])
+        self.assertEqual(cache.get("a"), (False, None))
+        cache.set("a", ObjectId(), generation)  # The lookup read the old key
+        self.assertEqual(cache.get("a"), (False, None))
+
+    async def test__refresh_versions_2(self):
+        cache = ApiKeyCache()
+        meta_collection = FakeMetaCollection()
+        db = {MONGODB_META_COLLECTION: meta_collection}
+        await refresh_versions(db, [cache])
+        user_id = ObjectId()
+        cache.set("a", user_id, cache.generation)
+        cache.set("b", user_id, cache.generation)
+
+        meta_collection.set("api_keys", 1, ["a"])  # Only the replaced key is dropped
+        await refresh_versions(db, [cache])
+        self.assertEqual((cache.get("a"), cache.get("b")), ((False, None), (True, user_id)))
+
+        meta_collection.set("api_keys", 3, ["c"])  # More keys were replaced than recorded
+        await refresh_versions(db, [cache])
+        self.assertEqual(cache.get("b"), (False, None))
+
+    async def test__watch_versions_1(self):
+        cache = ApiKeyCache()
+        user_id = ObjectId()
+        meta_collection = FakeMetaCollection([
+            {"documentKey": {"_id": "api_keys"}, "fullDocument": {"_id": "api_keys", "version": 1, "revoked": ["a"]}},
+        ])
+        watcher = asyncio.create_task(watch_versions({MONGODB_META_COLLECTION: meta_collection}, [cache], interval=60))
+        await asyncio.sleep(0)
+        cache.set("a", user_id, cache.generation)
+        cache.set("b", user_id, cache.generation)
+        while cache.version != 1:
+            await asyncio.sleep(0)
+        watcher.cancel()
+        self.assertEqual((cache.get("a"), cache.get("b")), ((False, None), (True, user_id)))
+
+class TestQueryCache(unittest.IsolatedAsyncioTestCase):
+
+    async def test__get_1(self):
+        cache = QueryCache(max_size=2)
+        loads = []
+
+        async def load(query: str) -> dict:
+            loads.append(query)
+            await asyncio.sleep(0.01)
+            return {"books": [query]}
+
+        # Concurrent misses of the same query share one load
+        results = await asyncio.gather(*[cache.get("a", lambda: load("a")) for _ in range(5)])
+        self.assertEqual(results, [{"books": ["a"]}] * 5)
+        self.assertEqual(loads, ["a"])
+        self.assertEqual(cache.stats, {"hits": 0, "misses": 1, "coalesced": 4})
+
+        await cache.get("b", lambda: load("b"))
+        await cache.get("a", lambda: load("a"))  # "b" is now the least recently used
+        await cache.get("c", lambda: load("c"))
+        await cache.get("b", lambda: load("b"))
+        self.assertEqual(loads, ["a", "b", "c", "b"])
+
+    async def test__get_2(self):
+        cache = QueryCache()
+
+        async def load():
+            raise ValueError("query failed")
+
+        for _ in range(2):  # Failures aren't cached
+            with self.assertRaises(ValueError):
+                await cache.get("a", load)
+        self.assertEqual(cache.stats["misses"], 2)
+
+    async def test__refresh_versions_1(self):
+        cache = QueryCache()
+        meta_collection = FakeMetaCollection()
+        db = {MONGODB_META_COLLECTION: meta_collection}
+        await refresh_versions(db, [cache])
+        await cache.get("a", lambda: asyncio.sleep(0))
+
+        meta_collection.set("catalog", 1)  # The scheduler wrote new books
+        await refresh_versions(db, [cache])
+        await cache.get("a", lambda: asyncio.sleep(0))
+        self.assertEqual(cache.stats["misses"], 2)
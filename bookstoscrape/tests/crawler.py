@@ -2,9 +2,15 @@ from bs4 import BeautifulSoup
 import unittest
 
 from ..crawler import process
-from ..settings import BASE_FOLDER
-from ..utils.common import Book
-from ..utils.crawler import extract_id_from_book_url
+from ..crawler.exceptions import ProcessingError
+from ..settings import (
+    BASE_FOLDER, RETRY_AFTER_MAX_SECONDS, RETRY_BASE_DELAY_SECONDS,
+    RETRY_MAX_DELAY_SECONDS,
+)
+from ..utils.common import Book, BookListing
+from ..utils.crawler import (
+    compute_retry_delay, extract_id_from_book_url, parse_retry_after,
+)
 
 
 class TestProcess(unittest.TestCase):
@@ -77,19 +83,55 @@ class TestProcess(unittest.TestCase):
     book1_article_tag = book1_soup.find("article", class_="product_page")
     book2_article_tag = book2_soup.find("article", class_="product_page")
     book4_article_tag = book4_soup.find("article", class_="product_page")
+    book1_info = process.extract_info_table(book1_article_tag.table)
+    book2_info = process.extract_info_table(book2_article_tag.table)
 
     def test__process_page_1(self):
-        self.assertEqual(
-            process.process_page(self.page1, "https://books.toscrape.com/"),
-            (1000, self.page1_urls)
-        )
+        for backend in process.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                book_count, listings = process.process_page(self.page1, "https://books.toscrape.com/", backend)
+                self.assertEqual(
+                    (book_count, [listing.url for listing in listings]),
+                    (1000, self.page1_urls)
+                )
 
     def test__process_page_2(self):
-        self.assertEqual(
-            process.process_page(self.page2, "https://books.toscrape.com/catalogue/page-4.html"),
-            (1000, self.page2_urls)
+        for backend in process.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                book_count, listings = process.process_page(self.page2, "https://books.toscrape.com/catalogue/page-4.html", backend)
+                self.assertEqual(
+                    (book_count, [listing.url for listing in listings]),
+                    (1000, self.page2_urls)
+                )
+
+    def test__process_page_3(self):
+        _, expected = process.process_page(self.page1, "https://books.toscrape.com/", "beautifulsoup")
+        for backend in process.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                _, listings = process.process_page(self.page1, "https://books.toscrape.com/", backend)
+                self.assertEqual(listings, expected)
+
+    def test__get_parser_1(self):
+        with self.assertRaises(ValueError):
+            process.get_parser("html5lib")
+
+    def test__extract_book_listings_1(self):
+        listings = process.extract_book_listings(self.page1_soup, "https://books.toscrape.com/")
+        self.assertEqual(
+            listings[0],
+            BookListing(
+                url="https://books.toscrape.com/catalogue/a-light-in-the-attic_1000/index.html",
+                price=51.77,
+                rating=3,
+                in_stock=True
+            )
         )
 
+    def test__extract_book_listings_2(self):
+        listings = process.extract_book_listings(self.page2_soup, "https://books.toscrape.com/catalogue/page-4.html")
+        self.assertEqual(len(listings), 20)
+        self.assertEqual([listing.url for listing in listings], self.page2_urls)
+
     def test__extract_total_book_count_1(self):
         self.assertEqual(
             process.extract_total_book_count(self.page1_soup),
@@ -102,97 +144,110 @@ class TestProcess(unittest.TestCase):
             1000
         )
 
-    def test__extract_book_urls_1(self):
-        self.assertEqual(
-            process.extract_book_urls(self.page1_soup, "https://books.toscrape.com/"),
-            self.page1_urls
-        )
-
-    def test__extract_book_urls_2(self):
-        self.assertEqual(
-            process.extract_book_urls(self.page2_soup, "https://books.toscrape.com/catalogue/page-4.html"),
-            self.page2_urls
-        )
-
     def test__process_book_1(self):
-        self.assertEqual(
-            process.process_book(self.book1, 1000, "https://books.toscrape.com/catalogue/a-light-in-the-attic_1000/index.html"),
-            Book(
-                bts_id=1000,
-                name="A Light in the Attic",
-                description="It's hard to imagine a world without A Light in the Attic. This now-classic collection of poetry and drawings from Shel Silverstein celebrates its 20th anniversary with this special edition. Silverstein's humorous and creative verse can amuse the dowdiest of readers. Lemon-faced adults and fidgety kids sit still and read these rhythmic words and laugh and smile and love th It's hard to imagine a world without A Light in the Attic. This now-classic collection of poetry and drawings from Shel Silverstein celebrates its 20th anniversary with this special edition. Silverstein's humorous and creative verse can amuse the dowdiest of readers. Lemon-faced adults and fidgety kids sit still and read these rhythmic words and laugh and smile and love that Silverstein. Need proof of his genius? RockabyeRockabye baby, in the treetopDon't you know a treetopIs no safe place to rock?And who put you up there,And your cradle, too?Baby, I think someone down here'sGot it in for you. Shel, you never sounded so good. ...more",
-                url="https://books.toscrape.com/catalogue/a-light-in-the-attic_1000/index.html",
-                category="Poetry",
-                upc="a897fe39b1053632",
-                price=51.77,
-                tax=0.0,
-                in_stock=True,
-                stock_count=22,
-                review_count=0,
-                cover_image_url="https://books.toscrape.com/media/cache/fe/72/fe72f0532301ec28892ae79a629a293c.jpg",
-                rating=3
-            )
-        )
+        for backend in process.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                self.assertEqual(
+                    process.process_book(self.book1, 1000, "https://books.toscrape.com/catalogue/a-light-in-the-attic_1000/index.html", backend),
+                    Book(
+                        bts_id=1000,
+                        name="A Light in the Attic",
+                        description="It's hard to imagine a world without A Light in the Attic. This now-classic collection of poetry and drawings from Shel Silverstein celebrates its 20th anniversary with this special edition. Silverstein's humorous and creative verse can amuse the dowdiest of readers. Lemon-faced adults and fidgety kids sit still and read these rhythmic words and laugh and smile and love th It's hard to imagine a world without A Light in the Attic. This now-classic collection of poetry and drawings from Shel Silverstein celebrates its 20th anniversary with this special edition. Silverstein's humorous and creative verse can amuse the dowdiest of readers. Lemon-faced adults and fidgety kids sit still and read these rhythmic words and laugh and smile and love that Silverstein. Need proof of his genius? RockabyeRockabye baby, in the treetopDon't you know a treetopIs no safe place to rock?And who put you up there,And your cradle, too?Baby, I think someone down here'sGot it in for you. Shel, you never sounded so good. ...more",
+                        url="https://books.toscrape.com/catalogue/a-light-in-the-attic_1000/index.html",
+                        category="Poetry",
+                        upc="a897fe39b1053632",
+                        price=51.77,
+                        tax=0.0,
+                        in_stock=True,
+                        stock_count=22,
+                        review_count=0,
+                        cover_image_url="https://books.toscrape.com/media/cache/fe/72/fe72f0532301ec28892ae79a629a293c.jpg",
+                        rating=3
+                    )
+                )
     
     def test__process_book_2(self):
-        self.assertEqual(
-            process.process_book(self.book2, 662, "https://books.toscrape.com/catalogue/angels-walking-angels-walking-1_662/index.html"),
-            Book(
-                bts_id=662,
-                name="Angels Walking (Angels Walking #1)",
-                description="When former national baseball star Tyler Ames suffers a career-ending injury, all he can think about is putting his life back together the way it was before. He has lost everyone he loves on his way to the big leagues. Then just when things seem to be turning around, Tyler hits rock bottom. Across the country, Tyler’s one true love Sami Dawson has moved on. A series of sma When former national baseball star Tyler Ames suffers a career-ending injury, all he can think about is putting his life back together the way it was before. He has lost everyone he loves on his way to the big leagues. Then just when things seem to be turning around, Tyler hits rock bottom. Across the country, Tyler’s one true love Sami Dawson has moved on. A series of small miracles leads Tyler to a maintenance job at a retirement home and a friendship with Virginia Hutcheson, an old woman with Alzheimer’s who strangely might have the answers he so desperately seeks.A team of Angels Walking take on the mission to restore hope for Tyler, Sami, and Virginia. Can such small and seemingly insignificant actions of the unseen bring healing and redemption? And can the words of a stranger rekindle lost love? Every journey begins with a step.It is time for the mission to begin… ...more",
-                url="https://books.toscrape.com/catalogue/angels-walking-angels-walking-1_662/index.html",
-                category="Add a comment",
-                upc="1fbb5f786e53a0ce",
-                price=34.20,
-                tax=0.0,
-                in_stock=True,
-                stock_count=14,
-                review_count=0,
-                cover_image_url="https://books.toscrape.com/media/cache/ba/d9/bad95369105e8e403bf1f2b9288c5e41.jpg",
-                rating=2
-            )
-        )
+        for backend in process.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                self.assertEqual(
+                    process.process_book(self.book2, 662, "https://books.toscrape.com/catalogue/angels-walking-angels-walking-1_662/index.html", backend),
+                    Book(
+                        bts_id=662,
+                        name="Angels Walking (Angels Walking #1)",
+                        description="When former national baseball star Tyler Ames suffers a career-ending injury, all he can think about is putting his life back together the way it was before. He has lost everyone he loves on his way to the big leagues. Then just when things seem to be turning around, Tyler hits rock bottom. Across the country, Tyler’s one true love Sami Dawson has moved on. A series of sma When former national baseball star Tyler Ames suffers a career-ending injury, all he can think about is putting his life back together the way it was before. He has lost everyone he loves on his way to the big leagues. Then just when things seem to be turning around, Tyler hits rock bottom. Across the country, Tyler’s one true love Sami Dawson has moved on. A series of small miracles leads Tyler to a maintenance job at a retirement home and a friendship with Virginia Hutcheson, an old woman with Alzheimer’s who strangely might have the answers he so desperately seeks.A team of Angels Walking take on the mission to restore hope for Tyler, Sami, and Virginia. Can such small and seemingly insignificant actions of the unseen bring healing and redemption? And can the words of a stranger rekindle lost love? Every journey begins with a step.It is time for the mission to begin… ...more",
+                        url="https://books.toscrape.com/catalogue/angels-walking-angels-walking-1_662/index.html",
+                        category="Add a comment",
+                        upc="1fbb5f786e53a0ce",
+                        price=34.20,
+                        tax=0.0,
+                        in_stock=True,
+                        stock_count=14,
+                        review_count=0,
+                        cover_image_url="https://books.toscrape.com/media/cache/ba/d9/bad95369105e8e403bf1f2b9288c5e41.jpg",
+                        rating=2
+                    )
+                )
     
     def test__process_book_3(self):
-        self.assertEqual(
-            process.process_book(self.book3, 639, "https://books.toscrape.com/catalogue/the-lonely-city-adventures-in-the-art-of-being-alone_639/index.html"),
-            Book(
-                bts_id=639,
-                name="The Lonely City: Adventures in the Art of Being Alone",
-                description="An expertly crafted work of reportage, memoir and biography on the subject of loneliness told through the lives of iconic artists, by the acclaimed author of The Trip to Echo Spring What does it mean to be lonely? How do we live, if we're not intimately engaged with another human being? How do we connect with other people? Does technology draw us closer together or trap us An expertly crafted work of reportage, memoir and biography on the subject of loneliness told through the lives of iconic artists, by the acclaimed author of The Trip to Echo Spring What does it mean to be lonely? How do we live, if we're not intimately engaged with another human being? How do we connect with other people? Does technology draw us closer together or trap us behind screens?When Olivia Laing moved to New York City in her mid-thirties, she found herself inhabiting loneliness on a daily basis. Increasingly fascinated by this most shameful of experiences, she began to explore the lonely city by way of art. Moving fluidly between works and lives - from Edward Hopper's Nighthawks to Andy Warhol's Time Capsules, from Henry Darger's hoarding to the depredations of the AIDS crisis - Laing conducts an electric, dazzling investigation into what it means to be alone, illuminating not only the causes of loneliness but also how it might be resisted and redeemed.Humane, provocative and deeply moving, The Lonely City is about the spaces between people and the things that draw them together, about sexuality, mortality and the magical possibilities of art. It's a celebration of a strange and lovely state, adrift from the larger continent of human experience, but intrinsic to the very act of being alive. ...more",
-                url="https://books.toscrape.com/catalogue/the-lonely-city-adventures-in-the-art-of-being-alone_639/index.html",
-                category="Nonfiction",
-                upc="582a21a1dbbef3cf",
-                price=33.26,
-                tax=0.0,
-                in_stock=True,
-                stock_count=12,
-                review_count=0,
-                cover_image_url="https://books.toscrape.com/media/cache/79/66/79660d2683a90670aa014cae6e02b2dc.jpg",
-                rating=2
-            )
-        )
+        for backend in process.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                self.assertEqual(
+                    process.process_book(self.book3, 639, "https://books.toscrape.com/catalogue/the-lonely-city-adventures-in-the-art-of-being-alone_639/index.html", backend),
+                    Book(
+                        bts_id=639,
+                        name="The Lonely City: Adventures in the Art of Being Alone",
+                        description="An expertly crafted work of reportage, memoir and biography on the subject of loneliness told through the lives of iconic artists, by the acclaimed author of The Trip to Echo Spring What does it mean to be lonely? How do we live, if we're not intimately engaged with another human being? How do we connect with other people? Does technology draw us closer together or trap us An expertly crafted work of reportage, memoir and biography on the subject of loneliness told through the lives of iconic artists, by the acclaimed author of The Trip to Echo Spring What does it mean to be lonely? How do we live, if we're not intimately engaged with another human being? How do we connect with other people? Does technology draw us closer together or trap us behind screens?When Olivia Laing moved to New York City in her mid-thirties, she found herself inhabiting loneliness on a daily basis. Increasingly fascinated by this most shameful of experiences, she began to explore the lonely city by way of art. Moving fluidly between works and lives - from Edward Hopper's Nighthawks to Andy Warhol's Time Capsules, from Henry Darger's hoarding to the depredations of the AIDS crisis - Laing conducts an electric, dazzling investigation into what it means to be alone, illuminating not only the causes of loneliness but also how it might be resisted and redeemed.Humane, provocative and deeply moving, The Lonely City is about the spaces between people and the things that draw them together, about sexuality, mortality and the magical possibilities of art. It's a celebration of a strange and lovely state, adrift from the larger continent of human experience, but intrinsic to the very act of being alive. ...more",
+                        url="https://books.toscrape.com/catalogue/the-lonely-city-adventures-in-the-art-of-being-alone_639/index.html",
+                        category="Nonfiction",
+                        upc="582a21a1dbbef3cf",
+                        price=33.26,
+                        tax=0.0,
+                        in_stock=True,
+                        stock_count=12,
+                        review_count=0,
+                        cover_image_url="https://books.toscrape.com/media/cache/79/66/79660d2683a90670aa014cae6e02b2dc.jpg",
+                        rating=2
+                    )
+                )
 
     def test__process_book_4(self):
-        self.assertEqual(
-            process.process_book(self.book4, 5, "https://books.toscrape.com/catalogue/alice-in-wonderland-alices-adventures-in-wonderland-1_5/index.html"),
-            Book(
-                bts_id=5,
-                name="Alice in Wonderland (Alice's Adventures in Wonderland #1)",
-                description=None,
-                url="https://books.toscrape.com/catalogue/alice-in-wonderland-alices-adventures-in-wonderland-1_5/index.html",
-                category="Classics",
-                upc="cd2a2a70dd5d176d",
-                price=55.53,
-                tax=0.0,
-                in_stock=True,
-                stock_count=1,
-                review_count=0,
-                cover_image_url="https://books.toscrape.com/media/cache/99/df/99df494c230127c3d5ff53153d1f23a3.jpg",
-                rating=1
-            )
-        )
+        for backend in process.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                self.assertEqual(
+                    process.process_book(self.book4, 5, "https://books.toscrape.com/catalogue/alice-in-wonderland-alices-adventures-in-wonderland-1_5/index.html", backend),
+                    Book(
+                        bts_id=5,
+                        name="Alice in Wonderland (Alice's Adventures in Wonderland #1)",
+                        description=None,
+                        url="https://books.toscrape.com/catalogue/alice-in-wonderland-alices-adventures-in-wonderland-1_5/index.html",
+                        category="Classics",
+                        upc="cd2a2a70dd5d176d",
+                        price=55.53,
+                        tax=0.0,
+                        in_stock=True,
+                        stock_count=1,
+                        review_count=0,
+                        cover_image_url="https://books.toscrape.com/media/cache/99/df/99df494c230127c3d5ff53153d1f23a3.jpg",
+                        rating=1
+                    )
+                )
+
+    def test__compute_product_digest_1(self):
+        content = self.book1.replace(b"\n", b"\r\n  ").replace(b"<!-- Start of product page -->", b"")
+        self.assertEqual(
+            process.compute_product_digest(content),
+            process.compute_product_digest(self.book1)
+        )
+
+    def test__compute_product_digest_2(self):
+        content = self.book1.replace(b"\xc2\xa351.77", b"\xc2\xa351.78")
+        self.assertNotEqual(
+            process.compute_product_digest(content),
+            process.compute_product_digest(self.book1)
+        )
+
+    def test__compute_product_digest_3(self):
+        self.assertIsNone(process.compute_product_digest(self.page1))
 
     def test__extract_book_name_1(self):
         self.assertEqual(
@@ -236,75 +291,93 @@ class TestProcess(unittest.TestCase):
             "Add a comment"
         )
 
-    def test__extract_td_given_th_1(self):
+    def test__extract_info_table_1(self):
         self.assertEqual(
-            process.extract_td_given_th(self.book1_article_tag.table, "Number of reviews"),
+            self.book1_info["Number of reviews"],
             "0"
         )
     
-    def test__extract_td_given_th_2(self):
+    def test__extract_info_table_2(self):
         self.assertEqual(
-            process.extract_td_given_th(self.book1_article_tag.table, "Price (incl. tax)"),
+            self.book1_info["Price (incl. tax)"],
             "£51.77"
         )
 
+    def test__processing_error_field_1(self):
+        content = self.book1.replace(b"<th>Tax</th>", b"<th>VAT</th>")
+        for backend in process.PARSER_BACKENDS:
+            with self.subTest(backend=backend):
+                with self.assertRaises(ProcessingError) as cm:
+                    process.process_book(content, 1000, "https://books.toscrape.com/catalogue/a-light-in-the-attic_1000/index.html", backend)
+                self.assertEqual((cm.exception.resource_type, cm.exception.field), ("book", "tax"))
+
+    def test__processing_error_field_2(self):
+        without_table = self.book1.replace(b"<table", b"<div").replace(b"</table>", b"</div>")
+        without_article = self.book1.replace(b'class="product_page"', b'class="product"')
+        for content, field in [(without_table, "info_table"), (without_article, "article")]:
+            for backend in process.PARSER_BACKENDS:
+                with self.subTest(backend=backend, field=field):
+                    with self.assertRaises(ProcessingError) as cm:
+                        process.process_book(content, 1000, "https://books.toscrape.com/catalogue/a-light-in-the-attic_1000/index.html", backend)
+                    self.assertEqual((cm.exception.resource_type, cm.exception.field), ("book", field))
+
     def test__extract_upc_1(self):
         self.assertEqual(
-            process.extract_upc(self.book1_article_tag.table),
+            process.extract_upc(self.book1_info),
             "a897fe39b1053632"
         )
 
     def test__extract_upc_2(self):
         self.assertEqual(
-            process.extract_upc(self.book2_article_tag.table),
+            process.extract_upc(self.book2_info),
             "1fbb5f786e53a0ce"
         )
 
     def test__extract_price_1(self):
         self.assertEqual(
-            process.extract_price(self.book1_article_tag.table),
+            process.extract_price(self.book1_info),
             51.77
         )
 
     def test__extract_price_2(self):
         self.assertEqual(
-            process.extract_price(self.book2_article_tag.table),
+            process.extract_price(self.book2_info),
             34.20
         )
 
     def test__extract_tax_1(self):
         self.assertEqual(
-            process.extract_tax(self.book1_article_tag.table),
+            process.extract_tax(self.book1_info),
             0.0
         )
 
     def test__extract_tax_2(self):
         self.assertEqual(
-            process.extract_tax(self.book2_article_tag.table),
+            process.extract_tax(self.book2_info),
             0.0
         )
 
     def test__extract_availability_1(self):
         self.assertEqual(
-            process.extract_availability(self.book1_article_tag.table),
+            process.extract_availability(self.book1_info),
             "In stock (22 available)"
         )
 
     def test__extract_availability_2(self):
         self.assertEqual(
-            process.extract_availability(self.book2_article_tag.table),
+            process.extract_availability(self.book2_info),
             "In stock (14 available)"
         )
 
     def test__extract_review_count_1(self):
         self.assertEqual(
-            process.extract_review_count(self.book1_article_tag.table),
+            process.extract_review_count(self.book1_info),
             0
         )
 
     def test__extract_review_count_2(self):
         self.assertEqual(
-            process.extract_review_count(self.book2_article_tag.table),
+            process.extract_review_count(self.book2_info),
             0
         )
 
@@ -345,3 +418,23 @@ class TestUtils(unittest.TestCase):
             extract_id_from_book_url("https://books.toscrape.com/catalogue/starving-hearts-triangular-trade-trilogy-1_990/index.html"),
             990
         )
+
+    def test__parse_retry_after_1(self):
+        self.assertEqual(parse_retry_after("120"), 120.0)
+
+    def test__parse_retry_after_2(self):
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+
+    def test__parse_retry_after_3(self):
+        self.assertIsNone(parse_retry_after("soon"))
+
+    def test__compute_retry_delay_1(self):
+        delay = compute_retry_delay(3)
+        self.assertGreaterEqual(delay, RETRY_BASE_DELAY_SECONDS * 2)
+        self.assertLessEqual(delay, RETRY_BASE_DELAY_SECONDS * 4)
+
+    def test__compute_retry_delay_2(self):
+        self.assertEqual(compute_retry_delay(1, retry_after=RETRY_MAX_DELAY_SECONDS), RETRY_MAX_DELAY_SECONDS)
+
+    def test__compute_retry_delay_3(self):
+        self.assertEqual(compute_retry_delay(1, retry_after=10**6), RETRY_AFTER_MAX_SECONDS)
@@ -0,0 +1,851 @@
+import asyncio
+import logging
+import tempfile
+import unittest
+from dataclasses import asdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional
+from unittest.mock import patch
+from httpx import (
+    AsyncClient, HTTPStatusError, MockTransport, ReadTimeout, Request, Response,
+)
+from pymongo import DeleteOne, InsertOne, ReplaceOne
+from pymongo.errors import (
+    AutoReconnect, BulkWriteError, DuplicateKeyError, OperationFailure,
+)
+
+from ..crawler.bulk_writer import BulkWriter
+from ..crawler.checkpoint import Checkpoint
+from ..crawler.exceptions import ProcessingError
+from ..crawler.fetch import fetch_page, read_page
+from ..crawler.main import (
+    get_book_indexes, get_changelog_indexes, get_rebuild_snapshot_folder,
+    swap_in_rebuild,
+)
+from ..crawler.frontier import (
+    Frontier, MongoFrontier, Priority, RetryQueue, Session,
+)
+from ..crawler.manager import ConcurrencyController, Manager
+from ..crawler.parallel import (
+    merge_daily_change_reports, merge_run_stats, shard_sessions,
+)
+from ..crawler.parse_pool import ParsePool
+from ..crawler.process import compute_product_digest, process_book
+from ..crawler.replay import STALE_SNAPSHOT, get_update_changes, replay_batch
+from ..crawler.snapshots import SnapshotStore
+from ..crawler.stored_books import StoredBooks
+from ..settings import BASE_FOLDER, MONGODB_BOOK_COLLECTION
+from ..utils.common import Book
+
+
+logger = logging.getLogger("tests")
+logger.addHandler(logging.NullHandler())
+logger.propagate = False
+
+class FakeCursor:
+    """Cursor over the documents found by a FakeCollection"""
+    def __init__(self, docs: list[dict]):
+        self.docs = docs
+
+    def sort(self, field: str, direction: int = 1):
+        self.docs = sorted(self.docs, key=lambda doc: doc[field], reverse=direction == -1)
+        return self
+
+    def limit(self, limit: int):
+        self.docs = self.docs[:limit]
+        return self
+
+    async def to_list(self):
+        return self.docs
+
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+class FakeCollection:
+    """
+    In-memory collection supporting the queries and writes of the crawler.
+    Failures can be injected: `write_errors` fails the writes of the given
+    ids once with an error code, `write_concern_error` misses the write
+    concern of the next bulk write, `failing` fails every bulk write, and
+    `insert_race` fails the next upsert as if another node inserted it first.
+    """
+    def __init__(self, docs: list[dict] = (), name: str = "books", calls: list = None):
+        self.docs: list[dict] = [dict(doc) for doc in docs]
+        self.name = name
+        self.database = SimpleNamespace(list_collection_names=self.list_collection_names)
+        self.exists = True
+        self.calls = [] if calls is None else calls  # Index builds, renames and drops
+        self.batches: list[list] = []  # Operations of every bulk write
+        self.queries: list[dict] = []  # Queries of every find
+        self.write_errors: dict = {}
+        self.write_concern_error = False
+        self.failing = False
+        self.insert_race = False
+
+    @classmethod
+    def matches(cls, doc: dict, query: dict) -> bool:
+        for field, condition in query.items():
+            if field == "$or":
+                if not any(cls.matches(doc, branch) for branch in condition):
+                    return False
+            elif isinstance(condition, dict):
+                value = doc.get(field)
+                for operator, operand in condition.items():
+                    if not {
+                        "$lt": lambda: (value is not None) and (value < operand),
+                        "$lte": lambda: (value is not None) and (value <= operand),
+                        "$gt": lambda: (value is not None) and (value > operand),
+                        "$ne": lambda: value != operand,
+                        "$in": lambda: value in operand,
+                    }[operator]():
+                        return False
+            elif doc.get(field) != condition:
+                return False
+        return True
+
+    @staticmethod
+    def project(doc: dict, projection) -> dict:
+        if isinstance(projection, dict):
+            included = {field.split(".")[0] for field, include in projection.items() if include}
+            excluded = {field for field, include in projection.items() if not include}
+        else:
+            included, excluded = {field.split(".")[0] for field in projection or ()}, set()
+        return {
+            field: value for field, value in doc.items()
+            if ((not included) or (field in included)) and (field not in excluded)
+        }
+
+    def find_docs(self, query: dict) -> list[dict]:
+        return [doc for doc in self.docs if self.matches(doc, query)]
+
+    def find(self, query: dict, projection=None) -> FakeCursor:
+        self.queries.append(query)
+        return FakeCursor([self.project(doc, projection) for doc in self.find_docs(query)])
+
+    async def find_one(self, query: dict, projection=None) -> Optional[dict]:
+        docs = self.find_docs(query)
+        return self.project(docs[0], projection) if docs else None
+
+    async def count_documents(self, query: dict, limit: int = 0) -> int:
+        return len(self.find_docs(query))
+
+    def upsert(self, query: dict, update: dict) -> dict:
+        if self.insert_race:
+            self.insert_race = False
+            raise DuplicateKeyError("duplicate key")
+        doc = {field: value for field, value in query.items() if not isinstance(value, dict)}
+        doc |= update.get("$setOnInsert", {}) | update.get("$set", {})
+        self.docs.append(doc)
+        return doc
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        docs = self.find_docs(query)
+        if docs:
+            docs[0].update(update.get("$set", {}))
+            return SimpleNamespace(upserted_id=None)
+        if not upsert:
+            return SimpleNamespace(upserted_id=None)
+        self.upsert(query, update)
+        return SimpleNamespace(upserted_id=len(self.docs))
+
+    async def update_many(self, query: dict, update: dict):
+        for doc in self.find_docs(query):
+            doc.update(update["$set"])
+
+    async def find_one_and_update(self, query: dict, update: dict, projection: dict, sort: list, return_document):
+        docs = self.find_docs(query)
+        if not docs:
+            return None
+        doc = min(docs, key=lambda doc: tuple(doc[field] for field, _ in sort))
+        doc.update(update["$set"])
+        return self.project(doc, projection)
+
+    def apply(self, operation) -> bool:
+        """Apply a write operation and return whether it inserted a document"""
+        if isinstance(operation, InsertOne):
+            self.docs.append(dict(operation._doc))
+            return True
+        docs = self.find_docs(operation._filter)
+        if isinstance(operation, DeleteOne):
+            if docs:
+                self.docs.remove(docs[0])
+            return False
+        if isinstance(operation, ReplaceOne):
+            update = {"$set": operation._doc}
+            if docs:
+                docs[0].clear()
+        else:
+            update = operation._doc
+        if docs:
+            docs[0].update(update["$set"])
+            return False
+        if operation._upsert:
+            self.upsert(operation._filter, update)
+            return True
+        return False
+
+    async def bulk_write(self, operations: list, ordered: bool = True):
+        if self.failing:
+            raise AutoReconnect("connection lost")
+        self.batches.append(operations)
+        upserted, write_errors = [], []
+        for i, operation in enumerate(operations):
+            key = operation._doc.get("_id") if isinstance(operation, InsertOne) else next(iter(operation._filter.values()))
+            if key in self.write_errors:
+                write_errors.append({"index": i, "code": self.write_errors.pop(key), "errmsg": "write failed"})
+            elif self.apply(operation):
+                upserted.append({"index": i, "_id": key})
+
+        write_concern_errors = []
+        if self.write_concern_error:
+            self.write_concern_error = False
+            write_concern_errors.append({"code": 64, "errmsg": "waiting for replication timed out"})
+        if write_errors or write_concern_errors:
+            raise BulkWriteError({"writeErrors": write_errors, "writeConcernErrors": write_concern_errors, "upserted": upserted})
+        return SimpleNamespace(upserted_ids={upsert["index"]: upsert["_id"] for upsert in upserted})
+
+    @property
+    def operations(self) -> list:
+        return [operation for batch in self.batches for operation in batch]
+
+    def batch_ids(self, field: str = "bts_id") -> list[list]:
+        return [[operation._filter[field] for operation in batch] for batch in self.batches]
+
+    async def list_collection_names(self) -> list[str]:
+        return [self.name] if self.exists else []
+
+    async def create_indexes(self, indexes: list):
+        self.calls.append(("create_indexes", len(indexes)))
+        return [str(i) for i in range(len(indexes))]
+
+    async def rename(self, new_name: str, **kwargs):
+        if not self.exists:
+            raise OperationFailure("source namespace does not exist", code=26)
+        self.calls.append(("rename", new_name, kwargs))
+        self.exists = False
+
+    async def drop(self):
+        self.calls.append(("drop",))
+        self.docs = []
+
+def build_status_error(status_code: int) -> HTTPStatusError:
+    request = Request("GET", "https://books.toscrape.com/")
+    response = Response(status_code, request=request)
+    return HTTPStatusError(str(status_code), request=request, response=response)
+
+class TestConcurrencyController(unittest.IsolatedAsyncioTestCase):
+
+    def build_controller(self, initial_limit: int = 4) -> ConcurrencyController:
+        return ConcurrencyController(
+            logger,
+            min_limit=1, max_limit=8, initial_limit=initial_limit,
+            target_latency=1.0, decrease_factor=0.5
+        )
+
+    async def raise_in_slot(self, controller: ConcurrencyController, exc: Exception):
+        with self.assertRaises(type(exc)):
+            async with controller.slot():
+                raise exc
+
+    async def test__additive_increase_1(self):
+        controller = self.build_controller()
+        for _ in range(4):
+            async with controller.slot():
+                pass
+        self.assertEqual(int(controller.limit), 4)
+        self.assertEqual(controller.stats["requests"], 4)
+
+    async def test__additive_increase_2(self):
+        controller = self.build_controller()
+        for _ in range(100):
+            async with controller.slot():
+                pass
+        self.assertEqual(controller.limit, 8)
+        self.assertEqual(controller.stats["highest"], 8)
+
+    async def test__multiplicative_decrease_1(self):
+        controller = self.build_controller()
+        await self.raise_in_slot(controller, build_status_error(429))
+        self.assertEqual(controller.limit, 2)
+        self.assertEqual(controller.stats["throttled"], 1)
+
+    async def test__multiplicative_decrease_2(self):
+        controller = self.build_controller(initial_limit=1)
+        await self.raise_in_slot(controller, ReadTimeout("timeout"))
+        self.assertEqual(controller.limit, 1)
+        self.assertEqual(controller.stats["timeouts"], 1)
+
+    async def test__neutral_status_1(self):
+        controller = self.build_controller()
+        await self.raise_in_slot(controller, build_status_error(404))
+        self.assertEqual(controller.limit, 4)
+        self.assertEqual(controller.in_flight, 0)
+
+def build_session(book_id: int) -> Session:
+    return Session(
+        sid=f"b{book_id}",
+        resource_id=book_id,
+        resource_type="book",
+        resource_url=f"https://books.toscrape.com/catalogue/book_{book_id}/index.html"
+    )
+
+class TestFrontier(unittest.IsolatedAsyncioTestCase):
+
+    async def test__priority_order_1(self):
+        frontier = Frontier()
+        frontier.push(build_session(1), Priority.UNCHANGED_BOOK)
+        frontier.push(build_session(2), Priority.NEW_BOOK)
+        frontier.push(Session("p2", 2, "page", "https://books.toscrape.com/catalogue/page-2.html"), Priority.PAGE)
+        sids = [(await frontier.get()).sid for _ in range(3)]
+        self.assertEqual(sids, ["p2", "b2", "b1"])
+
+    async def test__fifo_within_class_1(self):
+        frontier = Frontier()
+        for book_id in (5, 3, 4):
+            frontier.push(build_session(book_id), Priority.NEW_BOOK)
+        sids = [(await frontier.get()).sid for _ in range(3)]
+        self.assertEqual(sids, ["b5", "b3", "b4"])
+
+    async def test__fairness_1(self):
+        frontier = Frontier()
+        for book_id in range(100):
+            frontier.push(build_session(book_id), Priority.NEW_BOOK)
+        frontier.put_nowait((Priority.RETRY, build_session(1000)))
+        sids = [(await frontier.get()).sid for _ in range(10)]
+        self.assertIn("b1000", sids)
+
+    async def test__dedupe_1(self):
+        frontier = Frontier()
+        self.assertTrue(frontier.push(build_session(1), Priority.NEW_BOOK))
+        self.assertFalse(frontier.push(build_session(1), Priority.NEW_BOOK))
+        await frontier.get()
+        frontier.task_done()
+        self.assertFalse(frontier.push(build_session(1), Priority.CHANGED_BOOK))
+        self.assertEqual(frontier.qsize(), 0)
+        self.assertEqual(frontier.duplicates, 2)
+
+class TestMongoFrontier(unittest.IsolatedAsyncioTestCase):
+
+    def build_frontier(self, collection: FakeCollection, node_id: str) -> MongoFrontier:
+        frontier = MongoFrontier(collection, "crawler-1")
+        frontier.node_id = node_id
+        return frontier
+
+    def get_doc(self, collection: FakeCollection, sid: str) -> dict:
+        return next(doc for doc in collection.docs if doc["sid"] == sid)
+
+    async def test__add_1(self):
+        collection = FakeCollection(name="frontier")
+        frontier = self.build_frontier(collection, "a")
+        self.assertTrue(await frontier.add(build_session(1), Priority.NEW_BOOK))
+        self.assertFalse(await frontier.add(build_session(1), Priority.NEW_BOOK))
+        collection.insert_race = True
+        self.assertFalse(await frontier.add(build_session(2), Priority.NEW_BOOK))
+        self.assertEqual(len(collection.docs), 1)
+        self.assertEqual(frontier.duplicates, 2)
+
+    async def test__claim_order_1(self):
+        collection = FakeCollection(name="frontier")
+        frontier = self.build_frontier(collection, "a")
+        await frontier.add(build_session(1), Priority.UNCHANGED_BOOK)
+        await frontier.add(build_session(2), Priority.NEW_BOOK)
+        await frontier.add(build_session(3), Priority.NEW_BOOK)
+        await frontier.add(Session("p2", 2, "page", "https://books.toscrape.com/catalogue/page-2.html"), Priority.PAGE)
+        sids = [(await frontier.claim(timeout=0)).sid for _ in range(4)]
+        self.assertEqual(sids, ["p2", "b2", "b3", "b1"])
+        self.assertIsNone(await frontier.claim(timeout=0))
+        self.assertEqual(self.get_doc(collection, "b1")["lease_owner"], "a")
+
+    async def test__lease_expiry_1(self):
+        collection = FakeCollection(name="frontier")
+        node_a = self.build_frontier(collection, "a")
+        node_b = self.build_frontier(collection, "b")
+        await node_a.add(build_session(1), Priority.NEW_BOOK)
+        session = await node_a.claim(timeout=0)
+        self.assertIsNone(await node_b.claim(timeout=0))
+
+        # Node a dies and its lease expires
+        self.get_doc(collection, "b1")["lease_expires_at"] = datetime.now(timezone.utc) - timedelta(seconds=1)
+        self.assertEqual((await node_b.claim(timeout=0)).sid, "b1")
+
+        # Only the node holding the lease can complete or retry the session
+        await node_a.complete(session)
+        await node_a.retry(session, delay=0)
+        self.assertEqual(self.get_doc(collection, "b1")["status"], "leased")
+        await node_b.complete(session)
+        self.assertEqual(self.get_doc(collection, "b1")["status"], "done")
+
+    async def test__retry_1(self):
+        collection = FakeCollection(name="frontier")
+        frontier = self.build_frontier(collection, "a")
+        await frontier.add(build_session(1), Priority.NEW_BOOK)
+        session = await frontier.claim(timeout=0)
+        session.retry_count = 1
+        await frontier.retry(session, delay=60)
+        doc = self.get_doc(collection, "b1")
+        self.assertEqual((doc["status"], doc["priority"], doc["retry_count"], doc["lease_owner"]), ("pending", int(Priority.RETRY), 1, None))
+        self.assertIsNone(await frontier.claim(timeout=0))  # Not due yet
+
+        doc["due_at"] = datetime.now(timezone.utc)
+        self.assertEqual((await frontier.claim(timeout=0)).retry_count, 1)
+
+    @patch("bookstoscrape.crawler.frontier.FRONTIER_POLL_INTERVAL_SECONDS", 0.01)
+    async def test__join_1(self):
+        collection = FakeCollection(name="frontier")
+        frontier = self.build_frontier(collection, "a")
+        await frontier.add(build_session(1), Priority.NEW_BOOK)
+        session = await frontier.claim(timeout=0)
+        join = asyncio.create_task(frontier.join())
+        await asyncio.sleep(0.05)
+        self.assertFalse(join.done())
+        await frontier.complete(session)
+        await asyncio.wait_for(join, timeout=1)
+
+class TestRetryQueue(unittest.IsolatedAsyncioTestCase):
+
+    async def test__retry_order_1(self):
+        frontier = Frontier()
+        retry_queue = RetryQueue(frontier)
+        task = asyncio.create_task(retry_queue.run())
+        for book_id, delay in ((1, 0.04), (2, 0.01), (3, 0.02)):
+            frontier.push(build_session(book_id), Priority.NEW_BOOK)
+            retry_queue.schedule(await frontier.get(), delay)
+
+        sids = [(await frontier.get()).sid for _ in range(3)]
+        task.cancel()
+        self.assertEqual(sids, ["b2", "b3", "b1"])
+        self.assertEqual(len(retry_queue), 0)
+
+    async def test__join_waits_for_retries_1(self):
+        frontier = Frontier()
+        retry_queue = RetryQueue(frontier)
+        task = asyncio.create_task(retry_queue.run())
+        frontier.push(build_session(1), Priority.NEW_BOOK)
+        retry_queue.schedule(await frontier.get(), 0.02)
+
+        join = asyncio.create_task(frontier.join())
+        await asyncio.sleep(0.01)
+        self.assertFalse(join.done())
+
+        await frontier.get()
+        frontier.task_done()
+        await asyncio.wait_for(join, 1)
+        task.cancel()
+
+class TestParallel(unittest.TestCase):
+
+    def test__shard_sessions_1(self):
+        shards = shard_sessions([build_session(book_id) for book_id in range(1, 8)], 3)
+        self.assertEqual(
+            [[session.resource_id for session in shard] for shard in shards],
+            [[3, 6], [1, 4, 7], [2, 5]]
+        )
+
+    def test__merge_run_stats_1(self):
+        self.assertEqual(
+            merge_run_stats([
+                {"succeeded": 3, "failed": 1, "concurrency": {"current": 4, "lowest": 2, "highest": 6}},
+                {"succeeded": 5, "failed": 0, "concurrency": {"current": 3, "lowest": 1, "highest": 5}},
+            ]),
+            {"succeeded": 8, "failed": 1, "concurrency": {"current": 7, "lowest": 1, "highest": 6}}
+        )
+
+    def test__merge_daily_change_reports_1(self):
+        reports = [
+            {
+                "report_date": "2025-12-03",
+                "summary": {"added": 1, "updated": 0, "total": 1},
+                "changelog": [{"bts_id": 2, "event": "add", "timestamp": "2025-12-03 12:00:05", "changes": {}}]
+            },
+            {
+                "report_date": "2025-12-03",
+                "summary": {"added": 0, "updated": 1, "total": 1},
+                "changelog": [{"bts_id": 1, "event": "update", "timestamp": "2025-12-03 12:00:01", "changes": {}}]
+            },
+        ]
+        merged = merge_daily_change_reports(reports)
+        self.assertEqual(merged["summary"], {"added": 1, "updated": 1, "total": 2})
+        self.assertEqual([log["bts_id"] for log in merged["changelog"]], [1, 2])
+
+class TestFetch(unittest.IsolatedAsyncioTestCase):
+
+    page_url = "https://books.toscrape.com/catalogue/page-1.html"
+    with open(BASE_FOLDER / "tests" / "assets" / "page1.html", "rb") as f:
+        page1 = f.read()
+    parse_pool = ParsePool(pool_size=0)
+
+    def build_client(self, requests: list[Request]) -> AsyncClient:
+        def handler(request: Request) -> Response:
+            requests.append(request)
+            if request.headers.get("if-none-match") == '"v1"':
+                return Response(304)
+            return Response(200, content=self.page1, headers={"etag": '"v1"'})
+        return AsyncClient(transport=MockTransport(handler))
+
+    async def test__fetch_page_cache_1(self):
+        requests = []
+        async with self.build_client(requests) as client:
+            page = await fetch_page(client, self.page_url)
+            book_count, listings, cache_entry = await read_page(self.parse_pool, self.page_url, page)
+            self.assertEqual(cache_entry["etag"], '"v1"')
+            self.assertEqual(len(cache_entry["listings"]), 20)
+
+            page = await fetch_page(client, self.page_url, cache_entry)
+            cached = await read_page(self.parse_pool, self.page_url, page, cache_entry)
+        self.assertEqual(cached, (book_count, listings, None))
+        self.assertEqual(requests[1].headers["if-none-match"], '"v1"')
+
+    async def test__fetch_page_cache_2(self):
+        requests = []
+        cache_entry = {"page_url": self.page_url, "etag": '"v0"', "last_modified": None}
+        async with self.build_client(requests) as client:
+            page = await fetch_page(client, self.page_url, cache_entry)
+            _, listings, new_entry = await read_page(self.parse_pool, self.page_url, page, cache_entry)
+        self.assertEqual(len(listings), 20)
+        self.assertEqual(new_entry["etag"], '"v1"')
+
+class TestParsePool(unittest.IsolatedAsyncioTestCase):
+
+    book_url = "https://books.toscrape.com/catalogue/a-light-in-the-attic_1000/index.html"
+    with open(BASE_FOLDER / "tests" / "assets" / "book1.html", "rb") as f:
+        book1 = f.read()
+
+    async def asyncSetUp(self):
+        self.parse_pool = ParsePool(pool_size=2, batch_size=4, batch_delay=0.01)
+
+    async def asyncTearDown(self):
+        await self.parse_pool.shutdown()
+
+    async def test__batches_1(self):
+        books = await asyncio.gather(*[
+            self.parse_pool.parse_book(self.book1, 1000, self.book_url)
+            for _ in range(5)
+        ])
+        self.assertEqual(books, [process_book(self.book1, 1000, self.book_url)] * 5)
+        self.assertEqual(self.parse_pool.stats, {"jobs": 5, "batches": 2})
+
+    async def test__errors_1(self):
+        content = self.book1.replace(b"<th>UPC</th>", b"<th>ISBN</th>")
+        results = await asyncio.gather(
+            self.parse_pool.parse_book(content, 1000, self.book_url),
+            self.parse_pool.parse_book(self.book1, 1000, self.book_url),
+            return_exceptions=True
+        )
+        self.assertIsInstance(results[0], ProcessingError)
+        self.assertEqual(results[0].field, "upc")
+        self.assertEqual(results[1].bts_id, 1000)
+
+def build_replace(book_id: int) -> ReplaceOne:
+    return ReplaceOne({"bts_id": book_id}, {"bts_id": book_id}, upsert=True)
+
+class TestBulkWriter(unittest.IsolatedAsyncioTestCase):
+
+    async def test__batches_1(self):
+        collection = FakeCollection([{"bts_id": 2}])
+        writer = BulkWriter("book", collection, logger, batch_size=3, flush_interval=0.01)
+        results = await asyncio.gather(*[writer.write(build_replace(book_id)) for book_id in range(1, 6)])
+        self.assertEqual(results, [True, False, True, True, True])
+        self.assertEqual(collection.batch_ids(), [[1, 2, 3], [4, 5]])
+
+    @patch("bookstoscrape.crawler.bulk_writer.compute_retry_delay", return_value=0)
+    async def test__retry_failed_writes_1(self, _):
+        collection = FakeCollection()
+        collection.write_errors = {2: 112, 3: 112}  # WriteConflict
+        writer = BulkWriter("book", collection, logger, batch_size=4, flush_interval=0.01)
+        results = await asyncio.gather(*[writer.write(build_replace(book_id)) for book_id in range(1, 5)])
+        self.assertEqual(results, [True, True, True, True])
+        self.assertEqual(collection.batch_ids(), [[1, 2, 3, 4], [2, 3]])
+        self.assertEqual(writer.stats, {"operations": 4, "batches": 1, "retries": 1})
+
+    @patch("bookstoscrape.crawler.bulk_writer.compute_retry_delay", return_value=0)
+    async def test__retry_failed_writes_2(self, _):
+        # Non-transient errors, e.g. a duplicate key, aren't retried
+        collection = FakeCollection()
+        collection.write_errors = {2: 11000}
+        writer = BulkWriter("book", collection, logger, batch_size=3, flush_interval=0.01)
+        results = await asyncio.gather(*[writer.write(build_replace(book_id)) for book_id in range(1, 4)], return_exceptions=True)
+        self.assertEqual((results[0], results[2]), (True, True))
+        self.assertIsInstance(results[1], BulkWriteError)
+        self.assertEqual(collection.batch_ids(), [[1, 2, 3]])
+
+    @patch("bookstoscrape.crawler.bulk_writer.compute_retry_delay", return_value=0)
+    async def test__retry_failed_writes_3(self, _):
+        # A batch whose write concern wasn't met is retried whole, and still reports its inserts
+        collection = FakeCollection()
+        collection.write_concern_error = True
+        writer = BulkWriter("book", collection, logger, batch_size=2, flush_interval=0.01)
+        results = await asyncio.gather(*[writer.write(build_replace(book_id)) for book_id in range(1, 3)])
+        self.assertEqual(results, [True, True])
+        self.assertEqual(collection.batch_ids(), [[1, 2], [1, 2]])
+
+def get_sids(collection: FakeCollection) -> list[str]:
+    return sorted(doc["sid"] for doc in collection.docs)
+
+class TestCheckpoint(unittest.IsolatedAsyncioTestCase):
+
+    async def test__incremental_writes_1(self):
+        collection = FakeCollection(name="crawler_state")
+        checkpoint = Checkpoint(collection, logger, max_changes=100)
+        for book_id in (1, 2, 3):
+            checkpoint.add(build_session(book_id))
+        checkpoint.remove("b2")
+        await checkpoint.flush()
+        self.assertEqual(get_sids(collection), ["b1", "b3"])
+
+        checkpoint.remove("b1")
+        await checkpoint.flush()
+        self.assertEqual(get_sids(collection), ["b3"])
+        self.assertEqual(checkpoint.stats, {"upserted": 2, "deleted": 2, "writes": 2})
+
+    async def test__failed_write_1(self):
+        collection = FakeCollection(name="crawler_state")
+        collection.failing = True
+        checkpoint = Checkpoint(collection, logger, max_changes=100)
+        checkpoint.add(build_session(1))
+        checkpoint.add(build_session(2))
+        await checkpoint.flush()
+        checkpoint.remove("b2")
+
+        collection.failing = False
+        await checkpoint.close()
+        self.assertEqual(get_sids(collection), ["b1"])
+
+    async def test__load_1(self):
+        collection = FakeCollection(name="crawler_state")
+        checkpoint = Checkpoint(collection, logger)
+        collection.docs = [asdict(build_session(book_id)) for book_id in (3, 1, 2)]
+        sessions = [session async for session in checkpoint.load(batch_size=2)]
+        self.assertEqual([session.sid for session in sessions], ["b1", "b2", "b3"])
+        self.assertEqual(collection.queries, [{}, {"sid": {"$gt": "b2"}}])
+
+class TestStoredBooks(unittest.IsolatedAsyncioTestCase):
+
+    async def test__load_1(self):
+        collection = FakeCollection([
+            {"bts_id": 1, "price": 10.0, "category": "Poetry", "crawl_metadata": {"etag": "a", "status": "success"}},
+            {"bts_id": 3, "crawl_metadata": {"etag": None, "status": "failed"}},
+        ])
+        stored_books = StoredBooks(collection, batch_size=2)
+        await stored_books.load([1, 2, 3, 1])
+        self.assertEqual([query["bts_id"]["$in"] for query in collection.queries], [[1, 2], [3]])
+        self.assertEqual((stored_books.get(1).etag, stored_books.get(1).price), ("a", 10.0))
+        self.assertIsNone(stored_books.get(2))
+        self.assertEqual(stored_books.get(3).status, "failed")
+
+        # Loaded books, including the ones that aren't stored, aren't looked up again
+        self.assertEqual((await stored_books.lookup(2)), None)
+        self.assertEqual(len(collection.queries), 2)
+
+    async def test__discard_1(self):
+        collection = FakeCollection([{"bts_id": 1, "crawl_metadata": {"etag": "a"}}])
+        stored_books = StoredBooks(collection)
+        await stored_books.load([1, 2])
+        stored_books.discard(1)
+        stored_books.discard(2)
+        self.assertEqual(len(stored_books), 0)
+        self.assertEqual((await stored_books.lookup(1)).etag, "a")
+        self.assertEqual(stored_books.stats, {"lookups": 2, "loaded": 2, "highest": 2})
+
+class TestPushToStorage(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.stored = {
+            "bts_id": 1, "name": "A Light in the Attic", "description": "It's hard to imagine a world without A Light in the Attic.",
+            "url": "https://books.toscrape.com/catalogue/a-light-in-the-attic_1000/index.html",
+            "category": "Poetry", "upc": "a897fe39b1053632", "price": 51.77, "tax": 0.0,
+            "in_stock": True, "stock_count": 22, "review_count": 0,
+            "cover_image_url": "https://books.toscrape.com/media/cache/fe/72/fe72f0532301ec28892ae79a629a293c.jpg",
+            "rating": 3,
+        }
+        self.manager = Manager("dev", logger, is_scheduler=True)
+        self.collection = FakeCollection([self.stored | {"crawl_metadata": {"status": "success", "etag": "a"}}])
+        self.changelog = FakeCollection(name="changelog")
+        self.manager.book_collection = self.collection
+        self.manager.book_writer.collection = self.collection
+        self.manager.stored_books.collection = self.collection
+        self.manager.changelog_writer.collection = self.changelog
+        self.manager.notifier_stage.put = lambda item: asyncio.sleep(0)
+
+    async def asyncTearDown(self):
+        await self.manager.close_http_client()
+        await self.manager.close_db_client()
+
+    async def test__push_to_storage_1(self):
+        # Fields that aren't tracked in the changelog are still written
+        book = Book(**(self.stored | {"description": "A new description.", "price": 45.0}))
+        await self.manager._push_to_storage(1, self.stored["url"], "b", book, "digest")
+        update = self.collection.operations[0]._doc["$set"]
+        self.assertEqual(set(update), {"description", "price", "crawl_metadata"})
+        self.assertEqual(update["description"], "A new description.")
+        self.assertEqual(self.changelog.operations[0]._doc["changes"], {"price": {"old": 51.77, "new": 45.0}})
+
+    async def test__push_to_storage_2(self):
+        # The digest changed but the fields didn't, so only the metadata is written
+        alerts = []
+        self.manager.notifier_stage.put = lambda item: asyncio.sleep(0, alerts.append(item))
+        await self.manager._push_to_storage(1, self.stored["url"], "b", Book(**self.stored), "digest")
+        update = self.collection.operations[0]._doc["$set"]
+        self.assertEqual(set(update), {"crawl_metadata"})
+        self.assertEqual(update["crawl_metadata"]["digest"], "digest")
+        self.assertEqual(self.manager.daily_change_report["summary"]["updated"], 0)
+        self.assertEqual(self.changelog.operations, [])
+        self.assertEqual(alerts, [])
+
+class TestSnapshotStore(unittest.IsolatedAsyncioTestCase):
+
+    content = (BASE_FOLDER / "tests" / "assets" / "book1.html").read_bytes()
+
+    async def test__write_and_read_1(self):
+        with tempfile.TemporaryDirectory() as folder:
+            for compression in ("zstd", "gzip", None):
+                with self.subTest(compression=compression):
+                    store = SnapshotStore(Path(folder) / str(compression), day="20260101", compression=compression)
+                    await store.write(1000, self.content)
+                    await store.write(7, b"<html>7</html>")
+                    await store.close()
+                    self.assertEqual(store.read(1000, "20260101"), self.content)
+                    self.assertEqual(store.read(7), b"<html>7</html>")
+                    self.assertIsNone(store.read(8))
+                    self.assertIsNone(store.read(1001))
+                    store.close_readers()
+
+    async def test__deduplication_1(self):
+        with tempfile.TemporaryDirectory() as folder:
+            day1 = SnapshotStore(Path(folder), day="20260101")
+            await day1.write(1, self.content)
+            await day1.write(2, b"<html>2</html>")
+            await day1.close()
+
+            day2 = SnapshotStore(Path(folder), day="20260102")
+            await day2.write(1, self.content)
+            await day2.write(2, b"<html>2, updated</html>")
+            await day2.close()
+            self.assertEqual(day2.stats["deduplicated"], 1)
+            self.assertEqual(len(list((Path(folder) / "segments").glob("*.seg"))), 2)
+
+            self.assertEqual(day2.days(), ["20260101", "20260102"])
+            self.assertEqual(day2.read(2, "20260101"), b"<html>2</html>")
+            self.assertEqual(day2.read(2), b"<html>2, updated</html>")
+            self.assertEqual(day2.book_ids(), [1, 2])
+            self.assertEqual(dict(day2.iter_snapshots("20260102"))[1], self.content)
+            day2.close_readers()
+
+    async def test__segments_1(self):
+        with tempfile.TemporaryDirectory() as folder:
+            store = SnapshotStore(Path(folder), day="20260101", compression=None, segment_max_bytes=10)
+            for book_id in range(1, 4):
+                await store.write(book_id, f"<html>{book_id}</html>".encode())
+            await store.close()
+            self.assertEqual(len(list((Path(folder) / "segments").glob("*.seg"))), 3)
+            self.assertEqual([store.read(book_id) for book_id in range(1, 4)], [f"<html>{i}</html>".encode() for i in range(1, 4)])
+            store.close_readers()
+
+    async def test__unclosed_store_1(self):
+        # A run that is killed before closing its store keeps its snapshots
+        with tempfile.TemporaryDirectory() as folder:
+            store = SnapshotStore(Path(folder), day="20260101")
+            await store.write(1000, self.content)
+            await store.write(2, b"<html>2</html>")
+            store._executor.shutdown()
+
+            reader = SnapshotStore(Path(folder))
+            self.assertEqual(reader.book_ids(), [2, 1000])
+            self.assertEqual(reader.read(1000), self.content)
+            reader.close_readers()
+            await store.close()
+
+class TestReplay(unittest.IsolatedAsyncioTestCase):
+
+    content = (BASE_FOLDER / "tests" / "assets" / "book1.html").read_bytes()
+    book_url = "https://books.toscrape.com/catalogue/a-light-in-the-attic_1000/index.html"
+
+    async def test__replay_batch_1(self):
+        with tempfile.TemporaryDirectory() as folder:
+            store = SnapshotStore(Path(folder), day="20260101")
+            await store.write(1000, self.content)
+            await store.write(999, b"<html></html>")
+            await store.close()
+
+            results = replay_batch(Path(folder), None, [(1000, self.book_url, None), (999, self.book_url, None)], "lxml")
+            book_id, succeeded, book, digest = results[0]
+            self.assertTrue(succeeded)
+            self.assertEqual((book_id, book["upc"]), (1000, "a897fe39b1053632"))
+            self.assertIsNotNone(digest)
+            self.assertEqual(results[1], (999, False, "article", None))  # No product article
+
+    async def test__replay_batch_2(self):
+        # Only snapshots of the stored content are replayed
+        digest = compute_product_digest(self.content)
+        with tempfile.TemporaryDirectory() as folder:
+            store = SnapshotStore(Path(folder), day="20260101")
+            await store.write(1000, self.content)
+            await store.write(1001, self.content)
+            await store.close()
+
+            results = replay_batch(Path(folder), None, [(1000, self.book_url, digest), (1001, self.book_url, "newer")], "lxml")
+            self.assertTrue(results[0][1])
+            self.assertEqual(results[1], (1001, False, STALE_SNAPSHOT, None))
+
+    def test__get_update_changes_1(self):
+        stored_book = {"bts_id": 1, "price": 10.0, "rating": 3, "crawl_metadata": {}}
+        book = {"bts_id": 1, "price": 12.5, "rating": 3, "name": "Sapiens"}
+        self.assertEqual(get_update_changes(stored_book, book), {"price": {"old": 10.0, "new": 12.5}})
+
+class TestRebuild(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.live_folder = Path(self.folder.name) / "crawler"
+        live_store = SnapshotStore(self.live_folder, day="20260101")
+        await live_store.write(1, b"<html>live</html>")
+        await live_store.close()
+        self.rebuild_store = SnapshotStore(get_rebuild_snapshot_folder(self.live_folder), day="20260102")
+        await self.rebuild_store.write(2, b"<html>rebuild</html>")
+        await self.rebuild_store.close()
+
+    async def asyncTearDown(self):
+        self.folder.cleanup()
+
+    def build_manager(self, calls: list, swapped: bool = False) -> SimpleNamespace:
+        book_collection = FakeCollection(name="books_rebuild", calls=calls)
+        book_collection.exists = not swapped
+        return SimpleNamespace(
+            book_collection=book_collection,
+            changelog_collection=FakeCollection(name="changelog", calls=calls),
+            snapshot_store=self.rebuild_store,
+            logger=logger
+        )
+
+    async def test__swap_in_rebuild_1(self):
+        calls = []
+        await swap_in_rebuild(self.build_manager(calls), self.live_folder)
+        self.assertEqual(calls, [
+            ("create_indexes", len(get_book_indexes())),
+            ("rename", MONGODB_BOOK_COLLECTION, {"dropTarget": True}),
+            ("drop",),
+            ("create_indexes", len(get_changelog_indexes())),
+        ])
+        # The snapshots of the rebuild replace the live ones
+        store = SnapshotStore(self.live_folder)
+        self.assertEqual(store.book_ids(), [2])
+        self.assertFalse(get_rebuild_snapshot_folder(self.live_folder).exists())
+
+    async def test__swap_in_rebuild_2(self):
+        # Another process already swapped the collection in
+        calls = []
+        await swap_in_rebuild(self.build_manager(calls, swapped=True), self.live_folder)
+        self.assertEqual(calls, [])
+        self.assertEqual(SnapshotStore(self.live_folder).book_ids(), [2])
+
+    async def test__swap_in_rebuild_3(self):
+        # The live books keep their snapshots if the rename fails
+        manager = self.build_manager([])
+        async def rename(new_name: str, **kwargs):
+            raise OperationFailure("not authorized", code=13)
+        manager.book_collection.rename = rename
+        with self.assertRaises(OperationFailure):
+            await swap_in_rebuild(manager, self.live_folder)
+        self.assertEqual(SnapshotStore(self.live_folder).read(1), b"<html>live</html>")
@@ -1,21 +1,32 @@
+import asyncio
+import base64
 import hashlib
 import secrets
 import time
-from bson import ObjectId
-from contextlib import asynccontextmanager
+from bson import ObjectId, json_util
+from collections import OrderedDict
+from contextlib import asynccontextmanager, suppress
+from datetime import datetime
+from functools import partial
 from fastapi import FastAPI, Depends, Header, HTTPException, Request
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pymongo import AsyncMongoClient
 from pymongo.asynchronous.database import AsyncDatabase
-from pymongo.errors import ConnectionFailure
+from pymongo.errors import ConnectionFailure, OperationFailure, PyMongoError
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
 from ..settings import (
-    JWT_ALGORITHM, JWT_SECRET_KEY, MONGODB_CONNECTION_URI, MONGODB_DB,
-    MONGODB_USERS_COLLECTION, MONGODB_API_KEYS_COLLECTION,
+    API_KEY_CACHE_NEGATIVE_TTL_SECONDS, API_KEY_CACHE_SIZE,
+    API_KEY_CACHE_TTL_SECONDS, API_KEY_REVOCATION_HISTORY,
+    BOOKS_QUERY_CACHE_SIZE, JWT_ALGORITHM,
+    JWT_SECRET_KEY, META_VERSION_POLL_INTERVAL_SECONDS,
+    MONGODB_CONNECTION_URI, MONGODB_DB, MONGODB_USERS_COLLECTION,
+    MONGODB_API_KEYS_COLLECTION, MONGODB_META_COLLECTION,
 )
 from .common import setup_logger
 
@@ -31,6 +42,196 @@ api_limiter = Limiter(key_func=rate_limit_func)
 pl_ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")  # passlib context
 oauth2 = OAuth2PasswordBearer(tokenUrl="/login")
 
+CHANGE_STREAMS_NOT_SUPPORTED = 40573  # e.g. on a standalone server
+
+class ApiKeyCache:
+    """
+    LRU cache of verified API keys, mapping key hashes to their user_id, or
+    to None for invalid keys. Entries expire after `ttl` seconds, or
+    `negative_ttl` seconds for invalid keys.
+
+    Replacing a key bumps the "api_keys" version in the meta collection and
+    records the hash of the old key, which every API worker drops from its
+    cache as soon as the change stream reports it (see `watch_versions`).
+    Other cached keys are kept. Without a change stream, cached keys are only
+    trusted once the version is read again, so the old key stops working
+    everywhere at once.
+    """
+    meta_id = "api_keys"
+
+    def __init__(
+        self,
+        max_size: int = API_KEY_CACHE_SIZE,
+        ttl: float = API_KEY_CACHE_TTL_SECONDS,
+        negative_ttl: float = API_KEY_CACHE_NEGATIVE_TTL_SECONDS
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: OrderedDict[str, tuple[Optional[ObjectId], float]] = OrderedDict()  # user_id and expiry
+        self.version: Optional[int] = None
+        self.generation = 0  # Bumped on invalidation, so lookups that started before it aren't cached
+        self.watched = False  # Whether a change stream reports revoked keys
+
+    def get(self, key_hash: str) -> tuple[bool, Optional[ObjectId]]:
+        """Return whether the key is cached, with its user_id or None if it is invalid"""
+        entry = self._entries.get(key_hash)
+        if (entry is None) or (entry[1] < time.monotonic()):
+            return False, None
+        self._entries.move_to_end(key_hash)
+        return True, entry[0]
+
+    def set(self, key_hash: str, user_id: Optional[ObjectId], generation: int):
+        if generation != self.generation:
+            return
+        ttl = self.ttl if user_id else self.negative_ttl
+        self._entries[key_hash] = (user_id, time.monotonic() + ttl)
+        self._entries.move_to_end(key_hash)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, key_hash: str):
+        self._entries.pop(key_hash, None)
+        self.generation += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.generation += 1
+
+    def refresh(self, meta: dict):
+        """
+        Drop the keys revoked since the cached version. The whole cache is
+        cleared if more were revoked than the meta document keeps.
+        """
+        version, revoked = meta.get("version", 0), meta.get("revoked", [])
+        if version == self.version:
+            return
+        missed = version - (self.version or 0)
+        if (self.version is not None) and (0 < missed <= len(revoked)):
+            for key_hash in revoked[-missed:]:
+                self.discard(key_hash)
+        else:
+            self.clear()
+        self.version = version
+
+class QueryCache:
+    """
+    LRU cache of query results, keyed by the normalized query, holding up to
+    `max_size` results.
+
+    Concurrent misses of the same query share one load. Results are dropped
+    when the crawler or the scheduler bump the "catalog" version in the meta
+    collection (see `watch_versions`), so the cache is only invalidated when
+    the books change.
+    """
+    meta_id = "catalog"
+
+    def __init__(self, max_size: int = BOOKS_QUERY_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+        self._loads: dict[Hashable, asyncio.Task] = {}  # Misses being loaded
+        self.version: Optional[int] = None
+        self.generation = 0  # Bumped on clear, so loads that started before it aren't cached
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+    async def get(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        """Return the cached result of a query, or load it once for every caller that misses"""
+        if key in self._entries:
+            self.stats["hits"] += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        task = self._loads.get(key)
+        if task is None:
+            self.stats["misses"] += 1
+            task = asyncio.create_task(load())
+            task.add_done_callback(partial(self._store, key, self.generation))
+            self._loads[key] = task
+        else:
+            self.stats["coalesced"] += 1
+        # A caller that is cancelled, e.g. by a client disconnect, doesn't cancel the others' load
+        return await asyncio.shield(task)
+
+    def _store(self, key: Hashable, generation: int, task: asyncio.Task):
+        if self._loads.get(key) is task:
+            del self._loads[key]
+        if task.cancelled() or (task.exception() is not None) or (generation != self.generation):
+            return
+        self._entries[key] = task.result()
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self._loads.clear()
+        self.generation += 1
+
+    def refresh(self, meta: dict):
+        """Drop every result once the catalog version changes"""
+        version = meta.get("version", 0)
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+api_key_cache = ApiKeyCache()
+books_query_cache = QueryCache()
+
+async def refresh_versions(db: AsyncDatabase, caches: list[ApiKeyCache | QueryCache]):
+    """Refresh the caches whose version changed in the meta collection"""
+    metas = {
+        meta["_id"]: meta
+        async for meta in db[MONGODB_META_COLLECTION].find({"_id": {"$in": [cache.meta_id for cache in caches]}})
+    }
+    for cache in caches:
+        cache.refresh(metas.get(cache.meta_id, {}))
+
+async def watch_versions(
+    db: AsyncDatabase, caches: list[ApiKeyCache | QueryCache],
+    interval: float = META_VERSION_POLL_INTERVAL_SECONDS
+):
+    """
+    Refresh the caches for the life of the app, as soon as a change stream on
+    the meta collection reports a new version. Without change streams, e.g.
+    on a standalone server, versions are polled every `interval` seconds.
+    """
+    caches_by_id = {cache.meta_id: cache for cache in caches}
+    key_caches = [cache for cache in caches if isinstance(cache, ApiKeyCache)]
+    pipeline = [{"$match": {"documentKey._id": {"$in": list(caches_by_id)}}}]
+    while True:
+        try:
+            async with await db[MONGODB_META_COLLECTION].watch(pipeline, full_document="updateLookup") as stream:
+                await refresh_versions(db, caches)  # Changes made before the stream was opened
+                set_watched(key_caches, True)
+                while stream.alive:
+                    # try_next waits for one batch, within the client's timeout, unlike iterating the stream
+                    change = await stream.try_next()
+                    if change and change.get("fullDocument"):
+                        caches_by_id[change["documentKey"]["_id"]].refresh(change["fullDocument"])
+        except OperationFailure as exc:
+            if exc.code != CHANGE_STREAMS_NOT_SUPPORTED:
+                logger.warning(f"Cache version change stream failed: {repr(exc)}")
+            else:
+                logger.info("Change streams aren't supported. Polling the cache versions instead")
+                await poll_versions(db, caches, interval)
+        except PyMongoError as exc:
+            logger.warning(f"Cache version change stream failed: {repr(exc)}")
+        finally:
+            set_watched(key_caches, False)
+        await asyncio.sleep(interval)
+
+def set_watched(caches: list[ApiKeyCache], watched: bool):
+    for cache in caches:
+        cache.watched = watched
+
+async def poll_versions(db: AsyncDatabase, caches: list[ApiKeyCache | QueryCache], interval: float):
+    """Refresh the versions of the caches every `interval` seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await refresh_versions(db, caches)
+        except PyMongoError as exc:
+            logger.warning(f"Failed to check the cache versions: {repr(exc)}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """App lifespan. Used to initialize and close database"""
@@ -45,6 +246,10 @@ async def lifespan(app: FastAPI):
         app.db = app.mongodb_client[MONGODB_DB]
         logger.info("Database connected")
 
+        caches = [api_key_cache, books_query_cache]
+        await refresh_versions(app.db, caches)
+        app.version_watcher = asyncio.create_task(watch_versions(app.db, caches))
+
         yield
 
     except ConnectionFailure:
@@ -52,6 +257,10 @@ async def lifespan(app: FastAPI):
         raise
 
     finally:
+        if getattr(app, "version_watcher", None):
+            app.version_watcher.cancel()
+            with suppress(asyncio.CancelledError):
+                await app.version_watcher
         if app.mongodb_client:
             await app.mongodb_client.close()
             logger.info("Database disconnected")
@@ -95,16 +304,70 @@ def create_api_key():
     key_hash = hashlib.sha256(key.encode()).hexdigest()
     return key, key_hash
 
+async def revoke_api_key(db: AsyncDatabase, key_hash: str):
+    """Bump the API keys version with the hash of a replaced key, so every API worker drops it from its cache"""
+    await db[MONGODB_META_COLLECTION].update_one(
+        {"_id": ApiKeyCache.meta_id},
+        {
+            "$inc": {"version": 1},
+            "$push": {"revoked": {"$each": [key_hash], "$slice": -API_KEY_REVOCATION_HISTORY}}
+        },
+        upsert=True
+    )
+    api_key_cache.discard(key_hash)
+
 async def require_api_key(
     db: AsyncDatabase = Depends(get_db),
     x_api_key: str = Header(...)
 ):
-    """Dependency for book endpoints."""
-    key_collection = db[MONGODB_API_KEYS_COLLECTION]
+    """Dependency for book endpoints. Keys are verified from the cache when possible."""
+    key_hash = hashlib.sha256(x_api_key.encode()).hexdigest()
+    cached, user_id = api_key_cache.get(key_hash)
+    if cached and user_id and (not api_key_cache.watched):
+        # Without a change stream, a key revoked by another worker is only seen once the version is read
+        await refresh_versions(db, [api_key_cache])
+        cached, user_id = api_key_cache.get(key_hash)
+    if not cached:
+        generation = api_key_cache.generation
+        key_collection = db[MONGODB_API_KEYS_COLLECTION]
+        api_key = await key_collection.find_one({"key_hash": key_hash})
+        user_id = api_key["user_id"] if api_key else None
+        api_key_cache.set(key_hash, user_id, generation)
 
-    api_key = await key_collection.find_one(
-        {"key_hash": hashlib.sha256(x_api_key.encode()).hexdigest()}
-    )
-    if not api_key:
+    if not user_id:
         raise HTTPException(401, detail="Invalid API key")
-    return api_key["user_id"]
+    return user_id
+
+CURSOR_VALUE_TYPES = (str, int, float, datetime, type(None))
+
+def encode_cursor(sort: list[tuple[str, int]], doc: dict) -> str:
+    """Opaque pagination cursor holding the sort and the sort values of the last document of a page."""
+    position = {"sort": sort, "after": [doc[field] for field, _ in sort]}
+    return base64.urlsafe_b64encode(json_util.dumps(position).encode()).decode()
+
+def build_keyset_filter(sort: list[tuple[str, int]], cursor: str) -> dict:
+    """
+    Turn a cursor into a range filter matching the documents after it in
+    `sort` order, so a page starts with an index seek instead of a skip.
+    """
+    try:
+        position = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+        values = position["after"]
+        # Values go straight into the filter, so anything but a scalar, e.g. an operator, is refused
+        valid = (
+            ([list(key) for key in sort] == position["sort"])
+            and isinstance(values, list) and (len(values) == len(sort))
+            and all(isinstance(value, CURSOR_VALUE_TYPES) for value in values)
+        )
+    except Exception:
+        valid = False
+    if not valid:
+        raise HTTPException(400, detail="Invalid cursor")
+
+    # (a, b) after (x, y) is: a beyond x, or a equal to x and b beyond y
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch = {prev_field: values[j] for j, (prev_field, _) in enumerate(sort[:i])}
+        branch[field] = {"$gt" if direction == 1 else "$lt": values[i]}
+        branches.append(branch)
+    return {"$or": branches}
@@ -6,6 +6,7 @@ from datetime import datetime, timezone
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from enum import IntEnum
+from pathlib import Path
 from pydantic import BaseModel, HttpUrl
 from typing import Literal, Optional
 
@@ -30,6 +31,13 @@ class Book(BaseModel):
     cover_image_url: HttpUrl
     rating: Rating
 
+class BookListing(BaseModel):
+    """Book fields shown on a listing page"""
+    url: str
+    price: float
+    rating: Rating
+    in_stock: bool
+
 class Rating(IntEnum):
     ONE = 1
     TWO = 2
@@ -51,9 +59,10 @@ Category = Literal[
 ]
 
 def setup_logger(
-    name: Literal["crawler", "scheduler", "api"],
+    name: Literal["crawler", "scheduler", "replay", "api"],
     add_file_handler: bool = True,
-    use_uvicorn_format: bool = False
+    use_uvicorn_format: bool = False,
+    log_file: Optional[Path] = None
 ):
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
@@ -78,10 +87,11 @@ def setup_logger(
     logger.addHandler(stdout_handler)
 
     if add_file_handler:
-        log_folder = BASE_FOLDER / "logs"
-        log_folder.mkdir(exist_ok=True)
-        time_now = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
-        log_file = log_folder / f"{name}_{time_now}.log"
+        if not log_file:  # Worker processes append to their coordinator's log file
+            log_folder = BASE_FOLDER / "logs"
+            log_folder.mkdir(exist_ok=True)
+            time_now = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+            log_file = log_folder / f"{name}_{time_now}.log"
         file_handler = logging.FileHandler(log_file)
         file_handler.setLevel(logging.INFO)
         file_handler.setFormatter(formatter)
@@ -89,7 +99,13 @@ def setup_logger(
 
     return logger
 
-def cleanup_logger(name: Literal["crawler", "scheduler"]):
+def get_log_file(logger: logging.Logger) -> Optional[Path]:
+    """Return the path of the logger's log file, if it has one"""
+    for handler in logger.handlers:
+        if isinstance(handler, logging.FileHandler):
+            return Path(handler.baseFilename)
+
+def cleanup_logger(name: Literal["crawler", "scheduler", "replay"]):
     """Close all handlers for a logger to release file locks"""
     logger = logging.getLogger(name)
     for handler in logger.handlers[:]:
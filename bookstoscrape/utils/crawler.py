@@ -1,7 +1,17 @@
+import multiprocessing
+import os
+import random
 import re
 from argparse import ArgumentParser
-from typing import Literal
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Literal, Optional
 
+from ..settings import (
+    FRONTIER_BACKEND, RETRY_AFTER_MAX_SECONDS, RETRY_BASE_DELAY_SECONDS,
+    RETRY_MAX_DELAY_SECONDS,
+)
 from ..utils.common import send_email
 
 
@@ -10,6 +20,42 @@ def extract_id_from_book_url(url: str):
     book_id = re.search(r"_(\d+)/index\.html$", url).group(1)
     return int(book_id)
 
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parse a Retry-After header given either in seconds or as an HTTP date.
+    Return the number of seconds to wait or None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+def compute_retry_delay(retry_count: int, retry_after: Optional[float] = None) -> float:
+    """
+    Compute how long to wait before a retry: exponential backoff with jitter,
+    but never less than the origin's Retry-After.
+    """
+    backoff = min(RETRY_BASE_DELAY_SECONDS * 2 ** (retry_count - 1), RETRY_MAX_DELAY_SECONDS)
+    delay = backoff / 2 + random.uniform(0, backoff / 2)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, RETRY_AFTER_MAX_SECONDS))
+    return delay
+
+def create_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    """
+    Create a pool of worker processes started with spawn. Forking a process
+    that already runs an event loop and database threads is unsafe.
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
 def build_cli_parser() -> ArgumentParser:
     """Build CLI parser for BooksToScrape crawler."""
     parser = ArgumentParser(description="Run the BooksToScrape crawler")
@@ -31,9 +77,52 @@ def build_cli_parser() -> ArgumentParser:
         action="store_false",
         help="Resume from saved crawler state instead of restarting"
     )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="Number of worker processes. Book sessions are sharded across processes by their BooksToScrape ID"
+    )
+    parser.add_argument(
+        "--frontier",
+        choices=["memory", "mongo"],
+        default=FRONTIER_BACKEND,
+        help="Where to keep the crawl frontier. The mongo frontier can be shared by crawler processes on several hosts"
+    )
     parser.set_defaults(restart=True)
     return parser
 
+def build_replay_cli_parser() -> ArgumentParser:
+    """Build CLI parser for BooksToScrape replay."""
+    parser = ArgumentParser(description="Rebuild books from stored HTML snapshots")
+    parser.add_argument(
+        "--source",
+        choices=["crawler", "scheduler"],
+        default="crawler",
+        help="Snapshots to replay: the ones of crawler runs or of scheduler runs"
+    )
+    parser.add_argument(
+        "--day",
+        help="Replay the snapshots of a day, as YYYYMMDD. By default, the latest snapshot of every book is replayed"
+    )
+    parser.add_argument(
+        "--shadow",
+        action="store_true",
+        help="Write the books to a shadow copy of the book collection instead of the book collection"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report parse failures and changes, without writing any book"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes that parse snapshots"
+    )
+    return parser
+
 def send_error_email(
     session_id: int,
     error_type: Literal["HTTP", "Processing", "Unknown"]